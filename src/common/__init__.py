@@ -0,0 +1,2 @@
+"""Code shared by the wirelink tools. Each tool is a standalone script and
+puts the parent of its own directory on sys.path to import this package."""
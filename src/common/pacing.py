@@ -0,0 +1,83 @@
+"""Probe pacing and adaptive timeouts, shared by ping, traceroute and the
+port sniffer."""
+
+import time
+import threading
+
+RTO_MIN = 50.0  # floor of the adaptive timeout in ms
+
+
+class TokenBucket:
+    """Paces probes at `rate` per second on the monotonic clock, allowing
+    bursts of up to `burst` probes after an idle period. A bucket may be
+    the probe budget of many threads at once, which take their tokens with
+    acquire(); delay() and consume() are for a single event loop."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def delay(self):
+        """Seconds until the next token is available, 0 when one is."""
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def acquire(self):
+        """Blocks until a probe may be sent and takes its token."""
+        while True:
+            with self.lock:
+                wait = self.delay()
+                if wait <= 0:
+                    self.consume()
+                    return
+            time.sleep(wait)
+
+
+class RtoEstimator:
+    """Retransmission timeout of RFC 6298, in ms. SRTT and RTTVAR follow
+    each RTT sample with gains of 1/8 and 1/4, and the timeout is SRTT +
+    max(G, 4 * RTTVAR) clamped to [floor, ceiling]; it is `initial` until
+    the first sample. A timeout doubles it, up to the ceiling, until the
+    next sample. Every probe has its own sequence number, so unlike TCP
+    retransmissions any reply is a valid sample."""
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self, initial, floor=RTO_MIN, ceiling=60000.0,
+                 granularity=1.0):
+        self.floor = floor
+        self.ceiling = max(floor, ceiling)
+        self.granularity = granularity
+        self.srtt = None
+        self.rttvar = None
+        self.rto = self.clamp(initial)
+
+    def clamp(self, rto):
+        return max(self.floor, min(rto, self.ceiling))
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = ((1 - self.BETA) * self.rttvar +
+                           self.BETA * abs(self.srtt - rtt))
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.rto = self.clamp(self.srtt +
+                              max(self.granularity, self.K * self.rttvar))
+
+    def backoff(self):
+        self.rto = self.clamp(self.rto * 2)
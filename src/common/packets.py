@@ -0,0 +1,192 @@
+"""Internet checksums, echo requests, the header records of received
+packets and name resolution, shared by ping and traceroute."""
+
+import sys
+import array
+import socket
+import struct
+import collections
+
+try:
+    import numpy
+except ImportError:  # checksums fall back to the array module
+    numpy = None
+
+ICMP_ECHO = 8
+NUMPY_MIN_BYTES = 4096
+
+IPV4_HEADER = struct.Struct("!BBHHHBBH4s4s")
+ICMP_HEADER = struct.Struct("!BBHHH")
+UDP_HEADER = struct.Struct("!HHHH")
+TCP_HEADER = struct.Struct("!HHIIBBHHH")
+
+
+def fold_checksum(total):
+    # adding the higher order 16 bits and lower order 16 bits until no carry
+    while total >> 16:
+        total = (total >> 16) + (total & 0xffff)
+    return total
+
+
+def calculate_checksum(packet):
+    """RFC 1071 checksum of any buffer, in network byte order. The 16-bit
+    words are summed by array (or NumPy for large buffers) instead of a
+    Python loop."""
+    if len(packet) % 2:
+        packet = bytes(packet) + b'\0'
+
+    if numpy is not None and len(packet) >= NUMPY_MIN_BYTES:
+        words = numpy.frombuffer(packet, dtype='>u2')
+        total = int(words.sum(dtype=numpy.uint64))
+    else:
+        words = array.array('H', packet)
+        if sys.byteorder == "little":
+            words.byteswap()
+        total = sum(words)
+
+    return ~fold_checksum(total) & 0xffff
+
+
+def update_checksum(checksum, old_word, new_word):
+    """Incremental checksum update for one changed 16-bit word, RFC 1624
+    eqn. 3: HC' = ~(~HC + ~m + m')."""
+    total = (~checksum & 0xffff) + (~old_word & 0xffff) + new_word
+    return ~fold_checksum(total) & 0xffff
+
+
+class EchoPacketBuilder:
+    """Echo request template of one session. The payload and its checksum
+    are computed once; each packet only rewrites the identifier and sequence
+    words and patches the checksum incrementally.
+
+    ECMP routers hash the first word of the ICMP header and the checksum as
+    the flow of an echo. Given a checksum, build() rewrites the first word
+    of the payload to keep it, so that probes with different sequence
+    numbers still take one path (Paris traceroute)."""
+
+    def __init__(self, identifier, packet_size, start_value=65,
+                 icmp_type=ICMP_ECHO):
+        pattern = bytes(range(256))
+        pattern = pattern[start_value:] + pattern[:start_value]
+        payload = (pattern * (packet_size // 256 + 1))[:packet_size]
+
+        self.identifier = identifier
+        self.seq_no = 0
+        self.packet = bytearray(
+            struct.pack("!BBHHH", icmp_type, 0, 0, identifier, 0) + payload)
+        # the kernel overwrites this for ICMPv6, which needs a pseudo header
+        self.checksum = calculate_checksum(self.packet)
+        struct.pack_into("!H", self.packet, 2, self.checksum)
+
+    def build(self, seq_no, identifier=None, checksum=None):
+        if identifier is None:
+            identifier = self.identifier
+
+        updated = update_checksum(self.checksum, self.identifier, identifier)
+        updated = update_checksum(updated, self.seq_no, seq_no)
+        if checksum is not None and len(self.packet) >= ICMP_HEADER.size + 2:
+            # ~checksum = ~updated - word + new word, in one's complement
+            word, = struct.unpack_from("!H", self.packet, ICMP_HEADER.size)
+            new_word = fold_checksum((~checksum & 0xffff) + updated + word)
+            struct.pack_into("!H", self.packet, ICMP_HEADER.size, new_word)
+            updated = checksum
+        struct.pack_into("!HHH", self.packet, 2, updated, identifier,
+                         seq_no)
+        self.checksum = updated
+        self.identifier = identifier
+        self.seq_no = seq_no
+
+        return bytes(self.packet)
+
+
+def resolve(hostname):
+    """Returns one (family, address) pair per address family the host has,
+    IPv6 first as RFC 8305 prefers it."""
+    addresses = {}
+    for family, _, _, _, sockaddr in socket.getaddrinfo(
+            hostname, None, type=socket.SOCK_RAW):
+        if family in (socket.AF_INET, socket.AF_INET6):
+            addresses.setdefault(family, sockaddr[0])
+
+    return sorted(addresses.items(),
+                  key=lambda item: item[0] != socket.AF_INET6)
+
+
+def source_address(family, destination):
+    """The local address the kernel sends to destination from, which the
+    pseudo header of UDP and TCP checksums covers. Connecting a datagram
+    socket sends nothing."""
+    with socket.socket(family, socket.SOCK_DGRAM) as connected:
+        connected.connect((destination, 9))
+        return connected.getsockname()[0]
+
+
+# builds header records straight from unpack_from, skipping _make's checks
+_new_tuple = tuple.__new__
+
+
+class IPv4Header(
+        collections.namedtuple('IPv4Header', [
+            'version_ihl', 'tos', 'total_length', 'identification',
+            'flags_fragment', 'ttl', 'protocol', 'checksum', 'source',
+            'destination'
+        ])):
+    __slots__ = ()
+
+    @property
+    def version(self):
+        return self.version_ihl >> 4
+
+    @property
+    def header_length(self):
+        """Length in bytes including options, from the IHL field."""
+        return (self.version_ihl & 0x0f) * 4
+
+    @property
+    def source_address(self):
+        return socket.inet_ntoa(self.source)
+
+    @property
+    def destination_address(self):
+        return socket.inet_ntoa(self.destination)
+
+
+class IcmpHeader(
+        collections.namedtuple(
+            'IcmpHeader',
+            ['type', 'code', 'checksum', 'identifier', 'sequence_number'])):
+    __slots__ = ()
+
+
+class TcpHeader(
+        collections.namedtuple('TcpHeader', [
+            'source_port', 'destination_port', 'sequence_number',
+            'acknowledgment_number', 'data_offset', 'flags', 'window',
+            'checksum', 'urgent_pointer'
+        ])):
+    __slots__ = ()
+
+    @property
+    def header_length(self):
+        return (self.data_offset >> 4) * 4
+
+
+def parse_ipv4(buffer, offset=0):
+    """Parses the IPv4 header at `offset` of any buffer (bytes, bytearray
+    or memoryview) without copying it. Returns None when the buffer is too
+    short or the IHL field is invalid."""
+    if len(buffer) - offset < IPV4_HEADER.size or buffer[offset] & 0x0f < 5:
+        return None
+    return _new_tuple(IPv4Header, IPV4_HEADER.unpack_from(buffer, offset))
+
+
+def parse_icmp(buffer, offset):
+    if len(buffer) - offset < ICMP_HEADER.size:
+        return None
+    return _new_tuple(IcmpHeader, ICMP_HEADER.unpack_from(buffer, offset))
+
+
+def parse_tcp(buffer, offset):
+    if len(buffer) - offset < TCP_HEADER.size:
+        return None
+    return _new_tuple(TcpHeader, TCP_HEADER.unpack_from(buffer, offset))
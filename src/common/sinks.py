@@ -0,0 +1,169 @@
+"""Result sinks writing the records of a tool as JSON lines, CSV or fixed
+size binary records, shared by ping and traceroute. Each tool renders its
+own text output and packs its own binary records."""
+
+import io
+import sys
+import csv
+import json
+import queue
+import ipaddress
+import threading
+
+FORMATS = ('text', 'jsonl', 'csv', 'binary')
+
+
+class ResultSink:
+    """Writes result records from a background thread, so the probe loop
+    only pays for a queue put. Records are encoded and written in batches
+    and the stream is flushed whenever the queue runs dry.
+
+    An error encoding or writing a batch drops that batch and is raised
+    again by the next flush() or close(), so the writer never dies with
+    records left to wait for."""
+
+    BATCH_SIZE = 1024
+    binary = False
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.error = None
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def write(self, record):
+        self.queue.put(record)
+
+    def message(self, text):
+        """Human readable progress text; it goes to stderr unless the sink
+        itself is human readable."""
+        sys.stderr.write(text + "\n")
+
+    def progress(self, text):
+        """Interactive progress marks, only shown by text output."""
+
+    def flush(self):
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        self.queue.put(None)
+        self.writer.join()
+        if self.stream not in (sys.stdout, sys.stdout.buffer):
+            self.stream.close()
+        self.raise_error()
+
+    def raise_error(self):
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def encode(self, record):
+        raise NotImplementedError
+
+    def write_loop(self):
+        empty = b"" if self.binary else ""
+        while True:
+            items = [self.queue.get()]
+            while len(items) < self.BATCH_SIZE:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            closed = None in items
+            try:
+                chunks = [
+                    self.encode(item) for item in items if item is not None
+                ]
+                self.stream.write(empty.join(chunks))
+                if closed or self.queue.empty():
+                    self.stream.flush()
+            except Exception as error:
+                if self.error is None:
+                    self.error = error
+            for _ in items:
+                self.queue.task_done()
+            if closed:
+                return
+
+
+class JsonLinesSink(ResultSink):
+    def encode(self, record):
+        return json.dumps(record._asdict()) + "\n"
+
+
+class CsvSink(ResultSink):
+    """One row per record below a header of its fields. A tuple value, such
+    as the responders of a hop, is written space separated."""
+
+    def __init__(self, stream):
+        self.header_written = False
+        super().__init__(stream)
+
+    def encode(self, record):
+        line = io.StringIO()
+        writer = csv.writer(line)
+        if not self.header_written:
+            writer.writerow(record._fields)
+            self.header_written = True
+        writer.writerow([
+            "" if value is None else
+            " ".join(value) if isinstance(value, tuple) else value
+            for value in record
+        ])
+        return line.getvalue()
+
+
+class BinarySink(ResultSink):
+    """Fixed size records packed by the tool's `pack` function, addresses
+    as 16 bytes (IPv4 mapped into IPv6) and NaN for a lost probe."""
+
+    binary = True
+
+    def __init__(self, stream, pack):
+        self.pack = pack
+        super().__init__(stream)
+
+    def encode(self, record):
+        return self.pack(record)
+
+
+def address_to_bytes(address):
+    if address is None:
+        return bytes(16)
+    address = ipaddress.ip_address(address)
+    if address.version == 4:
+        address = ipaddress.IPv6Address("::ffff:" + str(address))
+    return address.packed
+
+
+def bytes_to_address(packed):
+    if not any(packed):
+        return None
+    address = ipaddress.IPv6Address(bytes(packed))
+    if address.ipv4_mapped is not None:
+        return str(address.ipv4_mapped)
+    return str(address)
+
+
+def create_sink(output_format, output_file, text_sink, pack):
+    """The sink of an output format, writing to output_file or stdout.
+    text_sink builds the tool's text sink from the stream, and pack packs
+    one of its records for the binary format."""
+    binary = output_format == 'binary'
+    if output_file is None:
+        stream = sys.stdout.buffer if binary else sys.stdout
+    elif binary:
+        stream = open(output_file, 'wb')
+    else:
+        stream = open(output_file, 'w', newline='')
+
+    if output_format == 'text':
+        return text_sink(stream)
+    if binary:
+        return BinarySink(stream, pack)
+    if output_format == 'csv':
+        return CsvSink(stream)
+    return JsonLinesSink(stream)
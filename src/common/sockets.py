@@ -0,0 +1,122 @@
+"""Batched socket I/O, shared by ping, traceroute and the port sniffer."""
+
+# the syscall counters of a BulkSocket
+IO_COUNTERS = ('polls', 'send_calls', 'recv_calls', 'packets_sent',
+               'packets_received')
+
+
+def describe_io(counters):
+    """One line on the syscalls spent per probe, from a mapping of the
+    IO_COUNTERS of one or more sockets."""
+    syscalls = (counters['polls'] + counters['send_calls'] +
+                counters['recv_calls'])
+    per_probe = (syscalls / counters['packets_sent']
+                 if counters['packets_sent'] else 0.0)
+    return ("{} syscalls for {} probes and {} received packets, "
+            "{:.2f} per probe".format(syscalls, counters['packets_sent'],
+                                      counters['packets_received'],
+                                      per_probe))
+
+
+class BulkSocket:
+    """Batched I/O on a non-blocking datagram or raw socket.
+
+    Python has no sendmmsg/recvmmsg, so a batch costs one sendto per
+    packet, but it is sent in a single wakeup. drain() reads every queued
+    datagram with recvfrom_into into a preallocated ring of buffers, so
+    no bytes object is allocated per packet. The views it returns stay
+    valid until the ring wraps around. With an ancillary_size, recvmsg_into
+    is used instead so control messages such as the IPv6 hop limit are
+    returned too. Syscalls are counted so the cost of a probe can be
+    reported.
+    """
+
+    def __init__(self, sock, ring_size=64, buffer_size=65535,
+                 ancillary_size=0):
+        self.socket = sock
+        self.socket.setblocking(False)
+        self.ancillary_size = ancillary_size
+        self.ring = [
+            memoryview(bytearray(buffer_size)) for _ in range(ring_size)
+        ]
+        self.next_buffer = 0
+
+        self.polls = 0
+        self.send_calls = 0
+        self.recv_calls = 0
+        self.packets_sent = 0
+        self.packets_received = 0
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def sendto(self, packet, address, ancdata=()):
+        self.send_calls += 1
+        if ancdata:
+            sent = self.socket.sendmsg([packet], ancdata, 0, address)
+        else:
+            sent = self.socket.sendto(packet, address)
+        self.packets_sent += 1
+        return sent
+
+    def send_batch(self, packets):
+        """Sends (packet, address) pairs until the socket would block and
+        returns how many were sent; the caller keeps the rest."""
+        sent = 0
+        for packet, address in packets:
+            try:
+                self.sendto(packet, address)
+            except (BlockingIOError, InterruptedError):
+                break
+            sent += 1
+        return sent
+
+    def drain(self):
+        """Reads every datagram already queued on the socket, up to one
+        ring's worth, and returns a list of (memoryview, address,
+        ancillary data). It is meant to be called once per readiness event,
+        which is counted as a poll.
+
+        A pending socket error, such as the ICMP error an unconnected UDP
+        socket reports, fails one receive and is cleared by it. It is
+        raised only when nothing was read before it, so that no datagram
+        already read is lost."""
+        self.polls += 1
+        received = []
+        ring_size = len(self.ring)
+        while len(received) < ring_size:
+            buffer = self.ring[self.next_buffer]
+            self.recv_calls += 1
+            try:
+                if self.ancillary_size:
+                    nbytes, ancdata, _, address = self.socket.recvmsg_into(
+                        [buffer], self.ancillary_size)
+                else:
+                    nbytes, address = self.socket.recvfrom_into(buffer)
+                    ancdata = ()
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                if not received:
+                    raise
+                break
+            received.append((buffer[:nbytes], address, ancdata))
+            self.next_buffer = (self.next_buffer + 1) % ring_size
+
+        self.packets_received += len(received)
+        return received
+
+    @property
+    def syscalls(self):
+        return self.polls + self.send_calls + self.recv_calls
+
+    def syscalls_per_probe(self):
+        if self.packets_sent == 0:
+            return 0.0
+        return self.syscalls / self.packets_sent
+
+    def counters(self):
+        return {name: getattr(self, name) for name in IO_COUNTERS}
+
+    def describe(self):
+        return describe_io(self.counters())
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+import sys
+import timeit
+import struct
+import socket
+import argparse
+
+import ping
+from common import packets
+
+
+def legacy_calculate_checksum(packet):
+    countTo = (len(packet) // 2) * 2
+
+    count = 0
+    sum = 0
+
+    while count < countTo:
+        if sys.byteorder == "little":
+            loByte = packet[count]
+            hiByte = packet[count + 1]
+        else:
+            loByte = packet[count + 1]
+            hiByte = packet[count]
+        sum = sum + (hiByte * 256 + loByte)
+        count += 2
+
+    if countTo < len(packet):
+        sum += packet[count]
+
+    sum = (sum >> 16) + (sum & 0xffff)
+    sum += (sum >> 16)
+    answer = ~sum & 0xffff
+    answer = socket.htons(answer)
+
+    return answer
+
+
+def legacy_echo_request(identifier, seq_no, packet_size):
+    startvalue = 65
+    header = struct.pack("!BBHHH", ping.ICMP_ECHO, ping.CODE, 0, identifier,
+                         seq_no)
+
+    payload = []
+    for i in range(startvalue, startvalue + packet_size):
+        payload.append(i & 0xff)
+
+    data = bytes(payload)
+
+    checksum = legacy_calculate_checksum(header + data)
+    header = struct.pack("!BBHHH", ping.ICMP_ECHO, ping.CODE, checksum,
+                         identifier, seq_no)
+
+    return header + data
+
+
+def header_to_dict(keys, header, struct_format):
+    values = struct.unpack(struct_format, header)
+    return dict(zip(keys, values))
+
+
+def legacy_parse_echo_reply(packet_data):
+    if len(packet_data) < 28:
+        return None
+
+    icmp_keys = ['type', 'code', 'checksum', 'identifier', 'sequence number']
+    icmp_header = header_to_dict(icmp_keys, packet_data[20:28], "!BBHHH")
+    if icmp_header['type'] != ping.ICMP_ECHOREPLY:
+        return None
+
+    ip_keys = [
+        'VersionIHL', 'Type_of_Service', 'Total_Length', 'Identification',
+        'Flags_FragOffset', 'TTL', 'Protocol', 'Header_Checksum', 'Source_IP',
+        'Destination_IP'
+    ]
+    ip_header = header_to_dict(ip_keys, packet_data[:20], "!BBHHHBBHII")
+    data_len = len(packet_data) - 28
+    return (icmp_header['identifier'], icmp_header['sequence number'],
+            ip_header['TTL'], data_len)
+
+
+def canned_packets(count):
+    """Echo replies and the echo requests a raw socket sees on loopback,
+    every fourth one carrying 8 bytes of IP options."""
+    builder = ping.EchoPacketBuilder(0x1234, 55)
+    packets = []
+    for seq_no in range(count):
+        icmp = bytearray(builder.build(seq_no & 0xffff))
+        if seq_no % 2:
+            icmp[0] = ping.ICMP_ECHOREPLY
+        options = b'\x01' * 8 if seq_no % 4 == 3 else b''
+        ip = struct.pack("!BBHHHBBH4s4s", 0x40 | (5 + len(options) // 4), 0,
+                         20 + len(options) + len(icmp), seq_no & 0xffff, 0,
+                         64, 1, 0, b'\x7f\0\0\x01', b'\x7f\0\0\x01')
+        packets.append(memoryview(ip + options + bytes(icmp)))
+    return packets
+
+
+def parse_header_records(packet_data):
+    ip_header = packets.parse_ipv4(packet_data)
+    return ip_header, packets.parse_icmp(packet_data, ip_header.header_length)
+
+
+def benchmark_parsing(count, min_pps):
+    packets = canned_packets(count)
+    for packet in packets[:4]:
+        if packet[0] == 0x45 and ping.parse_echo_reply(
+                packet) != legacy_parse_echo_reply(packet):
+            print("parse_echo_reply disagrees with the legacy parser")
+            return False
+    # the legacy parser ignored IHL and misreads packets with IP options
+    if ping.parse_echo_reply(packets[3])[3] != 55:
+        print("parse_echo_reply misreads a packet with IP options")
+        return False
+
+    results = {}
+    for name, parse in (('legacy', legacy_parse_echo_reply),
+                        ('header records', parse_header_records),
+                        ('parse_echo_reply', ping.parse_echo_reply)):
+        start = timeit.default_timer()
+        for packet in packets:
+            parse(packet)
+        elapsed = timeit.default_timer() - start
+        results[name] = count / elapsed
+        print("{:>18}: {:>12,.0f} packets/s".format(name, results[name]))
+
+    print("{:>18}: {:>12.1f}x".format(
+        "speedup", results['parse_echo_reply'] / results['legacy']))
+    if results['parse_echo_reply'] < max(min_pps, results['legacy']):
+        print("parse_echo_reply regressed below {:,.0f} packets/s".format(
+            max(min_pps, results['legacy'])))
+        return False
+    return True
+
+
+def best_of(statement, number):
+    return min(timeit.repeat(statement, number=number, repeat=5)) / number
+
+
+def benchmark_checksum(packet_sizes):
+    print("{:>8} {:>14} {:>14} {:>14} {:>9}".format("size", "legacy (us)",
+                                                    "builder (us)",
+                                                    "checksum (us)",
+                                                    "speedup"))
+    for packet_size in packet_sizes:
+        builder = ping.EchoPacketBuilder(0x1234, packet_size)
+        for seq_no in (0, 1, 0xfffe, 7):
+            if builder.build(seq_no) != legacy_echo_request(
+                    0x1234, seq_no, packet_size):
+                print("EchoPacketBuilder differs from the legacy request of "
+                      "{} bytes".format(packet_size))
+                return False
+
+        packet = legacy_echo_request(0x1234, 1, packet_size)
+        if packets.calculate_checksum(packet) != legacy_calculate_checksum(
+                packet):
+            print("calculate_checksum differs from the legacy checksum of "
+                  "{} bytes".format(packet_size))
+            return False
+
+        number = max(1, 200000 // (packet_size + 64))
+        legacy = best_of(lambda: legacy_echo_request(0x1234, 1, packet_size),
+                         number)
+        built = best_of(lambda: builder.build(1), number * 20)
+        checksum = best_of(lambda: packets.calculate_checksum(packet), number)
+        print("{:>8} {:>14.2f} {:>14.2f} {:>14.2f} {:>8.0f}x".format(
+            packet_size, legacy * 1e6, built * 1e6, checksum * 1e6,
+            legacy / built))
+    return True
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmarks of the ping packet path")
+    parser.add_argument('-p',
+                        '--packet_size',
+                        required=False,
+                        nargs='+',
+                        default=[55, 1472, 9000, 65507],
+                        type=int,
+                        metavar='Packet size in bytes')
+    parser.add_argument('-n',
+                        '--packets',
+                        required=False,
+                        nargs='?',
+                        default=1000000,
+                        type=int,
+                        metavar='Canned packets to parse')
+    parser.add_argument('-m',
+                        '--min_pps',
+                        required=False,
+                        nargs='?',
+                        default=0,
+                        type=float,
+                        metavar='Fail below this many parsed packets/s')
+    return parser
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    args = parser.parse_args(sys.argv[1:])
+    if not benchmark_checksum(args.packet_size):
+        sys.exit(1)
+    print()
+    if not benchmark_parsing(args.packets, args.min_pps):
+        sys.exit(1)
@@ -4,262 +4,820 @@ import socket
 import os
 import time
 import sys
+import math
+import array
 import struct
-import select
+import selectors
 import argparse
 import signal
+import asyncio
 import threading
+import collections
 
-timer = time.time
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.packets import (ICMP_HEADER, IPV4_HEADER, EchoPacketBuilder,
+                            resolve)
+from common import sinks
+from common.pacing import RTO_MIN, RtoEstimator, TokenBucket
+from common.sinks import FORMATS, ResultSink, address_to_bytes
+from common.sockets import BulkSocket, describe_io
+
+timer = time.perf_counter
 
 ICMP_ECHO = 8
 ICMP_ECHOREPLY = 0
+ICMPV6_ECHO_REQUEST = 128
+ICMPV6_ECHO_REPLY = 129
+ICMPV6_FILTER = 1  # <linux/icmpv6.h>, not exported by the socket module
+ICMP_FILTER = 1  # <linux/icmp.h>, at the SOL_RAW level
+SOL_RAW = 255
+IP_RECVTTL = 12  # <linux/in.h>, not exported by the socket module either
 CODE = 0
 MIN_SLEEP = 1000.00
-
-
-def calculate_checksum(packet):
-    countTo = (len(packet) // 2) * 2
-
-    count = 0
-    sum = 0
-
-    while count < countTo:
-        if sys.byteorder == "little":
-            loByte = packet[count]
-            hiByte = packet[count + 1]
-        else:
-            loByte = packet[count + 1]
-            hiByte = packet[count]
-        sum = sum + (hiByte * 256 + loByte)
-        count += 2
-
-    if countTo < len(packet):
-        sum += packet[count]
-
-    # sum &= 0xffffffff
-
-    # adding the higher order 16 bits and lower order 16 bits
-    sum = (sum >> 16) + (sum & 0xffff)
-    sum += (sum >> 16)
-    answer = ~sum & 0xffff
-    answer = socket.htons(answer)
-
-    return answer
-
-
-def is_valid_ip(hostname_ip):
-    ip_parts = hostname_ip.strip().split('.')
-    if ip_parts != 4:
-        return False
-    for part in ip_parts:
+PERCENTILES = (50, 90, 99, 99.9)
+SPIN_WAIT = 0.001  # waits shorter than this (s) are spun, not slept
+DATAGRAM_RING_SIZE = 8  # replies read at once from a session's ping socket
+
+PingResult = collections.namedtuple(
+    'PingResult',
+    [
+        'host', 'ip', 'seq_no', 'ttl', 'data_len', 'from_address', 'delay',
+        'timestamp'
+    ])
+# timestamp, ip, from address, sequence, ttl, data length, delay (ms)
+BINARY_RECORD = struct.Struct("!d16s16sHBHf")
+
+
+def open_icmp_socket(family=socket.AF_INET, datagram=False, ring_size=64,
+                     buffer_size=65535):
+    """Opens a raw ICMP socket, or with datagram=True an unprivileged Linux
+    ping socket (SOCK_DGRAM, allowed by net.ipv4.ping_group_range). The
+    kernel then sets the identifier to the socket's port, computes the
+    checksum, queues only the replies to that identifier and strips their
+    IP header, so the TTL has to come from a control message."""
+    kind = socket.SOCK_DGRAM if datagram else socket.SOCK_RAW
+    if family == socket.AF_INET6:
+        icmp_socket = socket.socket(socket.AF_INET6, kind,
+                                    socket.IPPROTO_ICMPV6)
+        icmp_socket.setsockopt(socket.IPPROTO_IPV6,
+                               socket.IPV6_RECVHOPLIMIT, 1)
+        # let only echo replies wake us up, a set bit blocks a type
+        blocked = [0xffffffff] * 8
+        blocked[ICMPV6_ECHO_REPLY >> 5] &= ~(1 << (ICMPV6_ECHO_REPLY & 31))
         try:
-            if int(part) < 0 or int(part) > 255:
-                return False
-
-        except ValueError:
-            return False
-
-    return True
+            icmp_socket.setsockopt(socket.IPPROTO_ICMPV6, ICMPV6_FILTER,
+                                   struct.pack("=8I", *blocked))
+        except OSError:
+            pass
+        return BulkSocket(icmp_socket,
+                          ring_size,
+                          buffer_size,
+                          ancillary_size=socket.CMSG_SPACE(4))
+
+    if datagram:
+        icmp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                    socket.IPPROTO_ICMP)
+        icmp_socket.setsockopt(socket.IPPROTO_IP, IP_RECVTTL, 1)
+        return BulkSocket(icmp_socket,
+                          ring_size,
+                          buffer_size,
+                          ancillary_size=socket.CMSG_SPACE(4))
+
+    icmp_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW,
+                                socket.getprotobyname("ICMP"))
+    # a raw socket sees every ICMP message of the host, the filter lets
+    # only echo replies wake us up
+    blocked = 0xffffffff & ~(1 << ICMP_ECHOREPLY)
+    try:
+        icmp_socket.setsockopt(SOL_RAW, ICMP_FILTER,
+                               struct.pack("=I", blocked))
+    except OSError:
+        pass
+    return BulkSocket(icmp_socket, ring_size, buffer_size)
+
+
+def print_socket_error(err):
+    if err.errno in (1, 13):
+        print(
+            "Operation not permitted: ICMP messages can only be sent from a process running as root"
+            " or from a group in net.ipv4.ping_group_range")
+    else:
+        print("Error: {}".format(err))
+
+
+def parse_echo_reply(packet_data, ancdata=()):
+    """Returns (identifier, sequence number, ttl, data length) of an echo
+    reply read from a raw socket, or None for any other packet. IP options
+    are skipped using the IHL field."""
+    if len(packet_data) < IPV4_HEADER.size:
+        return None
+    # cheap checks on single bytes first: most packets are not ours
+    offset = (packet_data[0] & 0x0f) * 4
+    if len(packet_data) < offset + ICMP_HEADER.size:
+        return None
+    # a raw socket also sees our own echo requests on loopback
+    if packet_data[offset] != ICMP_ECHOREPLY:
+        return None
+
+    icmp_type, code, checksum, identifier, seq_no = ICMP_HEADER.unpack_from(
+        packet_data, offset)
+    ttl = packet_data[8]
+    data_len = len(packet_data) - offset - ICMP_HEADER.size
+    return identifier, seq_no, ttl, data_len
+
+
+def hop_limit_from(ancdata):
+    """The TTL or hop limit a packet arrived with, from its IP_TTL or
+    IPV6_HOPLIMIT control message; 0 when there is none."""
+    for level, kind, data in ancdata:
+        if (level, kind) in ((socket.IPPROTO_IP, socket.IP_TTL),
+                             (socket.IPPROTO_IPV6, socket.IPV6_HOPLIMIT)):
+            return int.from_bytes(data[:4], sys.byteorder)
+    return 0
+
+
+def parse_echo_reply6(packet_data, ancdata=()):
+    """parse_echo_reply for ICMPv6 raw sockets, which receive no IP header;
+    the hop limit comes from the IPV6_HOPLIMIT control message."""
+    if len(packet_data) < ICMP_HEADER.size:
+        return None
+    if packet_data[0] != ICMPV6_ECHO_REPLY:
+        return None
+
+    icmp_type, code, checksum, identifier, seq_no = ICMP_HEADER.unpack_from(
+        packet_data)
+    return (identifier, seq_no, hop_limit_from(ancdata),
+            len(packet_data) - ICMP_HEADER.size)
+
+
+def parse_datagram_echo_reply(packet_data, ancdata=()):
+    """parse_echo_reply for IPv4 ping sockets, which receive no IP header
+    either; the TTL comes from the IP_TTL control message."""
+    if len(packet_data) < ICMP_HEADER.size:
+        return None
+    if packet_data[0] != ICMP_ECHOREPLY:
+        return None
+
+    icmp_type, code, checksum, identifier, seq_no = ICMP_HEADER.unpack_from(
+        packet_data)
+    return (identifier, seq_no, hop_limit_from(ancdata),
+            len(packet_data) - ICMP_HEADER.size)
+
+
+ECHO_REQUEST = {
+    socket.AF_INET: ICMP_ECHO,
+    socket.AF_INET6: ICMPV6_ECHO_REQUEST,
+}
+ECHO_REPLY_PARSER = {
+    socket.AF_INET: parse_echo_reply,
+    socket.AF_INET6: parse_echo_reply6,
+}
+DATAGRAM_ECHO_REPLY_PARSER = {
+    socket.AF_INET: parse_datagram_echo_reply,
+    socket.AF_INET6: parse_echo_reply6,
+}
+
+
+class RttStatistics:
+    """Streaming round-trip statistics of one session in constant memory.
+
+    Mean and variance are kept with Welford's method, jitter as in
+    RFC 3550 section 6.4.1 and percentiles in a log-bucketed histogram
+    whose estimates are within 1% of the real value. Two instances can be
+    merged, e.g. to aggregate every host of a run.
+    """
+
+    ACCURACY = 0.01
+    MIN_DELAY = 0.001  # ms, smaller delays land in the first bucket
+    BUCKETS = 1024  # covers up to ~800 s at 1% accuracy
+
+    GAMMA = (1 + ACCURACY) / (1 - ACCURACY)
+    LOG_GAMMA = math.log(GAMMA)
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min_delay = math.inf
+        self.max_delay = 0.0
+        self.jitter = 0.0
+        self.last_delay = None
+        self.buckets = array.array('Q', [0]) * self.BUCKETS
+
+    def add(self, delay):
+        self.count += 1
+        difference = delay - self.mean
+        self.mean += difference / self.count
+        self.m2 += difference * (delay - self.mean)
+
+        self.min_delay = min(self.min_delay, delay)
+        self.max_delay = max(self.max_delay, delay)
+
+        if self.last_delay is not None:
+            self.jitter += (abs(delay - self.last_delay) - self.jitter) / 16
+        self.last_delay = delay
+
+        self.buckets[self.bucket_index(delay)] += 1
+
+    def merge(self, other):
+        """Folds `other` into this instance. Jitter of the merged result is
+        the count weighted mean of both jitters."""
+        count = self.count + other.count
+        if other.count == 0:
+            return self
+        difference = other.mean - self.mean
+        self.m2 += other.m2 + difference**2 * self.count * other.count / count
+        self.mean += difference * other.count / count
+        self.jitter = (self.jitter * self.count +
+                       other.jitter * other.count) / count
+        self.count = count
+
+        self.min_delay = min(self.min_delay, other.min_delay)
+        self.max_delay = max(self.max_delay, other.max_delay)
+        self.last_delay = None
+        for index, bucket_count in enumerate(other.buckets):
+            if bucket_count:
+                self.buckets[index] += bucket_count
+        return self
+
+    def bucket_index(self, delay):
+        if delay <= self.MIN_DELAY:
+            return 0
+        index = math.ceil(math.log(delay / self.MIN_DELAY) / self.LOG_GAMMA)
+        return min(index, self.BUCKETS - 1)
+
+    def percentile(self, percent):
+        if self.count == 0:
+            return None
+        rank = max(1, math.ceil(self.count * percent / 100))
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= rank:
+                break
+        if index == 0:
+            estimate = self.MIN_DELAY
+        else:
+            estimate = (self.MIN_DELAY * 2 * self.GAMMA**index /
+                        (self.GAMMA + 1))
+        return min(max(estimate, self.min_delay), self.max_delay)
+
+    @property
+    def stddev(self):
+        if self.count < 2:
+            return 0.0
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    @property
+    def mdev(self):
+        """Population standard deviation, reported as mdev by iputils."""
+        if self.count == 0:
+            return 0.0
+        return math.sqrt(self.m2 / self.count)
+
+
+def print_statistics(statistics, sink):
+    if statistics.count == 0:
+        return
+    sink.message(
+        "round-trip min/avg/max/mdev = {:.3f}/{:.3f}/{:.3f}/{:.3f} ms".format(
+            statistics.min_delay, statistics.mean, statistics.max_delay,
+            statistics.mdev))
+    sink.message("stddev = {:.3f} ms, jitter = {:.3f} ms, "
+                 "p50/p90/p99/p99.9 = {:.3f}/{:.3f}/{:.3f}/{:.3f} ms".format(
+                     statistics.stddev, statistics.jitter,
+                     *[statistics.percentile(p) for p in PERCENTILES]))
+
+
+class TextSink(ResultSink):
+    """The classic ping output, one line per echo or, in flood mode, a dot
+    per echo that is erased again by its reply."""
+
+    def __init__(self, stream, flood=False):
+        self.flood = flood
+        super().__init__(stream)
+
+    def message(self, text):
+        self.write(text + "\n")
+
+    def progress(self, text):
+        self.write(text)
+
+    def encode(self, record):
+        if isinstance(record, str):
+            return record
+        if record.delay is None:
+            if self.flood:
+                return ""
+            return "Request timeout for icmp_seq {}\n".format(record.seq_no)
+        if self.flood:
+            return "\b \b"
+        return "{} bytes from {}: icmp_seq={} ttl={} time={:.3f} ms\n".format(
+            record.data_len, record.from_address, record.seq_no, record.ttl,
+            record.delay)
+
+
+def pack_binary_record(result):
+    delay = math.nan if result.delay is None else result.delay
+    return BINARY_RECORD.pack(result.timestamp, address_to_bytes(result.ip),
+                              address_to_bytes(result.from_address),
+                              result.seq_no, result.ttl,
+                              min(result.data_len, 0xffff), delay)
+
+
+def create_sink(output_format='text', output_file=None, flood=False):
+    return sinks.create_sink(output_format, output_file,
+                             lambda stream: TextSink(stream, flood),
+                             pack_binary_record)
+
+
+class IcmpDispatcher:
+    """One long-lived raw ICMP socket of an address family, shared by every
+    Ping session of the process. A single receive loop reads all echo
+    replies and routes each of them to the session that owns its
+    identifier.
+
+    Without the privilege to open a raw socket, the dispatcher falls back
+    to unprivileged ping sockets, one per session: the kernel hands out
+    the identifier (the socket's port) and delivers each socket only its
+    own replies, so other processes' echoes no longer wake us up."""
+
+    def __init__(self, family=socket.AF_INET):
+        self.family = family
+        self.parse_reply = ECHO_REPLY_PARSER[family]
+        self.datagram = False
+        self.bulk_socket = None
+        self.session_sockets = {}
+        self.counters = collections.Counter()  # of the sockets closed so far
+        self.opened = False
+        self.receiver = None
+        self.waker = None
+        self.wakeup = None
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.next_identifier = os.getpid() & 0xffff
+
+    def open(self):
+        with self.lock:
+            if self.receiver is not None:
+                return
+            try:
+                self.bulk_socket = open_icmp_socket(self.family)
+            except PermissionError:
+                # fails like the raw socket did when ping sockets are not
+                # allowed for our group either
+                open_icmp_socket(self.family, datagram=True).socket.close()
+                self.datagram = True
+                self.parse_reply = DATAGRAM_ECHO_REPLY_PARSER[self.family]
+            self.opened = True
+            self.waker, self.wakeup = socket.socketpair()
+            self.wakeup.setblocking(False)
+            self.receiver = threading.Thread(target=self.receive_loop,
+                                             args=(self.waker, self.wakeup),
+                                             daemon=True)
+            self.receiver.start()
+
+    def close(self):
+        with self.lock:
+            if self.receiver is None:
+                return
+            self.receiver = None
+            bulk_sockets = [self.bulk_socket] if self.bulk_socket else []
+            bulk_sockets += self.session_sockets.values()
+            self.bulk_socket = None
+            self.session_sockets.clear()
+            self.waker.send(b'\0')
+            # the receive loop closes the pair it was started with
+            self.waker = self.wakeup = None
+        for bulk_socket in bulk_sockets:
+            self.retire(bulk_socket)
+
+    def retire(self, bulk_socket):
+        """Closes a socket, keeping its syscall counters for describe()."""
+        with self.lock:
+            self.counters.update(bulk_socket.counters())
+        bulk_socket.socket.close()
+
+    def describe(self):
+        """The syscalls spent per probe on every socket used so far."""
+        with self.lock:
+            counters = collections.Counter(self.counters)
+            bulk_sockets = list(self.session_sockets.values())
+            if self.bulk_socket is not None:
+                bulk_sockets.append(self.bulk_socket)
+        for bulk_socket in bulk_sockets:
+            counters.update(bulk_socket.counters())
+        return describe_io(counters)
+
+    def register(self, session):
+        with self.lock:
+            if self.datagram:
+                # the kernel queues only this session's replies on it, so a
+                # few slots of the session's reply size are enough
+                bulk_socket = open_icmp_socket(
+                    self.family,
+                    datagram=True,
+                    ring_size=DATAGRAM_RING_SIZE,
+                    buffer_size=ICMP_HEADER.size + session.packet_size)
+                bulk_socket.socket.bind(('', 0))
+                identifier = bulk_socket.socket.getsockname()[1]
+                self.session_sockets[identifier] = bulk_socket
+                self.waker.send(b'\0')  # watch the new socket too
+            else:
+                identifier = self.next_identifier
+                while identifier in self.sessions:
+                    identifier = (identifier + 1) & 0xffff
+                self.next_identifier = (identifier + 1) & 0xffff
+            self.sessions[identifier] = session
+            return identifier
+
+    def unregister(self, identifier):
+        with self.lock:
+            self.sessions.pop(identifier, None)
+            bulk_socket = self.session_sockets.pop(identifier, None)
+            if bulk_socket is not None:
+                self.waker.send(b'\0')
+        if bulk_socket is not None:
+            self.retire(bulk_socket)
+
+    def sendto(self, packet, address, identifier):
+        bulk_socket = self.session_sockets.get(identifier, self.bulk_socket)
+        return bulk_socket.sendto(packet, (address, 0))
+
+    def receive_loop(self, waker, wakeup):
+        """Waits on the sockets with epoll (or the best selector of the
+        platform), which unlike select() takes any number of them. The set
+        watched is brought up to date on every wakeup; a socket closed in
+        the meantime has already left the epoll set by itself."""
+        selector = selectors.DefaultSelector()
+        selector.register(wakeup, selectors.EVENT_READ)
 
+        while True:
+            with self.lock:
+                if self.wakeup is not wakeup:  # closed, and maybe opened again
+                    selector.close()
+                    waker.close()
+                    wakeup.close()
+                    return
+                readers = set(self.session_sockets.values())
+                if self.bulk_socket is not None:
+                    readers.add(self.bulk_socket)
+            watched = {key.fileobj for key in selector.get_map().values()}
+            for bulk_socket in watched - readers - {wakeup}:
+                selector.unregister(bulk_socket)
+            for bulk_socket in readers - watched:
+                selector.register(bulk_socket, selectors.EVENT_READ)
+
+            ready = selector.select()
+            receive_time = timer()
 
-def to_ip(hostname):
-    if is_valid_ip(hostname):
-        return hostname
-    return socket.gethostbyname(hostname)
+            for key, events in ready:
+                bulk_socket = key.fileobj
+                if bulk_socket is wakeup:
+                    try:
+                        wakeup.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                try:
+                    packets = bulk_socket.drain()
+                except (OSError, ValueError):  # closed since
+                    continue
+
+                for packet_data, address, ancdata in packets:
+                    reply = self.parse_reply(packet_data, ancdata)
+                    if reply is None:
+                        continue
+
+                    identifier, seq_no, ttl, data_len = reply
+                    session = self.sessions.get(identifier)
+                    if session is not None:
+                        session.deliver(seq_no, receive_time, ttl, data_len,
+                                        address[0])
+
+
+dispatchers = {
+    socket.AF_INET: IcmpDispatcher(socket.AF_INET),
+    socket.AF_INET6: IcmpDispatcher(socket.AF_INET6),
+}
 
 
 class Ping:
     def __init__(self, destination_server, count_of_packets, timeout_in_ms,
-                 packet_size):
+                 packet_size, interval=MIN_SLEEP, window=1, flood=False,
+                 sink=None, adaptive=False, rto_min=RTO_MIN, rto_max=None):
+        self.own_sink = sink is None
+        self.sink = sink if sink is not None else TextSink(sys.stdout, flood)
         self.destination_server = destination_server
         self.count_of_packets = count_of_packets
         self.timeout_in_ms = timeout_in_ms
+        # echoes time out after the RTO, but their replies are counted until
+        # the ceiling, so that loss stays what it is with a fixed timeout;
+        # only an echo still unanswered then is reported lost
+        self.rto = None
+        if adaptive:
+            self.rto = RtoEstimator(timeout_in_ms, rto_min,
+                                    rto_max or timeout_in_ms)
+        self.late = {}
         self.packet_size = packet_size
+        self.interval = interval
+        self.window = max(1, min(window, 0xffff))
+        self.flood = flood
         if self.packet_size > 65507:
-            print("ping: packet size too large: {} > 65507".format(
+            self.sink.message("ping: packet size too large: {} > 65507".format(
                 self.packet_size))
+            self.sink.flush()
             sys.exit()
-        self.identifier = os.getpid() & 0xffff
+        self.dispatcher = None
+        self.identifier = None
+        self.packet_builder = None
         self.seq_no = -1
+        self.pending = {}
+        self.replies = []
+        self.reply_ready = threading.Condition()
         try:
-            self.destination_ip = to_ip(self.destination_server)
+            self.addresses = resolve(self.destination_server)
         except socket.gaierror as e:
             self.print_unknown_host()
+            self.sink.flush()
             sys.exit()
+        self.family, self.destination_ip = self.addresses[0]
 
         self.sent_packets = 0
         self.received_packets = 0
-        self.min_delay = 999999999.0
-        self.max_delay = 0.0
-        self.total_delay = 0.0
+        self.statistics = RttStatistics()
 
     def print_start(self):
-        print("PING {} ({}): {} data bytes".format(self.destination_server,
-                                                   self.destination_ip,
-                                                   self.packet_size))
+        self.sink.message("PING {} ({}): {} data bytes".format(
+            self.destination_server,
+            ", ".join(ip for family, ip in self.addresses), self.packet_size))
 
     def print_unknown_host(self):
-        print("ping: cannot resolve {}: Unknown host".format(
+        self.sink.message("ping: cannot resolve {}: Unknown host".format(
             self.destination_server))
 
-    def print_timeout(self):
-        print("Request timeout for icmp_seq {}".format(self.seq_no))
+    def print_timeout(self, seq_no):
+        self.sink.write(
+            PingResult(self.destination_server, self.destination_ip, seq_no,
+                       0, 0, None, None, time.time()))
 
-    def print_success(self, data_len, from_address, ttl, delay):
-        print("{} bytes from {}: icmp_seq={} ttl={} time={:.3f} ms".format(
-            data_len, from_address, self.seq_no, ttl, delay))
+    def print_success(self, seq_no, data_len, from_address, ttl, delay):
+        self.sink.write(
+            PingResult(self.destination_server, self.destination_ip, seq_no,
+                       ttl, data_len, from_address, delay, time.time()))
+
+    def print_sent(self):
+        if self.flood:
+            self.sink.progress(".")
 
     def print_exit(self):
-        print("\n--- {} ping statistics ---".format(self.destination_server))
+        self.sink.message("\n--- {} ping statistics ---".format(
+            self.destination_server))
 
         if self.sent_packets != 0:
             packet_loss = ((self.sent_packets - self.received_packets) *
                            100) / self.sent_packets
-            print(
+            self.sink.message(
                 "For {} ({}) {} packets transmitted, {} packets received, {:.1f}% packet loss"
                 .format(self.destination_server, self.destination_ip,
                         self.sent_packets, self.received_packets, packet_loss))
 
-            avg = self.total_delay / self.sent_packets
-            if self.received_packets > 0:
-                print(
-                    "round-trip min/avg/max = {:.3f}/{:.3f}/{:.3f} ms".format(
-                        self.min_delay, avg, self.max_delay))
+            print_statistics(self.statistics, self.sink)
 
         else:
-            print("{} packets transmitted, {} packets received".format(
-                self.sent_packets, self.received_packets))
+            self.sink.message(
+                "{} packets transmitted, {} packets received".format(
+                    self.sent_packets, self.received_packets))
+
+        self.sink.message('----------------------------------')
+        self.sink.flush()
 
-        print('----------------------------------')
+    def close(self):
+        """Stops the sink the session created for itself, if any."""
+        if self.own_sink:
+            self.sink.close()
 
-    @staticmethod
-    def header_to_dict(keys, header, struct_format):
-        values = struct.unpack(struct_format, header)
-        return dict(zip(keys, values))
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def start_ping(self):
 
-        try:
-            while self.count_of_packets > 0:
-                self.pinger()
-                self.count_of_packets -= 1
-        except KeyboardInterrupt:  # handle Ctrl+C
-            print()
+        candidates = []
+        for family, ip in self.addresses:
+            try:
+                dispatchers[family].open()
+            except socket.error as err:
+                error = err
+                continue
+            candidates.append((family, ip))
+
+        if not candidates:
+            print_socket_error(error)
+            sys.exit()
 
-    def pinger(self):
+        self.print_start()
+
+        if self.interval > 0:
+            bucket = TokenBucket(1000.00 / self.interval)
+        else:  # flood: paced only by the window of outstanding echoes
+            bucket = None
 
         try:
-            icmp_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW,
-                                        socket.getprotobyname("ICMP"))
+            if len(candidates) > 1 and self.count_of_packets > 0:
+                if bucket:
+                    bucket.consume()
+                self.race(candidates)
+            else:
+                self.use_address(*candidates[0])
+
+            while True:
+                self.receive_icmp_reply()
+                with self.reply_ready:
+                    if self.count_of_packets <= 0 and not (
+                            self.pending or self.late or self.replies):
+                        break
+
+                wait = None
+                if self.count_of_packets > 0 and len(
+                        self.pending) < self.window:
+                    wait = bucket.delay() if bucket else 0.0
+                    if wait <= 0:
+                        if bucket:
+                            bucket.consume()
+                        self.pinger()
+                        self.count_of_packets -= 1
+                        continue
+
+                if self.pending:
+                    oldest = self.pending[next(iter(self.pending))]
+                    expiry = oldest + self.current_timeout() - timer()
+                    wait = expiry if wait is None else min(wait, expiry)
+                if self.late:
+                    oldest = self.late[next(iter(self.late))]
+                    expiry = oldest + self.rto.ceiling / 1000 - timer()
+                    wait = expiry if wait is None else min(wait, expiry)
+
+                if wait is not None and wait < SPIN_WAIT:
+                    time.sleep(0)  # lets the receive loop run
+                    continue
+
+                with self.reply_ready:
+                    if not self.replies:
+                        self.reply_ready.wait(wait)
+        except KeyboardInterrupt:  # handle Ctrl+C
+            print()
+        finally:
+            if self.dispatcher is not None:
+                self.dispatcher.unregister(self.identifier)
+
+    def use_address(self, family, ip, identifier=None):
+        self.family = family
+        self.destination_ip = ip
+        self.dispatcher = dispatchers[family]
+        if identifier is None:
+            identifier = self.dispatcher.register(self)
+        self.identifier = identifier
+        self.packet_builder = EchoPacketBuilder(self.identifier,
+                                                self.packet_size,
+                                                icmp_type=ECHO_REQUEST[family])
+
+    def race(self, candidates):
+        """Happy Eyeballs: the first echo goes to every address of the host
+        at once and the session keeps the family that answers first. If
+        none does, the preferred one (IPv6) is kept."""
+        contenders = []
+        for family, ip in candidates:
+            identifier = dispatchers[family].register(self)
+            builder = EchoPacketBuilder(identifier,
+                                        self.packet_size,
+                                        icmp_type=ECHO_REQUEST[family])
+            contenders.append((family, ip, identifier, builder))
 
-        except socket.error as err:
-            if err.errno == 1:
-                print(
-                    "Operation not permitted: ICMP messages can only be sent from a process running as root"
-                )
+        self.seq_no += 1
+        with self.reply_ready:
+            self.pending[self.seq_no] = timer()
+        for family, ip, identifier, builder in contenders:
+            try:
+                dispatchers[family].sendto(builder.build(self.seq_no), ip,
+                                           identifier)
+            except socket.error:
+                pass
+        self.sent_packets += 1
+        self.count_of_packets -= 1
+        self.print_sent()
+
+        with self.reply_ready:
+            self.reply_ready.wait_for(lambda: self.replies,
+                                      self.current_timeout())
+            if self.replies:
+                from_address = self.replies[0][-1]
+                winner = (socket.AF_INET6
+                          if ':' in from_address else socket.AF_INET)
             else:
-                print("Error: {}".format(err))
+                winner = contenders[0][0]
 
-            sys.exit()
+        for family, ip, identifier, builder in contenders:
+            if family == winner:
+                self.use_address(family, ip, identifier)
+            else:
+                dispatchers[family].unregister(identifier)
+
+    def deliver(self, seq_no, receive_time, ttl, data_len, from_address):
+        with self.reply_ready:
+            send_time = self.pending.pop(seq_no, None)
+            if send_time is None:
+                send_time = self.late.pop(seq_no, None)
+            if send_time is not None:
+                self.replies.append((seq_no, send_time, receive_time, ttl,
+                                     data_len, from_address))
+                self.reply_ready.notify()
 
-        if self.seq_no == -1:
-            self.print_start()
+    def pinger(self):
 
         self.seq_no += 1
-        time_values = self.send_icmp_request(icmp_socket)
+        send_time = self.send_icmp_request()
 
-        if time_values is None:
-            time.sleep(MIN_SLEEP / 1000.00)
+        if send_time is None:
             return
 
-        send_time, start_of_wait = map(float, time_values)
         self.sent_packets += 1
+        self.print_sent()
 
-        receive_time, ttl, data_len, from_address = self.receive_icmp_reply(
-            icmp_socket)
-        icmp_socket.close()
-
-        if receive_time:
-            self.received_packets += 1
-            delay = (receive_time - send_time) * 1000.00
-            if self.min_delay > delay:
-                self.min_delay = delay
-
-            if self.max_delay < delay:
-                self.max_delay = delay
-
-            self.total_delay += delay
-
-            self.print_success(data_len, from_address, ttl, delay)
-
-            if MIN_SLEEP > delay:
-                time.sleep((MIN_SLEEP - delay) / 1000.00)
-
-    def send_icmp_request(self, icmp_socket):
+    def send_icmp_request(self):
 
-        checksum = 0
-        startvalue = 65
-        header = struct.pack("!BBHHH", ICMP_ECHO, CODE, checksum,
-                             self.identifier, self.seq_no)
+        seq_no = self.seq_no & 0xffff
+        packet = self.packet_builder.build(seq_no)
 
-        payload = []
-        for i in range(startvalue, startvalue + self.packet_size):
-            payload.append(i & 0xff)
-
-        data = bytes(payload)
-
-        checksum = calculate_checksum(header + data)
-        header = struct.pack("!BBHHH", ICMP_ECHO, CODE, checksum,
-                             self.identifier, self.seq_no)
-
-        packet = header + data
-
-        send_time = timer()
+        with self.reply_ready:
+            send_time = timer()
+            self.pending[seq_no] = send_time
         try:
-            icmp_socket.sendto(packet, (self.destination_server, 1))
-            start_of_wait = timer()
+            self.dispatcher.sendto(packet, self.destination_ip,
+                                   self.identifier)
 
         except socket.error as err:
-            print("General error: %s", err)
-            icmp_socket.close()
+            with self.reply_ready:
+                self.pending.pop(seq_no, None)
+            self.sink.message("ping: sendto {}: {}".format(
+                self.destination_ip, err))
             return
 
-        return send_time, start_of_wait
-
-    def receive_icmp_reply(self, icmp_socket):
-
-        timeout = self.timeout_in_ms / 1000  # converting timeout to s
-
-        while True:
-
-            inputready, _, _ = select.select([icmp_socket], [], [], timeout)
-            receive_time = timer()
-
-            if not inputready:  # timeout
-                self.print_timeout()
-                return None, 0, 0, 0
-
-            packet_data, address = icmp_socket.recvfrom(2048)
-
-            icmp_keys = [
-                'type', 'code', 'checksum', 'identifier', 'sequence number'
-            ]
-            icmp_header = self.header_to_dict(icmp_keys, packet_data[20:28],
-                                              "!BBHHH")
+        return send_time
+
+    def current_timeout(self):
+        """Seconds an echo is waited for before it is reported lost."""
+        if self.rto is None:
+            return self.timeout_in_ms / 1000  # converting timeout to s
+        return self.rto.rto / 1000
+
+    def receive_icmp_reply(self):
+        """Accounts for every reply delivered since the last call and for
+        every outstanding echo older than the timeout."""
+
+        timeout = self.current_timeout()
+
+        with self.reply_ready:
+            replies, self.replies = self.replies, []
+            expired = []
+            lost = []
+            now = timer()
+            while self.pending:
+                seq_no = next(iter(self.pending))
+                if now - self.pending[seq_no] < timeout:
+                    break
+                if self.rto is None:
+                    lost.append(seq_no)
+                else:
+                    # reported lost only once its reply can no longer come
+                    self.late[seq_no] = self.pending[seq_no]
+                del self.pending[seq_no]
+                expired.append(seq_no)
+            while self.late:
+                seq_no = next(iter(self.late))
+                if now - self.late[seq_no] < self.rto.ceiling / 1000:
+                    break
+                del self.late[seq_no]
+                lost.append(seq_no)
+
+        if expired and self.rto is not None:
+            self.rto.backoff()
+
+        for reply in replies:
+            seq_no, send_time, receive_time, ttl, data_len, from_address = reply
+            self.received_packets += 1
+            delay = (receive_time - send_time) * 1000.00
+            self.statistics.add(delay)
+            if self.rto is not None:
+                self.rto.sample(delay)
 
-            if icmp_header['identifier'] == self.identifier and icmp_header[
-                    'sequence number'] == self.seq_no:
+            self.print_success(seq_no, data_len, from_address, ttl, delay)
 
-                ip_keys = [
-                    'VersionIHL', 'Type_of_Service', 'Total_Length',
-                    'Identification', 'Flags_FragOffset', 'TTL', 'Protocol',
-                    'Header_Checksum', 'Source_IP', 'Destination_IP'
-                ]
-                ip_header = self.header_to_dict(ip_keys, packet_data[:20],
-                                                "!BBHHHBBHII")
-                data_len = len(packet_data) - 28
-                return receive_time, ip_header['TTL'], data_len, address[0]
+        for seq_no in lost:
+            self.print_timeout(seq_no)
 
 
 def create_parser():
@@ -291,20 +849,306 @@ def create_parser():
                         default=55,
                         type=int,
                         metavar='Packet size in bytes')
+    parser.add_argument('-i',
+                        '--interval',
+                        required=False,
+                        nargs='?',
+                        default=None,
+                        type=float,
+                        metavar='Interval between echoes in ms (0.001 = 1us)')
+    parser.add_argument('-w',
+                        '--window',
+                        required=False,
+                        nargs='?',
+                        default=1,
+                        type=int,
+                        metavar='Echoes in flight')
+    parser.add_argument('-f',
+                        '--flood',
+                        required=False,
+                        action='store_true',
+                        help='Flood ping: no pacing, a dot per unanswered echo')
+    parser.add_argument('-o',
+                        '--output_format',
+                        required=False,
+                        default='text',
+                        choices=sorted(FORMATS),
+                        help='Format of the results (default text)')
+    parser.add_argument('-O',
+                        '--output_file',
+                        required=False,
+                        default=None,
+                        metavar='File to write the results to')
+    parser.add_argument('-S',
+                        '--io_statistics',
+                        required=False,
+                        action='store_true',
+                        help='Report the syscalls spent per probe')
+    parser.add_argument('-E',
+                        '--asyncio',
+                        required=False,
+                        action='store_true',
+                        help='Ping every host from one asyncio event loop')
+    parser.add_argument('-A',
+                        '--adaptive',
+                        required=False,
+                        action='store_true',
+                        help='Time echoes out after an RTO estimated from '
+                        'their RTTs (RFC 6298), the timeout being its ceiling')
+    parser.add_argument('-k',
+                        '--rto_min',
+                        required=False,
+                        nargs='?',
+                        default=RTO_MIN,
+                        type=float,
+                        metavar='Floor of the adaptive timeout in ms')
+    parser.add_argument('-K',
+                        '--rto_max',
+                        required=False,
+                        nargs='?',
+                        default=None,
+                        type=float,
+                        metavar='Ceiling of the adaptive timeout in ms')
     return parser
 
 
-def is_any_thread_alive(threads):
-    return True in [t.is_alive() for t in threads]
+async def async_ping(hosts, timeout=1000, count=1000, packet_size=55,
+                     interval=MIN_SLEEP, bulk_sockets=None, sink=None):
+    """Pings every host from the running event loop and yields a PingResult
+    per echo as soon as it is answered or times out (delay is None then).
+
+    One non-blocking raw socket per address family is registered with the
+    loop, sends are scheduled with loop timers and each host is told apart
+    by its own ICMP identifier, so tens of thousands of hosts need neither
+    threads nor more than one socket per family. Probes due in the same
+    loop iteration are sent as one batch. Until a dual-stack host answers,
+    its echoes go to all of its addresses and the first family to reply is
+    kept. Without the privilege for raw sockets, unprivileged ping sockets
+    are used and replies are matched by their source address instead, so
+    there two hosts resolving to the same address cannot be told apart.
+    When a bulk_sockets list is given, the BulkSocket used for every family
+    is appended to it, so its syscall counters can be read afterwards.
+    Hosts that cannot be resolved are reported to the sink's messages, or
+    to stderr without a sink.
+    """
+    loop = asyncio.get_running_loop()
+
+    resolved = await asyncio.gather(
+        *[loop.run_in_executor(None, resolve, host) for host in hosts],
+        return_exceptions=True)
+    targets = {}
+    identifier = os.getpid() & 0xffff
+    for host, addresses in zip(hosts, resolved):
+        if isinstance(addresses, socket.gaierror):
+            text = "ping: cannot resolve {}: Unknown host".format(host)
+            if sink is not None:
+                sink.message(text)
+            else:
+                sys.stderr.write(text + "\n")
+            continue
+        if isinstance(addresses, BaseException):
+            raise addresses
+        if len(targets) > 0xffff:
+            raise ValueError("async_ping: at most 65536 hosts per call")
+        targets[identifier] = host, addresses
+        identifier = (identifier + 1) & 0xffff
+
+    sockets = {}
+    parsers = {}
+    datagram = {}
+    for family in {f for host, addresses in targets.values()
+                   for f, ip in addresses}:
+        try:
+            try:
+                bulk_socket = open_icmp_socket(family)
+                datagram[family] = False
+            except PermissionError:
+                bulk_socket = open_icmp_socket(family, datagram=True)
+                datagram[family] = True
+            parsers[family] = (DATAGRAM_ECHO_REPLY_PARSER[family]
+                               if datagram[family] else
+                               ECHO_REPLY_PARSER[family])
+        except socket.error:
+            if family == socket.AF_INET:
+                raise
+            continue  # no IPv6 here, dual-stack hosts fall back to IPv4
+        # replies of a whole sweep can arrive between two loop iterations
+        bulk_socket.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                      1 << 22)
+        sockets[family] = bulk_socket
+        if bulk_sockets is not None:
+            bulk_sockets.append(bulk_socket)
+    # a ping socket overwrites every identifier with its port, so its
+    # replies are told apart by the address they come from instead
+    by_address = {}
+    for identifier, (host, addresses) in targets.items():
+        addresses[:] = [(f, ip) for f, ip in addresses if f in sockets]
+        for family, ip in addresses:
+            if datagram[family]:
+                by_address.setdefault(ip, identifier)
+
+    packet_builders = {
+        family: EchoPacketBuilder(identifier,
+                                  packet_size,
+                                  icmp_type=ECHO_REQUEST[family])
+        for family in sockets
+    }
+    results = asyncio.Queue()
+    pending = {}
+    next_sends = {}
+    outbox = collections.deque()
+
+    def expire(key):
+        send_time, timeout_handle = pending.pop(key)
+        host, addresses = targets[key[0]]
+        ip = addresses[0][1] if addresses else None
+        results.put_nowait(
+            PingResult(host, ip, key[1], 0, 0, None, None, time.time()))
+
+    def send(identifier, seq_no):
+        if seq_no + 1 < count:
+            next_sends[identifier] = loop.call_later(interval / 1000, send,
+                                                     identifier, seq_no + 1)
+        else:
+            del next_sends[identifier]
+
+        # every probe due in this loop iteration goes out in one batch
+        if not outbox:
+            loop.call_soon(flush)
+        outbox.append((identifier, seq_no & 0xffff))
+
+    def flush():
+        batches = {family: [] for family in sockets}
+        for identifier, seq_no in outbox:
+            # a dual-stack host is raced on every family until one answers
+            for family, ip in targets[identifier][1]:
+                packet = packet_builders[family].build(seq_no, identifier)
+                batches[family].append((packet, (ip, 0)))
 
+        send_time = timer()
+        for family, batch in batches.items():
+            try:
+                sockets[family].send_batch(batch)
+            except OSError:
+                pass
+        # whatever could not be sent is reported lost by its timeout
+        for key in outbox:
+            pending[key] = send_time, loop.call_later(timeout / 1000, expire,
+                                                      key)
+        outbox.clear()
+
+    def on_readable(family):
+        packets = sockets[family].drain()
+        receive_time = timer()
+        parse_reply = parsers[family]
+
+        for packet_data, address, ancdata in packets:
+            reply = parse_reply(packet_data, ancdata)
+            if reply is None:
+                continue
+
+            identifier, seq_no, ttl, data_len = reply
+            identifier = by_address.get(address[0], identifier)
+            entry = pending.pop((identifier, seq_no), None)
+            if entry is None:  # late, duplicated or someone else's reply
+                continue
+
+            send_time, timeout_handle = entry
+            timeout_handle.cancel()
+            host, addresses = targets[identifier]
+            if len(addresses) > 1:  # this family won the race
+                addresses[:] = [(f, ip) for f, ip in addresses if f == family]
+            ip = addresses[0][1]
+            delay = (receive_time - send_time) * 1000.00
+            results.put_nowait(
+                PingResult(host, ip, seq_no, ttl, data_len, address[0],
+                           delay, time.time()))
 
-def ping(destination_server, timeout=1000, count=1000, packet_size=55):
+    for family, bulk_socket in sockets.items():
+        loop.add_reader(bulk_socket.fileno(), on_readable, family)
+    try:
+        # spread the first probes over one interval instead of a burst
+        for index, identifier in enumerate(targets):
+            next_sends[identifier] = loop.call_later(
+                interval / 1000 * index / len(targets), send, identifier, 0)
 
+        for _ in range(len(targets) * count):
+            yield await results.get()
+    finally:
+        for bulk_socket in sockets.values():
+            loop.remove_reader(bulk_socket.fileno())
+            bulk_socket.socket.close()
+        for handle in next_sends.values():
+            handle.cancel()
+        for send_time, timeout_handle in pending.values():
+            timeout_handle.cancel()
+
+
+async def run_async_ping(destination_server, timeout=1000, count=1000,
+                         packet_size=55, interval=MIN_SLEEP, sink=None,
+                         io_statistics=False):
+    own_sink = sink is None
+    if own_sink:
+        sink = TextSink(sys.stdout)
+    sent = collections.Counter()
+    statistics = collections.defaultdict(RttStatistics)
+    bulk_sockets = []
+    try:
+        async for result in async_ping(destination_server, timeout, count,
+                                       packet_size, interval, bulk_sockets,
+                                       sink):
+            sent[result.host] += 1
+            if result.delay is not None:
+                statistics[result.host].add(result.delay)
+            sink.write(result)
+    except socket.error as err:
+        print_socket_error(err)
+        if own_sink:
+            sink.close()
+        return
+
+    for host in destination_server:
+        if sent[host]:
+            sink.message("\n--- {} ping statistics ---".format(host))
+            sink.message("{} packets transmitted, {} packets received".format(
+                sent[host], statistics[host].count))
+            print_statistics(statistics[host], sink)
+
+    if len(sent) > 1:
+        print_fleet_statistics(sum(sent.values()), statistics.values(), sink)
+    if io_statistics:
+        for bulk_socket in bulk_sockets:
+            sink.message("io: " + bulk_socket.describe())
+    if own_sink:
+        sink.close()
+    else:
+        sink.flush()
+
+
+def print_fleet_statistics(sent_packets, statistics, sink):
+    fleet = RttStatistics()
+    for host_statistics in statistics:
+        fleet.merge(host_statistics)
+
+    sink.message("\n--- fleet ping statistics ---")
+    sink.message("{} packets transmitted, {} packets received".format(
+        sent_packets, fleet.count))
+    print_statistics(fleet, sink)
+
+
+def ping(destination_server, timeout=1000, count=1000, packet_size=55,
+         interval=MIN_SLEEP, window=1, flood=False, sink=None,
+         io_statistics=False, adaptive=False, rto_min=RTO_MIN, rto_max=None):
+
+    own_sink = sink is None
+    if own_sink:
+        sink = TextSink(sys.stdout, flood)
     threads = []
     processes = []
     try:
         for host in destination_server:
-            p = Ping(host, count, timeout, packet_size)
+            p = Ping(host, count, timeout, packet_size, interval, window,
+                     flood, sink, adaptive, rto_min, rto_max)
             processes.append(p)
 
             t = threading.Thread(target=p.start_ping, daemon=True)
@@ -313,13 +1157,24 @@ def ping(destination_server, timeout=1000, count=1000, packet_size=55):
         for thread in threads:
             thread.start()
 
-        while is_any_thread_alive(threads):
-            time.sleep(0)
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
     except KeyboardInterrupt:
         pass
     finally:
         for process in processes:
             process.print_exit()
+        if len(processes) > 1:
+            print_fleet_statistics(sum(p.sent_packets for p in processes),
+                                   [p.statistics for p in processes], sink)
+        for dispatcher in dispatchers.values():
+            if io_statistics and dispatcher.opened:
+                sink.message("io: " + dispatcher.describe())
+        if own_sink:
+            sink.close()
+        else:
+            sink.flush()
 
 
 if __name__ == '__main__':
@@ -329,4 +1184,25 @@ if __name__ == '__main__':
     timeout = args.timeout
     packet_size = args.packet_size
     count = args.count
-    ping(destination_server, timeout, count, packet_size)
\ No newline at end of file
+    flood = args.flood
+    interval = args.interval
+    if interval is None:
+        interval = 0.0 if flood else MIN_SLEEP
+    window = args.window
+    sink = create_sink(args.output_format, args.output_file, flood)
+    try:
+        if args.asyncio:
+            asyncio.run(
+                run_async_ping(destination_server, timeout, count,
+                               packet_size, interval, sink,
+                               args.io_statistics))
+        else:
+            ping(destination_server, timeout, count, packet_size, interval,
+                 window, flood, sink, args.io_statistics, args.adaptive,
+                 args.rto_min, args.rto_max)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for dispatcher in dispatchers.values():
+            dispatcher.close()
+        sink.close()
\ No newline at end of file
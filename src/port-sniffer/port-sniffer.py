@@ -1,14 +1,32 @@
 import os
-import re
 import sys
 import time
+import array
+import queue
+import errno
+import heapq
 import socket
+import struct
+import hashlib
 import datetime
 import argparse
+import functools
+import ipaddress
+import selectors
+import itertools
 import termcolor
 import threading
-import concurrent.futures
+import collections
 
+try:
+    import resource
+except ImportError:  # not on Windows, where the selector caps the sockets instead
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.pacing import TokenBucket
+from common.packets import calculate_checksum, source_address
+from common.sockets import BulkSocket
 
 parser = argparse.ArgumentParser(
     description="Check if hosts are up.",
@@ -26,29 +44,47 @@ parser.add_argument(
 parser.add_argument(
     "-r",
     "--retry",
-    help="The retry count when a connection fails (default 3)",
+    help="The retry count when a connection or UDP probe fails (default 3)",
     default=3,
     type=int,
 )
 parser.add_argument(
     "-d",
     "--delay",
-    help="The retry delay in seconds when a connection fails (default 10)",
+    help="The retry delay in seconds when a connection or UDP probe fails (default 10)",
     default=10,
     type=int,
 )
 parser.add_argument(
     "-t",
     "--timeout",
-    help="The connection timeout in seconds (default 3)",
+    help="The connection or UDP reply timeout in seconds (default 3)",
     default=3,
     type=int,
 )
 parser.add_argument(
-    "-s", "--start", help="The range ips that start from 0", default=0, type=int
+    "-s", "--start", help="The lowest port to scan (default 1)", default=1, type=int
 )
 parser.add_argument(
-    "-e", "--end", help="The range ips that end from 65353", default=65353, type=int
+    "-e",
+    "--end",
+    help="The highest port to scan (default 65535)",
+    default=65535,
+    type=int,
+)
+parser.add_argument(
+    "-p",
+    "--ports",
+    help="The ports to scan, like '22,80,8000-8100' (default the ports list)",
+    default=None,
+    type=str,
+)
+parser.add_argument(
+    "-T",
+    "--top-ports",
+    help="Scan the N tcp or udp ports that are open most often, up to 100 tcp and 50 udp",
+    default=None,
+    type=int,
 )
 parser.add_argument(
     "-H",
@@ -67,21 +103,49 @@ parser.add_argument(
 parser.add_argument(
     "-z",
     "--thread",
-    help="The needed threads (default 5)",
+    help="Unused, every port is scanned by an event loop (default 5)",
     default=5,
     type=int,
 )
 parser.add_argument(
     "-x",
     "--allport",
-    help="Scan all port(default 0)",
+    help="Scan all ports (default 0)",
     default=0,
     type=int,
 )
 parser.add_argument(
     "-n",
     "--run",
-    help="Run in all thread(default 0)",
+    help="Unused, every port is scanned by an event loop (default 0)",
+    default=0,
+    type=int,
+)
+parser.add_argument(
+    "-m",
+    "--max-inflight",
+    help="The TCP connects in flight at once (default 4096, capped by the open file limit)",
+    default=4096,
+    type=int,
+)
+parser.add_argument(
+    "-P",
+    "--per-host",
+    help="The TCP connects in flight to one host at once (default 1024)",
+    default=1024,
+    type=int,
+)
+parser.add_argument(
+    "-u",
+    "--udp-rate",
+    help="The UDP probes per second to one host (default the kernel's ICMP error ratelimit)",
+    default=None,
+    type=float,
+)
+parser.add_argument(
+    "-S",
+    "--syn",
+    help="Scan IPv4 TCP ports with stateless SYNs at this many packets per second, as root (default 0, connect)",
     default=0,
     type=int,
 )
@@ -118,6 +182,206 @@ connection_type = args.connection
 thread = args.thread
 allport = args.allport == 1
 run = args.run == 1
+max_inflight = args.max_inflight
+per_host = args.per_host
+port_spec = args.ports
+top_ports = args.top_ports
+udp_rate = args.udp_rate
+syn_rate = args.syn
+
+# ranked by how often they are open, as nmap's port frequencies
+TOP_TCP_PORTS = [
+    80,
+    23,
+    443,
+    21,
+    22,
+    25,
+    3389,
+    110,
+    445,
+    139,
+    143,
+    53,
+    135,
+    3306,
+    8080,
+    1723,
+    111,
+    995,
+    993,
+    5900,
+    1025,
+    587,
+    8888,
+    199,
+    1720,
+    465,
+    548,
+    113,
+    81,
+    6001,
+    10000,
+    514,
+    5060,
+    179,
+    1026,
+    2000,
+    8443,
+    8000,
+    32768,
+    554,
+    26,
+    1433,
+    49152,
+    2001,
+    515,
+    8008,
+    49154,
+    1027,
+    5666,
+    646,
+    5000,
+    5631,
+    631,
+    49153,
+    8081,
+    2049,
+    88,
+    79,
+    5800,
+    106,
+    2121,
+    1110,
+    49155,
+    6000,
+    513,
+    990,
+    5357,
+    427,
+    49156,
+    543,
+    544,
+    5101,
+    144,
+    7,
+    389,
+    8009,
+    3128,
+    444,
+    9999,
+    5009,
+    7070,
+    5190,
+    3000,
+    5432,
+    1900,
+    3986,
+    13,
+    1029,
+    9,
+    5051,
+    6646,
+    49157,
+    1028,
+    873,
+    1755,
+    2717,
+    4899,
+    9100,
+    119,
+    37,
+]
+TOP_UDP_PORTS = [
+    631,
+    161,
+    137,
+    123,
+    138,
+    1434,
+    445,
+    135,
+    67,
+    53,
+    139,
+    500,
+    68,
+    520,
+    1900,
+    4500,
+    514,
+    49152,
+    162,
+    69,
+    5353,
+    111,
+    49154,
+    1701,
+    998,
+    996,
+    997,
+    999,
+    3283,
+    49153,
+    1812,
+    136,
+    2222,
+    2049,
+    32768,
+    5060,
+    1025,
+    1433,
+    3456,
+    80,
+    20031,
+    1026,
+    7,
+    1646,
+    1645,
+    593,
+    518,
+    2048,
+    626,
+    1027,
+]
+
+OPEN = "open"
+CLOSED = "closed"
+FILTERED = "filtered"
+OPEN_FILTERED = "open|filtered"
+
+SO_EE_ORIGIN_ICMP = 2
+SO_EE_ORIGIN_ICMP6 = 3
+IP_RECVERR = getattr(socket, "IP_RECVERR", 11)
+IPV6_RECVERR = getattr(socket, "IPV6_RECVERR", 25)
+ICMP_BURST = 6  # XRLIM_BURST_FACTOR, the burst of the ratelimit of Linux
+UDP_BATCH = 64
+UDP_REPLY_SIZE = 512  # only the source of a reply is looked at
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+SO_RCVBUFFORCE = getattr(socket, "SO_RCVBUFFORCE", 33)
+SYN_BUFFER = 32 * 1024 * 1024
+UDP_BUFFER = 4 * 1024 * 1024  # capped by net.core.rmem_max
+
+# what a service answers, where it ignores an empty datagram
+UDP_PAYLOADS = {
+    # DNS, a query for the NS records of the root
+    53: struct.pack("!6H", 0x5350, 0x0100, 1, 0, 0, 0) + b"\x00\x00\x02\x00\x01",
+    # NTP, a version 4 client request
+    123: b"\xe3" + bytes(47),
+    # NetBIOS name service, a node status request for *
+    137: struct.pack("!6H", 0x5350, 0, 1, 0, 0, 0)
+    + b"\x20CKAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA\x00\x00\x21\x00\x01",
+    # SNMP, a v1 get-request of sysDescr.0 with the community public
+    161: bytes.fromhex(
+        "302602010004067075626c6963a019020101020100020100300e300c06082b060102010101000500"
+    ),
+    # SSDP, a discovery of every service
+    1900: b"M-SEARCH * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\n"
+    b'MAN: "ssdp:discover"\r\nMX: 1\r\nST: ssdp:all\r\n\r\n',
+}
+UDP_PAYLOADS[5353] = UDP_PAYLOADS[53]  # multicast DNS
 
 
 def println(string, indent, color="white"):
@@ -140,152 +404,876 @@ def println(string, indent, color="white"):
     print()
 
 
-def tcpCheck(ip, port):
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.settimeout(timeout)
-    try:
-        s.connect((ip, int(port)))
-        s.shutdown(socket.SHUT_RDWR)
-        return True
-    except:
-        return False
-    finally:
-        s.close()
+def openFileLimit():
+    """Raises the soft limit of open files to the hard one and returns it,
+    or None where there is no such limit."""
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
 
 
-def udpCheck(ip, port):
-    cmd = "nc -vzu -w " + str(timeout) + " " + ip + " " + str(port) + " 2>&1"
-    res = os.popen("DATA=$(" + cmd + ");echo -n $DATA").read()
-    if res != "":
-        return True
+class ConnectScanner:
+    """Scans TCP ports with non-blocking connects multiplexed by a selector
+    (epoll on Linux), with at most `max_inflight` connects in flight and at
+    most `per_host` of them to one host.
+
+    A port is open when its connect completes and closed when it is
+    refused. A connect that times out or finds the host unreachable is
+    retried up to `retry` attempts in all, `delay` seconds later, on a
+    timer of the event loop; then the port is filtered. Open connections
+    are reset rather than closed, so a sweep leaves no TIME_WAIT sockets
+    behind."""
+
+    def __init__(self, timeout, retry=1, delay=0, max_inflight=4096, per_host=1024):
+        limit = openFileLimit()
+        if limit is not None:
+            max_inflight = min(
+                max_inflight, limit - 64
+            )  # leaves some for everything else
+        self.timeout = timeout
+        self.retry = max(1, retry)
+        self.delay = delay
+        self.max_inflight = max(1, max_inflight)
+        self.per_host = max(1, per_host)
+        self.selector = selectors.DefaultSelector()
+        self.timers = (
+            []
+        )  # heap of (due, counter, socket or None, target), stale once a connect is done
+        self.retries = 0
+        self.counter = itertools.count()
+        self.connecting = {}  # socket -> (ip, port, attempt)
+        self.host_connects = collections.Counter()
+        self.waiting = (
+            collections.OrderedDict()
+        )  # ip -> deque of (port, attempt) held back by the caps
+        self.held = 0
+
+    def scan(self, targets):
+        """Yields (ip, port, status) for every (ip, port) of an iterable, as
+        the results come in. Targets are taken from the iterable only as the
+        caps let them start."""
+        targets = iter(targets)
+        exhausted = False
+        try:
+            while True:
+                results = []
+                self.start_waiting(results)
+                while (
+                    not exhausted
+                    and len(self.connecting) < self.max_inflight
+                    and self.held < self.max_inflight
+                ):
+                    target = next(targets, None)
+                    if target is None:
+                        exhausted = True
+                        break
+                    self.admit(target[0], target[1], 1, results)
+
+                if (
+                    exhausted
+                    and not self.connecting
+                    and not self.retries
+                    and not self.held
+                ):
+                    yield from results
+                    return
+
+                if not results:
+                    wait = None
+                    if self.timers:
+                        wait = max(0.0, self.timers[0][0] - time.monotonic())
+                    for key, mask in self.selector.select(wait):
+                        sock = key.fileobj
+                        self.finish(
+                            sock,
+                            sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR),
+                            results,
+                        )
+                    self.fire_timers(results)
+                yield from results
+        finally:
+            self.close()
+
+    def close(self):
+        """Closes the connects still in flight, when the scan was cut short,
+        and the selector."""
+        for sock in self.connecting:
+            sock.close()
+        self.connecting.clear()
+        self.selector.close()
+
+    def admit(self, ip, port, attempt, results):
+        if (
+            ip not in self.waiting
+            and self.host_connects[ip] < self.per_host
+            and len(self.connecting) < self.max_inflight
+        ):
+            self.connect(ip, port, attempt, results)
+        else:
+            self.waiting.setdefault(ip, collections.deque()).append((port, attempt))
+            self.held += 1
+
+    def start_waiting(self, results):
+        for ip in list(self.waiting):
+            queue = self.waiting[ip]
+            while (
+                queue
+                and self.host_connects[ip] < self.per_host
+                and len(self.connecting) < self.max_inflight
+            ):
+                port, attempt = queue.popleft()
+                self.held -= 1
+                self.connect(ip, port, attempt, results)
+            if not queue:
+                del self.waiting[ip]
+            if len(self.connecting) >= self.max_inflight:
+                break
+
+    def connect(self, ip, port, attempt, results):
+        sock = socket.socket(
+            socket.AF_INET6 if ":" in ip else socket.AF_INET, socket.SOCK_STREAM
+        )
+        sock.setblocking(False)
+        self.connecting[sock] = ip, port, attempt
+        self.host_connects[ip] += 1
+        error = sock.connect_ex((ip, port))
+        if error in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.selector.register(sock, selectors.EVENT_WRITE)
+            heapq.heappush(
+                self.timers,
+                (time.monotonic() + self.timeout, next(self.counter), sock, None),
+            )
+        else:
+            self.finish(sock, error, results)
+
+    def finish(self, sock, error, results):
+        ip, port, attempt = self.connecting.pop(sock)
+        self.host_connects[ip] -= 1
+        if sock in self.selector.get_map():
+            self.selector.unregister(sock)
+        if error == 0:
+            # resets the connection instead of a FIN handshake
+            sock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0)
+            )
+        sock.close()
+
+        if error == 0:
+            results.append((ip, port, OPEN))
+        elif error == errno.ECONNREFUSED:
+            results.append((ip, port, CLOSED))
+        elif attempt < self.retry:
+            self.retries += 1
+            heapq.heappush(
+                self.timers,
+                (
+                    time.monotonic() + self.delay,
+                    next(self.counter),
+                    None,
+                    (ip, port, attempt + 1),
+                ),
+            )
+        else:
+            results.append((ip, port, FILTERED))
+
+    def fire_timers(self, results):
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            due, counter, sock, target = heapq.heappop(self.timers)
+            if sock is None:  # a retry
+                self.retries -= 1
+                self.admit(*target, results)
+            elif sock in self.connecting:  # a connect timing out
+                self.finish(sock, errno.ETIMEDOUT, results)
+
+
+def icmpRateLimit(family):
+    """Returns the ICMP errors per second a Linux host sends to one peer,
+    from the icmp_ratelimit (in ms) and icmp_msgs_per_sec of this kernel,
+    or None when they are off. The targets are taken to be configured
+    alike, where there is no /proc the Linux defaults are used."""
+    if family == socket.AF_INET6:
+        paths = (
+            "/proc/sys/net/ipv6/icmp/ratelimit",
+            "/proc/sys/net/ipv4/icmp_msgs_per_sec",
+        )
     else:
-        return False
+        paths = (
+            "/proc/sys/net/ipv4/icmp_ratelimit",
+            "/proc/sys/net/ipv4/icmp_msgs_per_sec",
+        )
+    try:
+        values = []
+        for path in paths:
+            with open(path) as f:
+                values.append(int(f.read()))
+        interval, per_second = values
+    except (OSError, ValueError):
+        interval, per_second = 1000, 1000
+    rates = []
+    if interval > 0:
+        rates.append(1000.0 / interval)
+    if per_second > 0:
+        rates.append(float(per_second))
+    return min(rates) if rates else None
+
+
+class UdpScanner:
+    """Scans UDP ports with one unconnected socket per address family,
+    sending the payload of UDP_PAYLOADS that the service of a port answers,
+    or an empty datagram.
+
+    A port is open when it answers. With IP_RECVERR (Linux), the ICMP
+    errors for the probes are read from the error queue of the socket,
+    whose messages name the destination of the probe: port unreachable
+    makes the port closed, any other destination unreachable filtered. A
+    port that stays silent is probed again up to `retry` attempts in all,
+    `delay` seconds later, then it is open|filtered. Elsewhere no errors
+    are read and silent ports are never closed.
 
+    Hosts ratelimit their ICMP errors, so a burst of probes to closed ports
+    would leave most of them silent. The probes to one host are paced at
+    `rate` per second with the burst of the Linux ratelimit, by default at
+    icmpRateLimit(); loopback addresses, which Linux does not ratelimit,
+    are not paced. Probes to different hosts interleave, at most
+    `max_inflight` of them are taken from the targets at once."""
 
-def checkHost(host):
-    ipup = False
-    color = "white"
-    for i in range(retry):
-        if host["conntype"] == "udp":
-            if udpCheck(host["ip"], host["port"]):
-                ipup = True
+    def __init__(self, timeout, retry=1, delay=0, rate=None, max_inflight=4096):
+        self.timeout = timeout
+        self.retry = max(1, retry)
+        self.delay = delay
+        self.rate = rate
+        self.max_inflight = max(1, max_inflight)
+        self.recverr = sys.platform.startswith("linux")
+        self.selector = selectors.DefaultSelector()
+        self.sockets = {}  # family -> socket
+        self.buckets = {}  # ip -> TokenBucket, or None when not paced
+        self.timers = []  # heap of (due, counter, target, retry), stale once answered
+        self.retries = 0
+        self.counter = itertools.count()
+        self.probing = {}  # (ip, port) -> attempt
+        self.waiting = (
+            collections.OrderedDict()
+        )  # ip -> deque of (port, attempt) held back by the pacing
+        self.held = 0
+
+    def scan(self, targets):
+        """Yields (ip, port, status) for every (ip, port) of an iterable, as
+        the results come in."""
+        targets = iter(targets)
+        exhausted = False
+        try:
+            while True:
+                results = []
+                while not exhausted and self.held < self.max_inflight:
+                    target = next(targets, None)
+                    if target is None:
+                        exhausted = True
+                        break
+                    self.admit(target[0], target[1], 1)
+                wait = self.send_waiting(results)
+
+                if (
+                    exhausted
+                    and not self.probing
+                    and not self.retries
+                    and not self.held
+                ):
+                    yield from results
+                    return
+
+                if results:
+                    wait = 0
+                elif self.timers:
+                    due = max(0.0, self.timers[0][0] - time.monotonic())
+                    wait = due if wait is None else min(wait, due)
+                for key, mask in self.selector.select(wait):
+                    self.receive(key.fileobj, results)
+                self.fire_timers(results)
+                yield from results
+        finally:
+            self.close()
+
+    def close(self):
+        for bulk_socket in self.sockets.values():
+            self.selector.unregister(bulk_socket)
+            bulk_socket.socket.close()
+        self.sockets.clear()
+        self.selector.close()
+
+    def socket(self, family):
+        bulk_socket = self.sockets.get(family)
+        if bulk_socket is None:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            # the ICMP errors queue against the receive buffer too
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_BUFFER)
+            if self.recverr:
+                if family == socket.AF_INET6:
+                    sock.setsockopt(socket.IPPROTO_IPV6, IPV6_RECVERR, 1)
+                else:
+                    sock.setsockopt(socket.IPPROTO_IP, IP_RECVERR, 1)
+            # the replies of a batch of probes are read into one ring
+            bulk_socket = BulkSocket(sock, UDP_BATCH, UDP_REPLY_SIZE)
+            self.selector.register(bulk_socket, selectors.EVENT_READ)
+            self.sockets[family] = bulk_socket
+        return bulk_socket
+
+    def admit(self, ip, port, attempt):
+        if ip not in self.buckets:
+            family = socket.AF_INET6 if ":" in ip else socket.AF_INET
+            rate = self.rate if self.rate is not None else icmpRateLimit(family)
+            paced = rate and not ipaddress.ip_address(ip).is_loopback
+            self.buckets[ip] = TokenBucket(rate, ICMP_BURST) if paced else None
+        self.waiting.setdefault(ip, collections.deque()).append((port, attempt))
+        self.held += 1
+
+    def send_waiting(self, results):
+        """Sends the held probes that the pacing of their host allows, up to
+        UDP_BATCH of them so that the replies and errors are read before the
+        socket buffer overflows, and returns the seconds until the next one
+        may go, or None."""
+        wait = None
+        sent = 0
+        for ip in list(self.waiting):
+            queue = self.waiting[ip]
+            bucket = self.buckets[ip]
+            while queue:
+                if sent == UDP_BATCH:
+                    return 0.0
+                if bucket is not None:
+                    pause = bucket.delay()
+                    if pause:
+                        wait = pause if wait is None else min(wait, pause)
+                        break
+                    bucket.consume()
+                port, attempt = queue[0]
+                if not self.send(ip, port, attempt, results):
+                    return 0.0  # the socket buffer is full, read first
+                queue.popleft()
+                self.held -= 1
+                sent += 1
+            if not queue:
+                del self.waiting[ip]
+        return wait
+
+    def send(self, ip, port, attempt, results):
+        """Sends one probe and returns False when the socket would block."""
+        bulk_socket = self.socket(socket.AF_INET6 if ":" in ip else socket.AF_INET)
+        payload = UDP_PAYLOADS.get(port, b"")
+        for tries in range(2):
+            try:
+                bulk_socket.sendto(payload, (ip, port))
                 break
-            else:
-                println(
-                    "No response from "
-                    + host["ip"]
-                    + ":"
-                    + str(host["port"])
-                    + ":"
-                    + host["conntype"]
-                    + ", retrying in "
-                    + str(delay)
-                    + "s...",
-                    0,
-                    color,
+            except (BlockingIOError, InterruptedError):
+                return False
+            except OSError:
+                # an ICMP error pending on the socket fails one send, so only
+                # a second failure is about this destination
+                if tries:
+                    results.append((ip, port, FILTERED))
+                    return True
+        self.probing[ip, port] = attempt
+        heapq.heappush(
+            self.timers,
+            (time.monotonic() + self.timeout, next(self.counter), (ip, port), False),
+        )
+        return True
+
+    def receive(self, bulk_socket, results):
+        while True:
+            try:
+                replies = bulk_socket.drain()
+            except OSError:  # a pending ICMP error, read from the error queue
+                continue
+            for data, address, ancdata in replies:
+                self.answer(address[0], address[1], OPEN, results)
+            if not replies:
+                break
+
+        while self.recverr:
+            try:
+                data, ancdata, flags, address = bulk_socket.socket.recvmsg(
+                    0, 512, socket.MSG_ERRQUEUE | socket.MSG_DONTWAIT
                 )
-                time.sleep(delay)
-        else:
-            if tcpCheck(host["ip"], host["port"]):
-                ipup = True
+            except BlockingIOError:
                 break
-            else:
-                println(
-                    "No response from "
-                    + host["ip"]
-                    + ":"
-                    + str(host["port"])
-                    + ":"
-                    + host["conntype"]
-                    + ", retrying in "
-                    + str(delay)
-                    + "s...",
-                    0,
-                    color,
+            for level, kind, cmsg in ancdata:
+                if (level, kind) in (
+                    (socket.IPPROTO_IP, IP_RECVERR),
+                    (socket.IPPROTO_IPV6, IPV6_RECVERR),
+                ):
+                    ee_errno, origin, icmp_type, code = struct.unpack_from(
+                        "=IBBB", cmsg
+                    )
+                    status = self.classify(origin, icmp_type, code)
+                    if status is not None:
+                        self.answer(address[0], address[1], status, results)
+
+    @staticmethod
+    def classify(origin, icmp_type, code):
+        """Returns the status a port has by an ICMP error for a probe to it,
+        or None when the error does not tell it."""
+        if origin == SO_EE_ORIGIN_ICMP and icmp_type == 3:  # destination unreachable
+            return CLOSED if code == 3 else FILTERED
+        if origin == SO_EE_ORIGIN_ICMP6 and icmp_type == 1:
+            return CLOSED if code == 4 else FILTERED
+        return None
+
+    def answer(self, ip, port, status, results):
+        if self.probing.pop((ip, port), None) is not None:
+            results.append((ip, port, status))
+
+    def fire_timers(self, results):
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            due, counter, target, retry = heapq.heappop(self.timers)
+            if retry:
+                self.retries -= 1
+                self.admit(*target)
+                continue
+            attempt = self.probing.get(target)
+            if attempt is None:  # answered
+                continue
+            del self.probing[target]
+            if attempt < self.retry:
+                self.retries += 1
+                heapq.heappush(
+                    self.timers,
+                    (
+                        now + self.delay,
+                        next(self.counter),
+                        target + (attempt + 1,),
+                        True,
+                    ),
                 )
-                time.sleep(delay)
-    return ipup
+            else:
+                results.append(target + (OPEN_FILTERED,))
 
 
-def parseHost(host):
-    prestatus = host["status"]
-    color = "magenta"
-    println(
-        "Checking "
-        + host["ip"]
-        + ":"
-        + str(host["port"])
-        + ":"
-        + host["conntype"]
-        + "...",
-        0,
-        color,
-    )
+@functools.lru_cache(maxsize=4096)
+def sourceAddress(ip):
+    """The local address the kernel sends to ip from, looked up once per
+    target of a scan."""
+    return source_address(socket.AF_INET, ip)
+
+
+class SynScanner:
+    """Scans IPv4 TCP ports statelessly, like masscan: SYNs crafted on a raw
+    socket go out at `rate` packets per second, and a receiver thread reads
+    every incoming TCP segment from another raw socket. Needs root.
+
+    The sequence number of a SYN is a cookie, a keyed hash of the target
+    under a key drawn for the scan, so a reply is validated by its
+    acknowledgement number alone: SYN-ACK makes the port open and RST
+    closed. The kernel, which has no connection for the SYN-ACKs, resets
+    them. The source port is bound to a socket for the scan so the kernel
+    hands it to nothing else.
+
+    Targets are taken `window` at a time, which bounds the state of a scan.
+    The ports of a window that have not answered are probed again up to
+    `retry` attempts in all, at least `timeout` seconds apart, and replies
+    are awaited `timeout` seconds after the last SYN; then the ports that
+    never answered are filtered. Replies that come later are dropped."""
+
+    def __init__(self, rate, timeout, retry=1, window=65536):
+        self.rate = max(1, rate)
+        self.timeout = timeout
+        self.retry = max(1, retry)
+        self.window = max(1, window)
+        self.key = os.urandom(16)
+        self.results = queue.SimpleQueue()
+        self.stopped = threading.Event()
+        self.sport = None
+        self.sent = 0
+
+    def cookie(self, ip, port):
+        """The sequence number of the SYN to ip:port."""
+        digest = hashlib.blake2b(
+            socket.inet_aton(ip) + struct.pack("!HH", port, self.sport),
+            key=self.key,
+            digest_size=4,
+        ).digest()
+        return int.from_bytes(digest, "big")
+
+    def syn(self, ip, port):
+        tcp = struct.pack(
+            "!HHIIBBHHH4s",
+            self.sport,
+            port,
+            self.cookie(ip, port),
+            0,
+            6 << 4,  # a data offset of 6 words, for the MSS option
+            TCP_SYN,
+            1024,
+            0,
+            0,
+            b"\x02\x04\x05\xb4",
+        )
+        pseudo = struct.pack(
+            "!4s4sBBH",
+            socket.inet_aton(sourceAddress(ip)),
+            socket.inet_aton(ip),
+            0,
+            socket.IPPROTO_TCP,
+            len(tcp),
+        )
+        return tcp[:16] + struct.pack("!H", calculate_checksum(pseudo + tcp)) + tcp[18:]
+
+    def scan(self, targets):
+        """Yields (ip, port, status) for every (ip, port) of an iterable, as
+        the results come in."""
+        reserved = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_TCP)
+        listener = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_TCP)
+        # the receiver falls behind bursts of replies, the buffer takes them
+        listener.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, SYN_BUFFER)
+        reserved.bind(("", 0))
+        self.sport = reserved.getsockname()[1]
+        self.stopped.clear()
+        receiver = threading.Thread(target=self.receive, args=(listener,), daemon=True)
+        receiver.start()
+
+        bucket = TokenBucket(self.rate, max(1, self.rate / 100))
+        targets = iter(targets)
+        try:
+            while True:
+                window = list(itertools.islice(targets, self.window))
+                if not window:
+                    break
+                pending = set(window)
+                last = None
+                for attempt in range(self.retry):
+                    if last is not None:
+                        yield from self.collect(pending, last + self.timeout)
+                    last = time.monotonic()
+                    for ip, port in window:
+                        if (ip, port) not in pending:
+                            continue
+                        pause = bucket.delay()
+                        if pause:
+                            yield from self.collect(pending)
+                            time.sleep(pause)
+                            bucket.delay()
+                        bucket.consume()
+                        sender.sendto(self.syn(ip, port), (ip, 0))
+                        self.sent += 1
+                    yield from self.collect(pending)
+                yield from self.collect(pending, time.monotonic() + self.timeout)
+                for ip, port in window:
+                    if (ip, port) in pending:
+                        yield ip, port, FILTERED
+        finally:
+            self.stopped.set()
+            receiver.join()
+            for sock in (reserved, sender, listener):
+                sock.close()
+
+    def collect(self, pending, until=None):
+        """Yields the results that came in for the pending targets, the first
+        answer of each, waiting for more until the monotonic time `until` or
+        until none is pending."""
+        while pending:
+            wait = None if until is None else until - time.monotonic()
+            try:
+                if wait is None or wait <= 0:
+                    ip, port, status = self.results.get_nowait()
+                else:
+                    ip, port, status = self.results.get(timeout=wait)
+            except queue.Empty:
+                if wait is None or wait <= 0:
+                    return
+                continue
+            if (ip, port) in pending:
+                pending.discard((ip, port))
+                yield ip, port, status
+
+    def receive(self, sock):
+        sock.settimeout(0.1)
+        while not self.stopped.is_set():
+            try:
+                packet = sock.recv(65535)
+            except socket.timeout:
+                continue
+            ihl = (packet[0] & 0x0F) * 4
+            if len(packet) < ihl + 20:
+                continue
+            sport, dport, seq, ack, offset, flags = struct.unpack_from(
+                "!HHIIBB", packet, ihl
+            )
+            if dport != self.sport or not flags & TCP_ACK:
+                continue
+            ip = socket.inet_ntoa(packet[12:16])
+            if ack != (self.cookie(ip, sport) + 1) & 0xFFFFFFFF:
+                continue
+            if flags & TCP_RST:
+                self.results.put((ip, sport, CLOSED))
+            elif flags & TCP_SYN:
+                self.results.put((ip, sport, OPEN))
 
-    if checkHost(host):
-        host["status"] = "up"
-        color = "green"
+
+class PortList:
+    """Ports as a list of ranges, which are iterated without building the
+    ports. len() and iteration are all a ScanState and scanTargets need."""
+
+    def __init__(self, ranges):
+        self.ranges = [r for r in ranges if r]
+
+    @classmethod
+    def parse(cls, spec):
+        """The ports of an nmap-like spec such as '22,80,8000-8100', in
+        ascending order and each once. '-8000' starts from 1, '8000-' ends
+        at 65535 and '-' is every port."""
+        ranges = []
+        for part in spec.split(","):
+            part = part.strip()
+            low, dash, high = part.partition("-")
+            try:
+                low = int(low) if low or not dash else 1
+                high = (int(high) if high else 65535) if dash else low
+            except ValueError:
+                raise ValueError("invalid port spec '" + part + "'")
+            if not 1 <= low <= high <= 65535:
+                raise ValueError("invalid port range '" + part + "'")
+            ranges.append(range(low, high + 1))
+
+        merged = []
+        for r in sorted(ranges, key=lambda r: r.start):
+            if merged and r.start <= merged[-1].stop:
+                merged[-1] = range(merged[-1].start, max(merged[-1].stop, r.stop))
+            else:
+                merged.append(r)
+        return cls(merged)
+
+    @classmethod
+    def top(cls, ranked, count):
+        """The first `count` ports of a list ranked by how often they are
+        open. There are at most as many as the list has."""
+        return cls(range(port, port + 1) for port in ranked[:count])
+
+    def between(self, low, high):
+        """The ports from low to high, both included."""
+        return PortList(
+            range(max(r.start, low), min(r.stop, high + 1)) for r in self.ranges
+        )
+
+    def __len__(self):
+        return sum(len(r) for r in self.ranges)
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.ranges)
+
+
+class ScanState:
+    """The results of scanning `ports` on many hosts, in an open and a
+    closed bitmap per host with a bit for every position in `ports`. A
+    port in neither answered nothing, it is filtered. Bitmaps are made on
+    the first open or closed port of a host, so hosts that never answer
+    cost nothing, and a snapshot is a copy of the bitmaps."""
+
+    def __init__(self, ports):
+        self.ports = ports
+        self.size = (len(ports) + 7) // 8
+        self.position = array.array("i", [-1]) * 65536
+        for i, port in enumerate(ports):
+            self.position[port] = i
+        self.hosts = {}  # ip -> (open bitmap, closed bitmap)
+
+    def set(self, ip, port, status):
+        bitmaps = self.hosts.get(ip)
+        if bitmaps is None:
+            if status not in (OPEN, CLOSED):
+                return
+            bitmaps = self.hosts[ip] = bytearray(self.size), bytearray(self.size)
+        i = self.position[port]
+        byte, bit = i >> 3, 1 << (i & 7)
+        for bitmap, value in zip(bitmaps, (OPEN, CLOSED)):
+            if status == value:
+                bitmap[byte] |= bit
+            else:
+                bitmap[byte] &= ~bit
+
+    def status(self, ip, port):
+        bitmaps = self.hosts.get(ip)
+        if bitmaps is not None:
+            i = self.position[port]
+            for bitmap, value in zip(bitmaps, (OPEN, CLOSED)):
+                if bitmap[i >> 3] & 1 << (i & 7):
+                    return value
+        return FILTERED
+
+    def count(self, status):
+        """The number of ports that are open or closed."""
+        index = (OPEN, CLOSED).index(status)
+        return sum(
+            bin(int.from_bytes(bitmaps[index], "big")).count("1")
+            for bitmaps in self.hosts.values()
+        )
+
+    def clear(self):
+        self.hosts = {}
+
+    def snapshot(self):
+        """A copy of the state that the scan goes on without."""
+        state = ScanState.__new__(ScanState)
+        state.ports = self.ports
+        state.size = self.size
+        state.position = self.position
+        state.hosts = {
+            ip: (bytearray(opened), bytearray(closed))
+            for ip, (opened, closed) in self.hosts.items()
+        }
+        return state
+
+
+def splitHost(spec):
+    """Splits a '<server>:tcp' or '<server>:udp' host into the network of
+    the server and the connection type, which is --connection when the
+    host has none. The server is an address, a network like 10.0.0.0/24 or
+    a name, which is resolved to one address."""
+    server, conntype = spec, connection_type
+    if spec.rsplit(":", 1)[-1] in ("tcp", "udp"):
+        server, conntype = spec.rsplit(":", 1)
+    try:
+        network = ipaddress.ip_network(server, strict=False)
+    except ValueError:
+        network = ipaddress.ip_network(
+            socket.getaddrinfo(server, None, proto=socket.IPPROTO_TCP)[0][4][0]
+        )
+    return network, conntype
+
+
+def scanHosts(networks):
+    """Yields the address of every host of the networks, as a string."""
+    for network in networks:
+        if network.num_addresses == 1:
+            addresses = [network.network_address]
+        else:
+            addresses = network.hosts()
+        for address in addresses:
+            yield str(address)
+
+
+def scanTargets(networks, port_list):
+    """Yields (ip, port) for every port of port_list on every host of the
+    networks, without building them up front. Targets go port by port
+    across all the hosts, so the window of a scanner spreads over every
+    host and the caps and pacing per host do not make the scan serial."""
+    for port in port_list:
+        for ip in scanHosts(networks):
+            yield ip, port
+
+
+def scanPorts(networks, port_list, conntype, state):
+    """Scans port_list on the hosts of the networks at once, with a
+    ConnectScanner for tcp, a SynScanner for tcp with --syn or a UdpScanner
+    for udp, into the ScanState of the last check. Prints the ports that
+    are up, or that went down since the last check."""
+    if conntype == "udp":
+        scanner = UdpScanner(timeout, retry, delay, udp_rate, max_inflight)
+    elif syn_rate and all(network.version == 4 for network in networks):
+        scanner = SynScanner(syn_rate, timeout, retry)
     else:
-        host["status"] = "down"
-        color = "red"
+        scanner = ConnectScanner(timeout, retry, delay, max_inflight, per_host)
+    previous = state.snapshot()
+    state.clear()
+    started = time.time()
+    scanned = 0
+    for ip, port, status in scanner.scan(scanTargets(networks, port_list)):
+        scanned += 1
+        state.set(ip, port, status)
+        wasup = previous.status(ip, port) == OPEN
+        if status == OPEN or wasup:
+            println(
+                "Status of "
+                + ip
+                + ":"
+                + str(port)
+                + ":"
+                + conntype
+                + ": "
+                + ("up" if status == OPEN else "down")
+                + " ("
+                + status
+                + ")",
+                0,
+                "green" if status == OPEN else "red",
+            )
 
     println(
-        "Status of "
-        + host["ip"]
-        + ":"
-        + str(host["port"])
-        + ":"
-        + host["conntype"]
-        + ": "
-        + host["status"],
+        "Scanned "
+        + str(scanned)
+        + " "
+        + conntype
+        + " ports in "
+        + "{:.2f}".format(time.time() - started)
+        + "s, "
+        + str(state.count(OPEN))
+        + " up",
         0,
-        color,
+        "yellow",
     )
 
-    time.sleep(1)
+
+def portList(conntype):
+    """The ports to scan with conntype, from --start to --end: those of
+    --ports, the --top-ports ones, all of them with --allport, or else the
+    ports list."""
+    if port_spec is not None:
+        port_list = PortList.parse(port_spec)
+    elif top_ports is not None:
+        ranked = TOP_UDP_PORTS if conntype == "udp" else TOP_TCP_PORTS
+        if top_ports > len(ranked):
+            raise ValueError(
+                "argument -T/--top-ports: only "
+                + str(len(ranked))
+                + " "
+                + conntype
+                + " ports are ranked"
+            )
+        port_list = PortList.top(ranked, top_ports)
+    elif allport:
+        port_list = PortList([range(1, 65536)])
+    else:
+        port_list = PortList(range(port, port + 1) for port in ports)
+    return port_list.between(start, end)
 
 
 def run():
-    host_list = []
-    for ip in hosts:
-        if allport:
-            for i in range(65353):
-                host_list.append(
-                    {
-                        "ip": ip,
-                        "port": i,
-                        "conntype": connection_type,
-                        "status": "unknown",
-                    }
-                )
-        else:
-            for port in ports:
-                if port > start and port < end:
-                    host_list.append(
-                        {
-                            "ip": ip,
-                            "port": port,
-                            "conntype": connection_type,
-                            "status": "unknown",
-                        }
-                    )
+    if port_spec is not None and top_ports is not None:
+        parser.error("--ports and --top-ports exclude each other")
+    if top_ports is not None and top_ports < 1:
+        parser.error("argument -T/--top-ports: must be at least 1")
+    if start > end:
+        parser.error("argument -s/--start: must not be above -e/--end")
+    networks = {"tcp": [], "udp": []}
+    for spec in hosts:
+        network, conntype = splitHost(spec)
+        networks["udp" if conntype == "udp" else "tcp"].append(network)
+    try:
+        port_lists = {
+            conntype: portList(conntype) for conntype in networks if networks[conntype]
+        }
+    except ValueError as e:
+        parser.error(str(e))
+    states = {conntype: ScanState(port_lists[conntype]) for conntype in port_lists}
 
     while True:
 
-        if run:
-            threads = []
-            for host in host_list:
-                t = threading.Thread(target=parseHost, args=(host,))
-                threads.append(t)
-            for thread in threads:
-                thread.start()
-            for thread in threads:
-                thread.join()
-
-            del threads[:]
-        else:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=thread) as executor:
-                executor.map(parseHost, host_list)
+        for conntype in ("tcp", "udp"):
+            if networks[conntype]:
+                scanPorts(
+                    networks[conntype],
+                    port_lists[conntype],
+                    conntype,
+                    states[conntype],
+                )
 
         println("Waiting " + str(interval) + " minutes for next check.", 0, "yellow")
 
@@ -1,263 +1,1751 @@
+import math
+import random
 import socket
 import struct
+import array
 import os
 import time
 import sys
 import select
 import argparse
+import ipaddress
+import threading
+import itertools
+import collections
+import concurrent.futures
+
+try:
+    import numpy
+except ImportError:  # hop statistics fall back to a Python loop
+    numpy = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.packets import (ICMP_HEADER, TCP_HEADER, UDP_HEADER, EchoPacketBuilder, calculate_checksum,
+                            fold_checksum, parse_icmp, parse_ipv4, parse_tcp, resolve, source_address,
+                            update_checksum)
+from common import sinks
+from common.pacing import RTO_MIN, RtoEstimator, TokenBucket
+from common.sinks import FORMATS, ResultSink, address_to_bytes, bytes_to_address
+from common.sockets import BulkSocket
 
 ICMP_ECHO = 8
 ICMP_ECHO_REPLY = 0
+ICMP_DEST_UNREACHABLE = 3
 ICMP_TIME_EXCEEDED = 11
-MIN_SLEEP = 1000
-
-timer = time.time
-
-
-def calculate_checksum(packet):
-    countTo = (len(packet) // 2) * 2
-
-    count = 0
-    sum = 0
-
-    while count < countTo:
-        if sys.byteorder == "little":
-            loByte = packet[count]
-            hiByte = packet[count + 1]
+ICMPV6_DEST_UNREACHABLE = 1
+ICMPV6_TIME_EXCEEDED = 3
+ICMPV6_ECHO_REQUEST = 128
+ICMPV6_ECHO_REPLY = 129
+ICMPV6_FILTER = 1  # <linux/icmpv6.h>, not exported by the socket module
+ICMP_FILTER = 1  # <linux/icmp.h>, at the SOL_RAW level
+SOL_RAW = 255
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+TCP_RESPONSE = 0x100  # ProbeReply type of a SYN-ACK or RST, beyond any ICMP type
+UDP_PORT = 33434
+TCP_PORT = 80
+PROTOCOLS = {
+    "icmp": socket.IPPROTO_ICMP,
+    "udp": socket.IPPROTO_UDP,
+    "tcp": socket.IPPROTO_TCP,
+}
+IPV6_HEADER_LENGTH = 40
+DOUBLETREE_TTL = 3  # batch traces start here, past the hops shared by nearly every path
+BATCH_PPS = 1000
+BATCH_JOBS = 64
+PATH_WINDOW = 8  # TTLs probed at once by a path monitor's full trace
+MONITOR_INTERVAL = 300  # s between the cycles of a path monitor
+MONITOR_SAMPLE = 3  # hops a path monitor checks per destination and cycle, besides the last two
+NUMPY_MIN_BYTES = 4096
+
+timer = time.perf_counter
+
+HopResult = collections.namedtuple("HopResult", ["destination", "ttl", "probe", "ip", "hostname", "delay", "timestamp"])
+# timestamp, responder ip, ttl, probe, delay (ms)
+BINARY_RECORD = struct.Struct("!d16sBBf")
+# an edge of the multipath hop graph, ip and previous are None for a silent hop
+HopLink = collections.namedtuple("HopLink", ["destination", "ttl", "previous", "ip", "hostname", "flows"])
+# ttl, previous hop, responder ip, flows seen on the edge
+LINK_RECORD = struct.Struct("!B16s16sH")
+# a hop of a monitored path that changed, previous or ip is None where the path is shorter
+PathChange = collections.namedtuple("PathChange", ["destination", "ttl", "previous", "ip", "hops", "timestamp"])
+# timestamp, ttl, previous responder, responder, hop count of the new path
+CHANGE_RECORD = struct.Struct("!dB16s16sB")
+# the probes of one hop summed up, responders from the most to the least frequent
+HopStatistics = collections.namedtuple(
+    "HopStatistics",
+    ["destination", "ttl", "ip", "hostname", "responders", "sent", "received", "loss", "min", "avg", "max", "stddev",
+     "timestamp"])
+# timestamp, most frequent responder, ttl, sent, received, loss (%), min, avg, max and stddev (ms, NaN if none)
+STATISTICS_RECORD = struct.Struct("!d16sBIIfffff")
+# the last known path to a destination, the responder of each TTL from 1 or None
+KnownPath = collections.namedtuple("KnownPath", ["hops", "reached", "timestamp"])
+# name length, hop count, reached, timestamp; then the name and 16 bytes per hop
+PATH_RECORD = struct.Struct("!HB?d")
+
+
+def pseudo_header(family, source, destination, protocol, length):
+    if family == socket.AF_INET6:
+        return (socket.inet_pton(family, source) + socket.inet_pton(family, destination) +
+                struct.pack("!IxxxB", length, protocol))
+    return socket.inet_aton(source) + socket.inet_aton(destination) + struct.pack("!xBH", protocol, length)
+
+
+class UdpProbeBuilder:
+    """UDP probes to high ports, classic traceroute style. The source port
+    identifies the trace and, as in Paris traceroute, the checksum carries
+    the probe's sequence number: the first payload word is rewritten to
+    match it, so the ports, and the flow with them, stay the same. A flow
+    number moves the destination port up by as much."""
+
+    def __init__(self, family, source, destination, source_port, port, packet_size):
+        payload = bytes(max(packet_size, 2))
+        self.port = port
+        self.destination_port = port
+        self.packet = bytearray(UDP_HEADER.pack(source_port, port, UDP_HEADER.size + len(payload), 0) + payload)
+        self.checksum = calculate_checksum(
+            pseudo_header(family, source, destination, socket.IPPROTO_UDP, len(self.packet)) + self.packet)
+        struct.pack_into("!H", self.packet, 6, self.checksum)
+
+    def build(self, seq_no, flow=None):
+        destination_port = (self.port + (flow or 0)) & 0xffff
+        checksum = update_checksum(self.checksum, self.destination_port, destination_port)
+        # ~seq_no = ~checksum - word + new word, in one's complement
+        word, = struct.unpack_from("!H", self.packet, UDP_HEADER.size)
+        new_word = fold_checksum((~seq_no & 0xffff) + checksum + word)
+        struct.pack_into("!H", self.packet, UDP_HEADER.size, new_word)
+        struct.pack_into("!H", self.packet, 2, destination_port)
+        struct.pack_into("!H", self.packet, 6, seq_no)
+        self.destination_port = destination_port
+        self.checksum = seq_no
+
+        return bytes(self.packet)
+
+
+class TcpSynProbeBuilder:
+    """TCP SYN probes to one port, tcptraceroute style, which firewalls that
+    drop ICMP and UDP let through like any new connection. The source port
+    identifies the trace and the sequence number is the probe's."""
+
+    def __init__(self, family, source, destination, source_port, port, packet_size=0):
+        self.pseudo = pseudo_header(family, source, destination, socket.IPPROTO_TCP, TCP_HEADER.size)
+        self.source_port = source_port
+        self.port = port
+
+    def build(self, seq_no, flow=None):
+        header = bytearray(TCP_HEADER.pack(self.source_port, self.port, seq_no, 0, 5 << 4, TCP_SYN, 0xffff, 0, 0))
+        struct.pack_into("!H", header, 16, calculate_checksum(self.pseudo + header))
+        return bytes(header)
+
+
+PROBE_BUILDERS = {
+    socket.IPPROTO_UDP: UdpProbeBuilder,
+    socket.IPPROTO_TCP: TcpSynProbeBuilder,
+}
+
+
+class TextSink(ResultSink):
+    """The classic traceroute output: one line per hop, extended probe by
+    probe, with the hop's name printed again whenever the responder
+    changes."""
+
+    def __init__(self, stream, count_of_packets=3, max_ttl=10):
+        self.count_of_packets = min(count_of_packets, 0xff)  # as many as a hop is probed
+        self.max_ttl = max_ttl
+        self.prev_sender_hostname = ""
+        self.prev_link_ttl = None
+        super().__init__(stream)
+
+    def message(self, text):
+        self.write(text + "\n")
+
+    def encode(self, record):
+        if isinstance(record, str):
+            return record
+        if isinstance(record, HopLink):
+            return self.encode_link(record)
+        if isinstance(record, HopStatistics):
+            return self.encode_statistics(record)
+        if isinstance(record, PathChange):
+            return "{}: hop {} changed from {} to {}, {} hops\n".format(
+                record.destination, record.ttl, record.previous or "*", record.ip or "*", record.hops)
+
+        line = ""
+        if record.delay is None:
+            if record.probe == 1:
+                if record.ttl < self.max_ttl:
+                    line += " {}  ".format(record.ttl)
+                else:
+                    line += "{}  ".format(record.ttl)
+            line += "* "
+            if record.probe == self.count_of_packets:
+                line += "\n"
+            return line
+
+        if self.prev_sender_hostname != record.hostname:
+            if record.ttl < 10:
+                line += " {}  {} ({}) {:.3f}ms ".format(record.ttl, record.hostname, record.ip, record.delay)
+            else:
+                line += "{}  {} ({}) {:.3f}ms ".format(record.ttl, record.hostname, record.ip, record.delay)
+            self.prev_sender_hostname = record.hostname
         else:
-            loByte = packet[count + 1]
-            hiByte = packet[count]
-        sum = sum + (hiByte * 256 + loByte)
-        count += 2
-
-    if countTo < len(packet):
-        sum += packet[count]
-
-        # sum &= 0xffffffff
-
-    sum = (sum >> 16) + (sum & 0xffff)  # adding the higher order 16 bits and lower order 16 bits
-    sum += (sum >> 16)
-    answer = ~sum & 0xffff
-    answer = socket.htons(answer)
-
-    return answer
-
+            line += "{:.3f} ms ".format(record.delay)
 
-def is_valid_ip(hostname):
-    ip_parts = hostname.strip().split('.')
-    if len(ip_parts) != 4:
-        return False
+        if record.probe == self.count_of_packets:
+            line += "\n"
+            self.prev_sender_hostname = ""
+        return line
+
+    def encode_link(self, link):
+        """One line per edge of the hop graph, the TTL only on the first edge
+        of a hop."""
+        line = " {:>2}  ".format(link.ttl) if link.ttl != self.prev_link_ttl else "     "
+        self.prev_link_ttl = link.ttl
+        if link.ip is None:
+            line += "*"
+        else:
+            line += "{} ({})".format(link.hostname, link.ip)
+        if link.previous is not None:
+            line += "  <- {}".format(link.previous)
+        return line + "  [{} flows]\n".format(link.flows)
+
+    def encode_statistics(self, statistics):
+        """One mtr style line per hop, every other responder of the hop on
+        a line of its own below."""
+        if statistics.ip is None:
+            host = "*"
+        else:
+            host = "{} ({})".format(statistics.hostname, statistics.ip)
+        line = " {:>2}  {:<40} {:5.1f}% {:>5}".format(statistics.ttl, host, statistics.loss, statistics.sent)
+        if statistics.received:
+            line += " {:8.3f} {:8.3f} {:8.3f} {:8.3f}".format(statistics.min, statistics.avg, statistics.max,
+                                                              statistics.stddev)
+        line += "\n"
+        for ip in statistics.responders[1:]:
+            line += "     {}\n".format(ip)
+        return line
+
+
+def pack_binary_record(result):
+    if isinstance(result, HopStatistics):
+        delays = [math.nan if value is None else value for value in result[8:12]]
+        return STATISTICS_RECORD.pack(result.timestamp, address_to_bytes(result.ip), result.ttl, result.sent,
+                                      result.received, result.loss, *delays)
+    if isinstance(result, PathChange):
+        return CHANGE_RECORD.pack(result.timestamp, result.ttl, address_to_bytes(result.previous),
+                                  address_to_bytes(result.ip), min(result.hops, 0xff))
+    if isinstance(result, HopLink):
+        return LINK_RECORD.pack(result.ttl, address_to_bytes(result.previous), address_to_bytes(result.ip),
+                                min(result.flows, 0xffff))
+    delay = math.nan if result.delay is None else result.delay
+    return BINARY_RECORD.pack(result.timestamp, address_to_bytes(result.ip), result.ttl, min(result.probe, 0xff),
+                              delay)
+
+
+def create_sink(output_format="text", output_file=None, count_of_packets=3, max_ttl=10):
+    return sinks.create_sink(output_format, output_file, lambda stream: TextSink(stream, count_of_packets, max_ttl),
+                             pack_binary_record)
+
+
+class TraceBuffer:
+    """Holds the output of one trace of a batch until the trace is done, so
+    that the traces running at once are written one after the other, hop by
+    hop, whatever order their hops were probed in."""
+
+    def __init__(self):
+        self.messages = []
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+
+    def message(self, text):
+        self.messages.append(text)
+
+    def progress(self, text):
+        pass
+
+    def flush_to(self, sink):
+        for text in self.messages:
+            sink.message(text)
+        for record in sorted(self.records, key=lambda record: (record.ttl, getattr(record, "probe", 0))):
+            sink.write(record)
+
+
+# ports and TCP sequence number, all of a transport header an ICMP error has to quote
+QUOTED_PORTS = struct.Struct("!HHI")
+# builds reply records straight from unpack_from, skipping _make's checks
+_new_tuple = tuple.__new__
+
+
+class ProbeReply(
+        collections.namedtuple('ProbeReply', ['type', 'code', 'protocol', 'identifier', 'sequence'])):
+    """The ICMP type and code of a reply and what it tells about the probe
+    it answers: for ICMP probes the echo identifier and sequence number
+    (protocol is IPPROTO_ICMP for ICMPv6 too), for UDP probes the source
+    port and checksum, for TCP probes the source port and sequence number.
+    A SYN-ACK or RST has type TCP_RESPONSE and its flags as the code."""
+    __slots__ = ()
+
+
+def decode_reply(family, packet_data):
+    """Decodes an echo reply, or the probe quoted inside a Time Exceeded or
+    Destination Unreachable error, read from a raw ICMP socket of the given
+    family. The quoted IP header tells the probe's protocol; any packet that
+    cannot belong to a probe gives None."""
+    if family == socket.AF_INET6:
+        icmp_header = parse_icmp(packet_data, 0)
+        quoted_offset = ICMP_HEADER.size
+    else:
+        ip_header = parse_ipv4(packet_data)
+        if ip_header is None:
+            return None
+        icmp_header = parse_icmp(packet_data, ip_header.header_length)
+        quoted_offset = ip_header.header_length + ICMP_HEADER.size
+    if icmp_header is None:
+        return None
+
+    if icmp_header.type == ECHO_REPLY[family]:
+        return _new_tuple(ProbeReply, (icmp_header.type, icmp_header.code, socket.IPPROTO_ICMP,
+                                       icmp_header.identifier, icmp_header.sequence_number))
+    if icmp_header.type not in ERRORS[family]:
+        return None
+
+    if family == socket.AF_INET6:
+        # the next header of the quoted IPv6 header, extension headers are not followed
+        if len(packet_data) < quoted_offset + IPV6_HEADER_LENGTH:
+            return None
+        protocol = packet_data[quoted_offset + 6]
+        offset = quoted_offset + IPV6_HEADER_LENGTH
+    else:
+        quoted_ip_header = parse_ipv4(packet_data, quoted_offset)
+        if quoted_ip_header is None:
+            return None
+        protocol = quoted_ip_header.protocol
+        offset = quoted_offset + quoted_ip_header.header_length
+
+    if protocol == ECHO_PROTOCOL[family]:
+        quoted = parse_icmp(packet_data, offset)
+        if quoted is None or quoted.type != ECHO_REQUEST[family]:
+            return None
+        return _new_tuple(ProbeReply, (icmp_header.type, icmp_header.code, socket.IPPROTO_ICMP, quoted.identifier,
+                                       quoted.sequence_number))
+
+    if protocol not in (socket.IPPROTO_UDP, socket.IPPROTO_TCP) or len(packet_data) - offset < QUOTED_PORTS.size:
+        return None
+    source_port, destination_port, sequence_number = QUOTED_PORTS.unpack_from(packet_data, offset)
+    if protocol == socket.IPPROTO_UDP:  # length and checksum
+        return _new_tuple(ProbeReply, (icmp_header.type, icmp_header.code, protocol, source_port,
+                                       sequence_number & 0xffff))
+    return _new_tuple(ProbeReply, (icmp_header.type, icmp_header.code, protocol, source_port, sequence_number))
+
+
+def decode_tcp_reply(family, packet_data):
+    """Decodes the SYN-ACK or RST a destination answers a TCP probe with,
+    read from a raw TCP socket of the given family, into the ProbeReply of
+    the probe it acknowledges. Any other segment gives None."""
+    offset = 0
+    if family == socket.AF_INET:
+        ip_header = parse_ipv4(packet_data)
+        if ip_header is None:
+            return None
+        offset = ip_header.header_length
+    tcp_header = parse_tcp(packet_data, offset)
+    if tcp_header is None:
+        return None
+
+    flags = tcp_header.flags
+    if not flags & TCP_RST and flags & (TCP_SYN | TCP_ACK) != TCP_SYN | TCP_ACK:
+        return None
+    return _new_tuple(ProbeReply, (TCP_RESPONSE, flags, socket.IPPROTO_TCP, tcp_header.destination_port,
+                                   (tcp_header.acknowledgment_number - 1) & 0xffffffff))
+
+
+ECHO_REQUEST = {
+    socket.AF_INET: ICMP_ECHO,
+    socket.AF_INET6: ICMPV6_ECHO_REQUEST,
+}
+ECHO_REPLY = {
+    socket.AF_INET: ICMP_ECHO_REPLY,
+    socket.AF_INET6: ICMPV6_ECHO_REPLY,
+}
+TIME_EXCEEDED = {
+    socket.AF_INET: ICMP_TIME_EXCEEDED,
+    socket.AF_INET6: ICMPV6_TIME_EXCEEDED,
+}
+ERRORS = {
+    socket.AF_INET: (ICMP_DEST_UNREACHABLE, ICMP_TIME_EXCEEDED),
+    socket.AF_INET6: (ICMPV6_DEST_UNREACHABLE, ICMPV6_TIME_EXCEEDED),
+}
+ECHO_PROTOCOL = {
+    socket.AF_INET: socket.IPPROTO_ICMP,
+    socket.AF_INET6: socket.IPPROTO_ICMPV6,
+}
+
+
+def open_icmp_socket(family=socket.AF_INET):
+    # only wake up for the types a trace is made of, a set bit blocks a type
+    blocked = [0xffffffff] * 8
+    for icmp_type in (ECHO_REPLY[family],) + ERRORS[family]:
+        blocked[icmp_type >> 5] &= ~(1 << (icmp_type & 31))
+
+    if family == socket.AF_INET6:
+        icmp_socket = socket.socket(socket.AF_INET6, socket.SOCK_RAW, socket.IPPROTO_ICMPV6)
+        level, option, icmp_filter = socket.IPPROTO_ICMPV6, ICMPV6_FILTER, struct.pack("=8I", *blocked)
+    else:
+        icmp_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.getprotobyname("ICMP"))
+        level, option, icmp_filter = SOL_RAW, ICMP_FILTER, struct.pack("=I", blocked[0])
+    try:
+        icmp_socket.setsockopt(level, option, icmp_filter)
+    except OSError:
+        pass
+    return BulkSocket(icmp_socket)
+
+
+def open_probe_socket(family, protocol):
+    """A raw socket sending UDP or TCP probes. The ICMP errors they trigger
+    come in on the ICMP socket; the TCP one also reads SYN-ACKs and RSTs."""
+    probe_socket = socket.socket(family, socket.SOCK_RAW, protocol)
+    if protocol == socket.IPPROTO_UDP:
+        # never read, so keep the copies of every UDP datagram to a minimum
+        probe_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 0)
+    return BulkSocket(probe_socket)
+
+
+def hop_limit_message(family, ttl):
+    """Control message setting the TTL (hop limit) of a single packet, so
+    that traces sharing a socket never race on a socket option."""
+    if family == socket.AF_INET6:
+        return [(socket.IPPROTO_IPV6, socket.IPV6_HOPLIMIT, struct.pack("@i", ttl))]
+    return [(socket.IPPROTO_IP, socket.IP_TTL, struct.pack("@i", ttl))]
+
+
+class TraceDispatcher:
+    """One long-lived raw ICMP socket of an address family, shared by every
+    Traceroute of the process, plus raw UDP and TCP sockets once probes of
+    those protocols are sent. Each probe carries its TTL in a control
+    message, and a single receive loop decodes every reply and routes it to
+    the trace owning the probe, so hundreds of traces can run at once."""
+
+    def __init__(self, family=socket.AF_INET):
+        self.family = family
+        self.bulk_socket = None
+        self.probe_sockets = {}
+        self.receiver = None
+        self.waker = None
+        self.wakeup = None
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.next_identifier = os.getpid() & 0xffff
+
+    def open(self, protocol=socket.IPPROTO_ICMP):
+        with self.lock:
+            if self.bulk_socket is None:
+                self.bulk_socket = open_icmp_socket(self.family)
+                # the errors of a burst of traces arrive all at once
+                self.bulk_socket.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+                self.waker, self.wakeup = socket.socketpair()
+                self.wakeup.setblocking(False)
+                self.receiver = threading.Thread(target=self.receive_loop, args=(self.waker, self.wakeup),
+                                                 daemon=True)
+                self.receiver.start()
+            if protocol != socket.IPPROTO_ICMP and protocol not in self.probe_sockets:
+                self.probe_sockets[protocol] = open_probe_socket(self.family, protocol)
+                self.waker.send(b'\0')  # watch the TCP socket too
+
+    def close(self):
+        with self.lock:
+            bulk_sockets = list(self.probe_sockets.values())
+            if self.bulk_socket is not None:
+                bulk_sockets.append(self.bulk_socket)
+                self.waker.send(b'\0')
+            self.bulk_socket = None
+            self.probe_sockets = {}
+            # the receive loop closes the pair it was started with
+            self.waker = self.wakeup = None
+        for bulk_socket in bulk_sockets:
+            bulk_socket.socket.close()
+
+    def register(self, session, protocol=socket.IPPROTO_ICMP):
+        with self.lock:
+            identifier = self.next_identifier
+            while (protocol, identifier) in self.sessions:
+                identifier = (identifier + 1) & 0xffff
+            self.next_identifier = (identifier + 1) & 0xffff
+            self.sessions[protocol, identifier] = session
+            return identifier
+
+    def unregister(self, identifier, protocol=socket.IPPROTO_ICMP):
+        with self.lock:
+            self.sessions.pop((protocol, identifier), None)
+
+    def sendto(self, packet, address, ttl, protocol=socket.IPPROTO_ICMP):
+        bulk_socket = self.bulk_socket if protocol == socket.IPPROTO_ICMP else self.probe_sockets[protocol]
+        # raw IPv6 sockets reject a non-zero port
+        return bulk_socket.sendto(packet, (address, 0), hop_limit_message(self.family, ttl))
+
+    def describe(self):
+        lines = [self.bulk_socket.describe()]
+        names = {protocol: name for name, protocol in PROTOCOLS.items()}
+        for protocol, bulk_socket in sorted(self.probe_sockets.items()):
+            lines.append("{} probes: {}".format(names[protocol], bulk_socket.describe()))
+        return "\n".join(lines)
+
+    def receive_loop(self, waker, wakeup):
+        while True:
+            with self.lock:
+                if self.wakeup is not wakeup:  # closed, and maybe opened again since
+                    waker.close()
+                    wakeup.close()
+                    return
+                readers = {self.bulk_socket: decode_reply, wakeup: None}
+                if socket.IPPROTO_TCP in self.probe_sockets:
+                    readers[self.probe_sockets[socket.IPPROTO_TCP]] = decode_tcp_reply
+            try:
+                ready, _, _ = select.select(list(readers), [], [])
+            except (OSError, ValueError):  # a socket was closed
+                continue
+            receive_time = timer()
 
-    for part in ip_parts:
+            for bulk_socket in ready:
+                decode = readers[bulk_socket]
+                if decode is None:
+                    try:
+                        wakeup.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                try:
+                    packets = bulk_socket.drain()
+                except (OSError, ValueError):
+                    continue
+
+                for packet_data, address, ancdata in packets:
+                    reply = decode(self.family, packet_data)
+                    if reply is None:
+                        continue
+
+                    session = self.sessions.get((reply.protocol, reply.identifier))
+                    if session is not None:
+                        session.deliver(reply, receive_time, address[0])
+
+
+# shared by every trace of the process that is not given its own
+default_dispatchers = {
+    socket.AF_INET: TraceDispatcher(socket.AF_INET),
+    socket.AF_INET6: TraceDispatcher(socket.AF_INET6),
+}
+
+
+class ReverseDnsCache:
+    """PTR lookups shared by every trace of the process. Host names are kept
+    for `ttl` seconds and failures for `negative_ttl` seconds, the least
+    recently used entry is evicted beyond `max_entries`, and misses are
+    resolved in a thread pool so that no caller blocks on DNS."""
+
+    def __init__(self, max_entries=4096, ttl=3600, negative_ttl=300, workers=8):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.workers = workers
+        self.entries = collections.OrderedDict()  # ip -> (future, expiry), no expiry while in flight
+        self.lock = threading.Lock()
+        self.executor = None
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, ip):
+        """Returns a future of the host name of ip, or of None if it has
+        none."""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(ip)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                self.entries.move_to_end(ip)
+                self.hits += 1
+                return entry[0]
+
+            self.misses += 1
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="rdns")
+            future = self.executor.submit(self.query, ip)
+            self.entries[ip] = future, None
+            self.entries.move_to_end(ip)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+        future.add_done_callback(lambda done: self.expire_after(ip, done))
+        return future
+
+    @staticmethod
+    def query(ip):
         try:
-            if int(part) < 0 or int(part) > 255:
-                return False
-        except ValueError:
-            return False
-
-    return True
-
-
-def to_ip(hostname):
-    if is_valid_ip(hostname):
-        return hostname
-    return socket.gethostbyname(hostname)
+            return socket.gethostbyaddr(ip)[0]
+        except OSError:  # herror and gaierror, cached as negative
+            return None
+
+    def expire_after(self, ip, future):
+        ttl = self.ttl if future.result() is not None else self.negative_ttl
+        with self.lock:
+            entry = self.entries.get(ip)
+            if entry is not None and entry[0] is future:
+                self.entries[ip] = future, time.monotonic() + ttl
+
+    def describe(self):
+        return "{} reverse lookups, {} served from cache, {} cached".format(
+            self.hits + self.misses, self.hits, len(self.entries))
+
+
+default_reverse_dns = ReverseDnsCache()
+
+_stopping_points = {}
+
+
+def mda_stopping_point(successors, confidence=95):
+    """Probes the Multipath Detection Algorithm sends through an interface
+    before it concludes that the `successors` next hops seen so far are all
+    there is: the fewest flows that, spread evenly over one more next hop,
+    miss one of them with probability below 1 - confidence (6, 11, 16, 21,
+    ... at 95%)."""
+    key = successors, confidence
+    if key not in _stopping_points:
+        hops = successors + 1
+        for probes in itertools.count(1):
+            missed = sum((-1)**(i + 1) * math.comb(hops, i) * ((hops - i) / hops)**probes for i in range(1, hops + 1))
+            if missed <= 1 - confidence / 100:
+                break
+        _stopping_points[key] = probes
+    return _stopping_points[key]
+
+
+class StopSet:
+    """The stop sets of Doubletree (Donnet et al.), shared by the traces of
+    a batch. Forward probing ends at a hop already seen on the way to the
+    destination's prefix, as the rest of the path is known from there;
+    backward probing ends at any hop already seen, as the path from the
+    source to it is. Destinations are grouped by prefix because the hosts
+    of one /24 are reached through the same last hops; a prefix length of
+    32 (128) stops at known (hop, destination) pairs only."""
+
+    def __init__(self, prefix_length=24, prefix_length6=64):
+        self.prefix_lengths = {4: prefix_length, 6: prefix_length6}
+        self.hops = set()  # local stop set
+        self.hop_prefixes = set()  # global stop set
+        self.lock = threading.Lock()
+
+    def prefix(self, ip):
+        address = ipaddress.ip_address(ip)
+        return ipaddress.ip_network((address, self.prefix_lengths[address.version]), strict=False)
+
+    def forward(self, responders, prefix):
+        """Records the responders of a hop on the way to prefix and tells
+        whether forward probing stops there."""
+        pairs = {(ip, prefix) for ip in responders}
+        with self.lock:
+            stop = not pairs.isdisjoint(self.hop_prefixes)
+            self.hop_prefixes |= pairs
+            self.hops |= responders
+        return stop
+
+    def backward(self, responders, prefix):
+        """Records the responders of a hop below the start TTL and tells
+        whether backward probing stops there."""
+        with self.lock:
+            stop = not self.hops.isdisjoint(responders)
+            self.hop_prefixes |= {(ip, prefix) for ip in responders}
+            self.hops |= responders
+        return stop
+
+
+class HopSamples:
+    """The RTTs (ms) of the probes sent to one hop, in an array with NaN for
+    a lost probe, and alongside the address that answered each, None for a
+    lost one. Only the last MAX_SAMPLES probes are kept, so a long running
+    monitor stays in bounded memory."""
+
+    MAX_SAMPLES = 4096
+
+    def __init__(self):
+        self.delays = array.array('d')
+        self.responders = []
+
+    def add(self, delay, ip=None):
+        if len(self.delays) >= self.MAX_SAMPLES:
+            del self.delays[:self.MAX_SAMPLES // 2]
+            del self.responders[:self.MAX_SAMPLES // 2]
+        self.delays.append(math.nan if delay is None else delay)
+        self.responders.append(ip)
+
+    def ranked_responders(self):
+        """The addresses that answered, the most frequent first."""
+        counts = collections.Counter(ip for ip in self.responders if ip is not None)
+        return tuple(ip for ip, count in counts.most_common())
+
+    def summarize(self, destination, ttl, hostname=None):
+        """The HopStatistics of the samples. The statistics are computed over
+        the whole array at once, with NumPy for large ones."""
+        sent = len(self.delays)
+        if numpy is not None and sent * self.delays.itemsize >= NUMPY_MIN_BYTES:
+            delays = numpy.frombuffer(self.delays, dtype=numpy.float64)
+            delays = delays[~numpy.isnan(delays)]
+            received = len(delays)
+            if received:
+                low, high, mean = float(delays.min()), float(delays.max()), float(delays.mean())
+                stddev = float(delays.std(ddof=1)) if received > 1 else 0.0
+        else:
+            delays = [delay for delay in self.delays if delay == delay]  # NaN is not equal to itself
+            received = len(delays)
+            if received:
+                low, high, mean = min(delays), max(delays), math.fsum(delays) / received
+                stddev = math.sqrt(math.fsum((delay - mean)**2 for delay in delays) / (received - 1)) \
+                    if received > 1 else 0.0
+        if not received:
+            low = high = mean = stddev = None
+
+        responders = self.ranked_responders()
+        ip = responders[0] if responders else None
+        loss = (sent - received) * 100.0 / sent if sent else 0.0
+        return HopStatistics(destination, ttl, ip, hostname or ip, responders, sent, received, loss, low, mean, high,
+                             stddev, time.time())
+
+
+class PathStore:
+    """The last known path to every monitored destination, kept in memory
+    and saved as PATH_RECORDs to one file. Saving writes a new file and
+    renames it over the old one, so the store survives a crash mid-save."""
+
+    def __init__(self, path):
+        self.path = path
+        self.paths = {}
+
+    def load(self):
+        """Reads the saved paths. A truncated or corrupt file is reported on
+        stderr and loads nothing, so every destination is traced afresh and
+        the next save replaces the file."""
+        try:
+            with open(self.path, "rb") as stream:
+                data = stream.read()
+        except FileNotFoundError:
+            return
+        try:
+            self.paths.update(self.parse(data))
+        except (struct.error, ValueError) as error:  # UnicodeDecodeError is a ValueError
+            print("Warning: ignoring corrupt path store {}: {}".format(self.path, error), file=sys.stderr)
+
+    @staticmethod
+    def parse(data):
+        paths = {}
+        offset = 0
+        while offset < len(data):
+            name_length, hop_count, reached, timestamp = PATH_RECORD.unpack_from(data, offset)
+            offset += PATH_RECORD.size
+            if offset + name_length + hop_count * 16 > len(data):
+                raise ValueError("record truncated at byte {}".format(offset - PATH_RECORD.size))
+            name = data[offset:offset + name_length].decode()
+            offset += name_length
+            hops = tuple(bytes_to_address(data[offset + i * 16:offset + i * 16 + 16]) for i in range(hop_count))
+            offset += hop_count * 16
+            paths[name] = KnownPath(hops, reached, timestamp)
+        return paths
+
+    def save(self):
+        chunks = []
+        for name, known in self.paths.items():
+            encoded = name.encode()
+            chunks.append(PATH_RECORD.pack(len(encoded), len(known.hops), known.reached, known.timestamp))
+            chunks.append(encoded)
+            chunks += [address_to_bytes(ip) for ip in known.hops]
+        with open(self.path + ".tmp", "wb") as stream:
+            stream.write(b"".join(chunks))
+        os.replace(self.path + ".tmp", self.path)
+
+    def get(self, destination):
+        return self.paths.get(destination)
+
+    def put(self, destination, known):
+        self.paths[destination] = known
 
 
 class Traceroute:
-    def __init__(self, destination_server, count_of_packets, packet_size, max_hops, timeout, ttl, max_ttl):
+    def __init__(self, destination_server, count_of_packets, packet_size, max_hops, timeout, ttl, max_ttl, sink=None,
+                 parallel=False, numeric=False, paris=False, multipath=False, confidence=95, protocol="icmp",
+                 port=None, budget=None, stop_set=None, adaptive=False, rto_min=RTO_MIN, rto_max=None,
+                 summary=False, dispatchers=None, reverse_dns=None):
+        self.own_sink = sink is None
+        if sink is None:
+            sink = TextSink(sys.stdout, count_of_packets, max_ttl)
+        self.sink = sink
+        self.dispatchers = default_dispatchers if dispatchers is None else dispatchers
+        self.reverse_dns = default_reverse_dns if reverse_dns is None else reverse_dns
         self.destination_server = destination_server
         self.count_of_packets = count_of_packets
         self.packet_size = packet_size
         self.max_hops = max_hops
+        self.max_ttl = max_ttl
         self.timeout = timeout
-        self.identifier = os.getpid() & 0xffff
+        # the RTO of the destination, which hops start from until they have
+        # their own samples or time out
+        self.rto = RtoEstimator(timeout, rto_min, rto_max or timeout) if adaptive else None
+        self.hop_rtos = {}
+        self.probe_counts = collections.Counter()
+        self.summary = summary
+        self.samples = collections.defaultdict(HopSamples)  # ttl -> the samples of the hop
+        self.parallel = parallel
+        self.numeric = numeric
+        self.paris = paris
+        self.multipath = multipath
+        self.confidence = confidence
+        self.protocol = PROTOCOLS[protocol]
+        if port is None:
+            port = TCP_PORT if self.protocol == socket.IPPROTO_TCP else UDP_PORT
+        self.port = port
+        self.budget = budget
+        self.stop_set = stop_set
+        self.probes_sent = 0
+        self.base_checksum = 0
+        self.unwritten = collections.deque()
+        self.holding = False  # results are kept back until the trace knows its last TTL
+        self.last_ttl = None  # results of TTLs above it are dropped
+        self.dispatcher = None
+        self.identifier = None
+        self.packet_builder = None
         self.seq_no = 0
         self.delays = []
-        self.prev_sender_hostname = ""
+        self.send_times = {}
+        self.replies = {}
+        self.reply_ready = threading.Condition()
 
         self.ttl = ttl
+        self.family = socket.AF_INET
+        self.destination_ip = None
+        self.addresses = []
         try:
-            self.destination_ip = to_ip(destination_server)
-        except socket.gaierror:
+            self.addresses = resolve(destination_server)
+            self.family, self.destination_ip = self.addresses[0]
+        except (socket.gaierror, UnicodeError):  # UnicodeError: a name IDNA cannot encode
             self.print_unknownhost()
 
     def print_start(self):
-        print("traceroute to {} ({}), {} hops max, {} byte packets".format(self.destination_server, self.destination_ip,
-                                                                           self.max_hops, self.packet_size))
+        self.sink.message("traceroute to {} ({}), {} hops max, {} byte packets".format(
+            self.destination_server, self.destination_ip, self.max_hops, self.packet_size))
 
     def print_unknownhost(self):
-        print("traceroute: unknown host {}".format(self.destination_server))
+        self.sink.message("traceroute: unknown host {}".format(self.destination_server))
 
     def print_timeout(self):
-        if self.seq_no == 1:
-            if self.ttl < max_ttl:
-                print(" {}  ".format(self.ttl), end="")
-            else:
-                print("{}  ".format(self.ttl), end="")
-        print("* ", end="")
-        if self.seq_no == self.count_of_packets:
-            print()
+        self.samples[self.ttl].add(None)
+        if self.summary:
+            return
+        self.unwritten.append(
+            (HopResult(self.destination_server, self.ttl, self.seq_no, None, None, None, time.time()), None))
+        self.write_results()
 
-    def print_trace(self, delay, ip_header):
+    def print_trace(self, delay, ip):
+        self.samples[self.ttl].add(delay, ip)
+        if self.summary:
+            return
 
-        ip = socket.inet_ntoa(struct.pack('!I', ip_header['Source_IP']))
-        try:
-            sender_hostname = socket.gethostbyaddr(ip)[0]
-        except socket.herror:
-            sender_hostname = ip
+        hostname = None if self.numeric else self.reverse_dns.lookup(ip)
+        self.unwritten.append(
+            (HopResult(self.destination_server, self.ttl, self.seq_no, ip, ip, delay, time.time()), hostname))
+        self.write_results()
+
+    def print_summary(self):
+        """Writes the HopStatistics of every hop probed so far, up to the
+        destination."""
+        with self.reply_ready:
+            last_ttl = self.destination_ttl(self.replies)
+        ttls = [ttl for ttl in sorted(self.samples) if last_ttl is None or ttl <= last_ttl]
+        hostnames = {}
+        if not self.numeric:
+            responders = {ttl: self.samples[ttl].ranked_responders() for ttl in ttls}
+            hostnames = {ttl: self.reverse_dns.lookup(responders[ttl][0]) for ttl in ttls if responders[ttl]}
+        self.sink.message(" {:>2}  {:<40} {:>6} {:>5} {:>8} {:>8} {:>8} {:>8}".format(
+            "", "host", "loss", "sent", "min", "avg", "max", "stddev"))
+        for ttl in ttls:
+            hostname = hostnames[ttl].result() if ttl in hostnames else None
+            self.sink.write(self.samples[ttl].summarize(self.destination_server, ttl, hostname))
+
+    def write_results(self, wait=False):
+        """Writes the results whose host name is known, in probe order. Names
+        are looked up off the probe path, so a result waits here until its
+        lookup is done, or until the end of the trace when `wait` is set.
+        Results beyond last_ttl are dropped."""
+        if self.holding and not wait:
+            return
+        while self.unwritten:
+            result, hostname = self.unwritten[0]
+            if hostname is not None:
+                if not wait and not hostname.done():
+                    return
+                result = result._replace(hostname=hostname.result() or result.ip)
+            self.unwritten.popleft()
+            if self.last_ttl is None or result.ttl <= self.last_ttl:
+                self.sink.write(result)
+
+    def open_socket(self):
+        """Opens the dispatchers of the destination's addresses and picks the
+        address to trace. Raises the socket error of the last address when
+        none can be probed."""
+        candidates = []
+        for family, ip in self.addresses:
+            try:
+                self.dispatchers[family].open(self.protocol)
+            except socket.error as err:
+                error = err
+                continue
+            candidates.append((family, ip))
 
-        if self.prev_sender_hostname != sender_hostname:
-            if self.ttl < 10:
-                print(" {}  {} ({}) {:.3f}ms ".format(self.ttl, sender_hostname, ip, delay), end="")
-            else:
-                print("{}  {} ({}) {:.3f}ms ".format(self.ttl, sender_hostname, ip, delay), end="")
-            self.prev_sender_hostname = sender_hostname
+        if not candidates:
+            raise error
 
+        if len(candidates) > 1:
+            self.race(candidates)
         else:
-            print("{:.3f} ms ".format(delay), end="")
+            self.use_address(*candidates[0])
+
+    def use_address(self, family, ip, identifier=None):
+        self.family = family
+        self.destination_ip = ip
+        self.dispatcher = self.dispatchers[family]
+        if identifier is None:
+            identifier = self.dispatcher.register(self, self.protocol)
+        self.identifier = identifier
+        if self.protocol == socket.IPPROTO_ICMP:
+            self.packet_builder = EchoPacketBuilder(self.identifier, self.packet_size, icmp_type=ECHO_REQUEST[family])
+            self.base_checksum = self.packet_builder.checksum
+        else:
+            self.packet_builder = PROBE_BUILDERS[self.protocol](family, source_address(family, ip), ip,
+                                                                self.identifier, self.port, self.packet_size)
+
+    def flow_checksum(self, flow):
+        """The checksum that makes up flow number `flow`; flow 0 is the one
+        of the plain packet template."""
+        return (self.base_checksum + flow) % 0xffff
+
+    def race(self, candidates):
+        """Happy Eyeballs: one echo with the full hop budget goes to every
+        address of the destination and the family whose echo reply arrives
+        first is traced. If none answers, the preferred one (IPv6) is. UDP
+        and TCP traces race with echoes too, then register their own
+        protocol."""
+        contenders = []
+        for family, ip in candidates:
+            identifier = self.dispatchers[family].register(self)
+            builder = EchoPacketBuilder(identifier, self.packet_size, icmp_type=ECHO_REQUEST[family])
+            contenders.append((family, ip, identifier, builder))
+
+        with self.reply_ready:
+            self.send_times[0] = timer()
+        for family, ip, identifier, builder in contenders:
+            try:
+                self.dispatchers[family].sendto(builder.build(0), ip, self.max_hops)
+            except socket.error:
+                pass
+
+        with self.reply_ready:
+            self.reply_ready.wait_for(lambda: 0 in self.replies, self.timeout / 1000)
+            del self.send_times[0]
+            reply = self.replies.pop(0, None)
+        winner = contenders[0][0]
+        if reply is not None and reply[1] in ECHO_REPLY.values():
+            winner = socket.AF_INET6 if ':' in reply[2] else socket.AF_INET
+
+        for family, ip, identifier, builder in contenders:
+            if family == winner and self.protocol == socket.IPPROTO_ICMP:
+                self.use_address(family, ip, identifier)
+                continue
+            self.dispatchers[family].unregister(identifier)
+            if family == winner:
+                self.use_address(family, ip)
+
+    def deliver(self, reply, receive_time, address):
+        with self.reply_ready:
+            if reply.sequence in self.send_times and reply.sequence not in self.replies:
+                self.replies[reply.sequence] = receive_time, reply.type, address
+                if self.rto is not None:
+                    # late replies are sampled too, so the RTO grows to cover a slow hop
+                    rtt = (receive_time - self.send_times[reply.sequence]) * 1000.0
+                    self.rto.sample(rtt)
+                    if reply.sequence >> 8:  # not the race echo
+                        self.hop_rto(reply.sequence >> 8).sample(rtt)
+                self.reply_ready.notify()
+
+    def hop_rto(self, ttl):
+        if ttl not in self.hop_rtos:
+            self.hop_rtos[ttl] = RtoEstimator(self.rto.rto, self.rto.floor, self.rto.ceiling)
+        return self.hop_rtos[ttl]
+
+    def hop_timeout(self, ttl):
+        """Seconds a probe at ttl is waited for: the fixed timeout, or the RTO
+        of the hop once it has one and the destination's until then."""
+        if self.rto is None:
+            return self.timeout / 1000
+        with self.reply_ready:
+            hop = self.hop_rtos.get(ttl, self.rto)
+            return hop.rto / 1000
+
+    def expire(self, ttl):
+        """Backs off the RTO of a hop that left a probe unanswered."""
+        if self.rto is not None:
+            with self.reply_ready:
+                self.hop_rto(ttl).backoff()
+
+    def close_socket(self):
+        if self.dispatcher is not None:
+            self.dispatcher.unregister(self.identifier, self.protocol)
+
+    def close(self):
+        """Leaves the dispatcher and stops the sink the trace created for
+        itself, if any."""
+        self.close_socket()
+        if self.own_sink:
+            self.sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
-        if self.seq_no == self.count_of_packets:
-            print()
-            self.prev_sender_hostname = ""
-            if MIN_SLEEP > delay:
-                time.sleep((MIN_SLEEP - delay) / 1000)
+    def start_traceroute(self):
 
-    def header_to_dict(self, keys, packet, struct_format):
-        values = struct.unpack(struct_format, packet)
-        return dict(zip(keys, values))
+        if not self.addresses:  # unknown host
+            return
 
-    def start_traceroute(self):
+        if self.dispatcher is None:
+            self.open_socket()
 
-        icmp_header = None
-        while self.ttl <= self.max_hops:
-            self.seq_no = 0
-            try:
-                for i in range(self.count_of_packets):
-                    icmp_header = self.tracer()
+        try:
+            if self.multipath:
+                self.multipath_trace()
+                return
+            if self.parallel:
+                self.parallel_trace()
+                return
 
-            except KeyboardInterrupt:  # handles Ctrl+C
-                break
+            self.print_start()
+            if self.stop_set is not None:
+                self.doubletree_trace()
+                return
+
+            while self.ttl <= self.max_hops:
+                responders, reached = self.trace_hop()
+                self.ttl += 1
+                if reached:
+                    break
+        except KeyboardInterrupt:  # handles Ctrl+C
+            pass
+        finally:
+            self.write_results(wait=True)
+            if self.summary:
+                self.print_summary()
+
+    def trace_hop(self):
+        """Probes the current TTL count_of_packets times, one probe after the
+        other. Returns the addresses that answered and whether one of them
+        ends the path. Probes are keyed by the TTL and their number in the
+        low byte, so at most 255 are sent per hop."""
+        self.seq_no = 0
+        reached = False
+        count = min(self.count_of_packets, 0xff)
+        for i in range(count):
+            icmp_type = self.tracer()
+            # an echo reply, or an unreachable error ending the path
+            if icmp_type is not None and icmp_type != TIME_EXCEEDED[self.family]:
+                reached = True
+
+        keys = [(self.ttl & 0xff) << 8 | probe for probe in range(1, count + 1)]
+        with self.reply_ready:
+            responders = {self.replies[key][2] for key in keys if key in self.replies}
+        return responders, reached
+
+    def doubletree_trace(self):
+        """Probes hop by hop from the start TTL towards the destination until
+        it answers or the path joins one known from the stop set, then from
+        the start TTL back towards the source until the path joins a hop the
+        batch has already seen. Silent hops never stop either direction.
+
+        A destination closer than the start TTL answers every TTL from its
+        own up, so the results are held until the trace is done and those
+        above the lowest TTL it answered are dropped."""
+        first_ttl = self.ttl
+        prefix = self.stop_set.prefix(self.destination_ip)
+        self.holding = True
+        try:
+            while self.ttl <= self.max_hops:
+                responders, reached = self.trace_hop()
+                self.ttl += 1
+                if self.stop_set.forward(responders, prefix) or reached:
+                    break
 
-            self.ttl += 1
-            if icmp_header is not None:
-                if icmp_header['type'] == ICMP_ECHO_REPLY:
+            for self.ttl in range(first_ttl - 1, 0, -1):
+                responders, reached = self.trace_hop()
+                # while the destination answers it is closer still
+                if self.stop_set.backward(responders, prefix) and not reached:
+                    break
+        finally:
+            self.holding = False
+            with self.reply_ready:
+                self.last_ttl = self.destination_ttl(self.replies)
+
+    def probe_ttls(self, ttls):
+        """Sends one probe to each of the TTLs at once, keyed by the TTL and a
+        counter of its probes that wraps at 255, and waits for their replies.
+        Returns the (icmp_type, address) of the reply of each TTL that
+        answered."""
+        keys = {}
+        for ttl in ttls:
+            self.probe_counts[ttl] = self.probe_counts[ttl] % 0xff + 1
+            key = ttl << 8 | self.probe_counts[ttl]
+            with self.reply_ready:
+                self.replies.pop(key, None)
+            if self.send_probe(key, ttl) is not None:
+                keys[key] = ttl
+
+        sent = timer()
+        with self.reply_ready:
+            while not all(key in self.replies for key in keys):
+                remaining = sent + max(self.hop_timeout(ttl) for ttl in keys.values()) - timer()
+                if remaining <= 0:
+                    break
+                self.reply_ready.wait(remaining)
+            answers = {ttl: self.replies[key][1:] for key, ttl in keys.items() if key in self.replies}
+            for key, ttl in keys.items():
+                reply = self.replies.get(key)
+                if reply is None:
+                    self.samples[ttl].add(None)
+                else:
+                    self.samples[ttl].add((reply[0] - self.send_times[key]) * 1000.0, reply[2])
+
+        for ttl in set(keys.values()) - set(answers):
+            self.expire(ttl)
+        return answers
+
+    def trace_path(self):
+        """The responder of every TTL from 1 to the destination, None for a
+        silent one, and whether the destination answered. TTLs are probed
+        PATH_WINDOW at a time, the silent ones up to count_of_packets
+        times."""
+        hops = []
+        last_ttl = min(self.max_hops, 0xff)
+        for first_ttl in range(1, last_ttl + 1, PATH_WINDOW):
+            ttls = range(first_ttl, min(first_ttl + PATH_WINDOW, last_ttl + 1))
+            answers = {}
+            for attempt in range(self.count_of_packets):
+                silent = [ttl for ttl in ttls if ttl not in answers]
+                if not silent:
+                    break
+                answers.update(self.probe_ttls(silent))
+
+            for ttl in ttls:
+                icmp_type, address = answers.get(ttl, (None, None))
+                hops.append(address)
+                if icmp_type is not None and icmp_type != TIME_EXCEEDED[self.family]:
+                    return tuple(hops), True
+
+        while hops and hops[-1] is None:
+            hops.pop()
+        return tuple(hops), False
+
+    def parallel_trace(self):
+        """Sends the probes of every TTL from the start TTL to max_hops in one
+        burst, with the TTL in the high byte of the sequence number and the
+        probe in the low one, and lets the dispatcher match the replies back
+        to their hop. The trace ends once every probe up to the destination
+        has been answered, or when the timeout expires, so it takes about
+        one RTT plus the timeout."""
+        self.print_start()
+        first_ttl = self.ttl
+        last_ttl = min(self.max_hops, 0xff)
+        probes = range(1, min(self.count_of_packets, 0xff) + 1)
+
+        for ttl in range(first_ttl, last_ttl + 1):
+            for probe in probes:
+                # whatever could not be sent is reported as a timeout
+                self.send_probe(ttl << 8 | probe, ttl)
+
+        def finished():
+            destination_ttl = self.destination_ttl(self.replies)
+            return destination_ttl is not None and all(
+                ttl << 8 | probe in self.replies for ttl in range(first_ttl, destination_ttl + 1) for probe in probes)
+
+        sent = timer()
+        with self.reply_ready:
+            while not finished():
+                # the RTOs shrink as replies come in
+                remaining = sent + max(self.hop_timeout(ttl) for ttl in range(first_ttl, last_ttl + 1)) - timer()
+                if remaining <= 0:
+                    break
+                self.reply_ready.wait(remaining)
+            replies = dict(self.replies)
+
+        for self.ttl in range(first_ttl, (self.destination_ttl(replies) or last_ttl) + 1):
+            for self.seq_no in probes:
+                key = self.ttl << 8 | self.seq_no
+                if key in replies:
+                    receive_time, icmp_type, address = replies[key]
+                    self.print_trace((receive_time - self.send_times[key]) * 1000.0, address)
+                else:
+                    self.print_timeout()
+
+    def multipath_trace(self):
+        """Multipath Detection Algorithm (Augustin et al.). Probes of one flow
+        take one path through per-flow load balancers, so each hop is probed
+        with distinct flows until, for every interface of the previous hop,
+        enough of the flows through it have been seen to rule out another
+        next hop with the given confidence. When too few flows are known to
+        cross an interface, new ones are first sent to the previous hop to
+        find some. Each TTL spends at most 255 probes. The result is written
+        as the edges of the hop graph, with the flows seen on each.
+
+        IPv6 load balancers hashing the flow label are not enumerated; only
+        the ICMPv6 checksum changes between flows."""
+        self.print_start()
+        first_ttl = self.ttl
+        last_ttl = min(self.max_hops, 0xff)
+        responders = {}  # ttl -> {flow: responder, None when silent}
+        terminal = set()  # responders that answered with anything but Time Exceeded
+        probes_sent = collections.Counter()
+        flows = itertools.count()
+
+        for ttl in range(first_ttl, last_ttl + 1):
+            responders[ttl] = {}
+            while True:
+                batch = self.mda_round(ttl, first_ttl, responders, flows)
+                if not self.probe_flows(batch, responders, terminal, probes_sent):
                     break
 
-    def tracer(self):
+            hop = {ip for ip in responders[ttl].values() if ip is not None}
+            if hop and hop <= terminal:
+                break
 
-        try:
-            icmp_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.getprotobyname("ICMP"))
-            icmp_socket.setsockopt(socket.SOL_IP, socket.IP_TTL, self.ttl)
+        self.print_graph(first_ttl, ttl, responders)
+
+    def mda_round(self, ttl, first_ttl, responders, flows):
+        """The (ttl, flow) probes the next MDA round needs at this hop."""
+        nodes = collections.defaultdict(list)
+        for flow, ip in responders.get(ttl - 1, {}).items():
+            if ip is not None:
+                nodes[ip].append(flow)
+        if ttl == first_ttl or not nodes:  # nothing to steer by, one node holds every flow
+            nodes = {None: list(dict.fromkeys(itertools.chain(responders.get(ttl - 1, {}), responders[ttl])))}
+
+        batch = []
+        for node, node_flows in nodes.items():
+            probed = [flow for flow in node_flows if flow in responders[ttl]]
+            successors = {responders[ttl][flow] for flow in probed} - {None}
+            # silent probes still count, a silent hop is probed like one with a single next hop
+            missing = mda_stopping_point(max(len(successors), 1), self.confidence) - len(probed)
+            if missing <= 0:
+                continue
+
+            unprobed = [flow for flow in node_flows if flow not in responders[ttl]][:missing]
+            batch += [(ttl, flow) for flow in unprobed]
+            missing -= len(unprobed)
+            # new flows are found at the previous hop, unless any flow will do
+            new_ttl = ttl if node is None else ttl - 1
+            batch += [(new_ttl, next(flows)) for _ in range(missing)]
+        return batch
+
+    def probe_flows(self, batch, responders, terminal, probes_sent):
+        """Sends a round of (ttl, flow) probes at once and records who answers
+        each of them. Returns False once nothing could be sent."""
+        keys = {}
+        for ttl, flow in batch:
+            if probes_sent[ttl] >= 0xff:  # the probe budget of this hop is spent
+                continue
+            probes_sent[ttl] += 1
+            key = ttl << 8 | probes_sent[ttl]
+            if self.send_probe(key, ttl, flow) is not None:
+                keys[key] = ttl, flow
+        if not keys:
+            return False
 
-        except socket.error as err:
-            if err.errno == 1:
-                print("Operation not permitted: ICMP messages can only be sent from a process running as root")
-            else:
-                print("Error: {}".format(err))
+        sent = timer()
+        ttls = {ttl for ttl, flow in keys.values()}
+        with self.reply_ready:
+            while not all(key in self.replies for key in keys):
+                remaining = sent + max(self.hop_timeout(ttl) for ttl in ttls) - timer()
+                if remaining <= 0:
+                    break
+                self.reply_ready.wait(remaining)
+            replies = {key: self.replies.get(key) for key in keys}
+
+        for ttl in {ttl for key, (ttl, flow) in keys.items() if replies[key] is None}:
+            self.expire(ttl)
+        for key, (ttl, flow) in keys.items():
+            reply = replies[key]
+            if reply is None:
+                responders[ttl].setdefault(flow, None)
+                continue
+            receive_time, icmp_type, address = reply
+            responders[ttl][flow] = address
+            if icmp_type != TIME_EXCEEDED[self.family]:
+                terminal.add(address)
+        return True
+
+    def print_graph(self, first_ttl, last_ttl, responders):
+        edges = []
+        for ttl in range(first_ttl, last_ttl + 1):
+            previous = responders.get(ttl - 1, {})
+            counts = collections.Counter((previous.get(flow), ip) for flow, ip in responders[ttl].items())
+            # flows found for a later hop were never sent to the one before
+            linked = {ip for before, ip in counts if before is not None}
+            for before, ip in list(counts):
+                if before is None and ip in linked:
+                    del counts[before, ip]
+            edges += sorted(((ttl, ip, flows_seen, before) for (before, ip), flows_seen in counts.items()),
+                            key=lambda edge: (edge[1] is None, edge[1] or "", edge[3] or ""))
+
+        names = {}
+        if not self.numeric:
+            names = {ip: self.reverse_dns.lookup(ip) for ttl, ip, flows_seen, before in edges if ip is not None}
+        for ttl, ip, flows_seen, before in edges:
+            hostname = names[ip].result() or ip if ip in names else ip
+            self.sink.write(HopLink(self.destination_server, ttl, before, ip, hostname, flows_seen))
+
+    def destination_ttl(self, replies):
+        """The lowest TTL answered by anything but Time Exceeded, or None."""
+        return min((key >> 8 for key, (receive_time, icmp_type, address) in replies.items()
+                    if icmp_type != TIME_EXCEEDED[self.family]), default=None)
 
-            sys.exit()
+    def tracer(self):
 
         self.seq_no += 1
-        if self.ttl == 1 and self.seq_no == 1:
-            self.print_start()
-
-        sent_time = self.send_icmp_echo(icmp_socket)
+        key = (self.ttl & 0xff) << 8 | self.seq_no & 0xff
+        with self.reply_ready:
+            # a late reply to an earlier probe with this key is not ours
+            self.replies.pop(key, None)
+            self.send_times.pop(key, None)
+        sent_time = self.send_probe(key, self.ttl)
 
         if sent_time is None:
             return
 
-        receive_time, icmp_header, ip_header = self.receive_icmp_reply(icmp_socket)
-
-        icmp_socket.close()
-        if receive_time:
-            delay = (receive_time - sent_time) * 1000.0
-            self.print_trace(delay, ip_header)
-
-        return icmp_header
-
-    def send_icmp_echo(self, icmp_socket):
+        reply = self.receive_icmp_reply(key, sent_time)
+        if reply is None:
+            return
 
-        header = struct.pack("!BBHHH", ICMP_ECHO, 0, 0, self.identifier, self.seq_no)
+        receive_time, icmp_type, address = reply
+        delay = (receive_time - sent_time) * 1000.0
+        self.print_trace(delay, address)
 
-        start_value = 65
-        payload = []
-        for i in range(start_value, start_value+self.packet_size):
-            payload.append(i & 0xff)
+        return icmp_type
 
-        data = bytes(payload)
-        checksum = calculate_checksum(header + data)
-        header = struct.pack("!BBHHH", ICMP_ECHO, 0, checksum, self.identifier, self.seq_no)
+    def send_probe(self, seq_no, ttl, flow=None):
 
-        packet = header + data
+        if flow is None and self.paris:
+            flow = 0
+        if self.budget is not None:
+            self.budget.acquire()
+        if self.protocol == socket.IPPROTO_ICMP:
+            checksum = None if flow is None else self.flow_checksum(flow)
+            packet = self.packet_builder.build(seq_no, checksum=checksum)
+        else:
+            packet = self.packet_builder.build(seq_no, flow)
 
-        send_time = timer()
+        with self.reply_ready:
+            send_time = timer()
+            self.send_times[seq_no] = send_time
         try:
-            icmp_socket.sendto(packet, (self.destination_server, 1))
+            self.dispatcher.sendto(packet, self.destination_ip, ttl, self.protocol)
 
         except socket.error as err:
-            print("General error: %s", err)
-            icmp_socket.close()
+            with self.reply_ready:
+                self.send_times.pop(seq_no, None)
+            self.sink.message("traceroute: sendto {}: {}".format(self.destination_ip, err))
             return
 
+        self.probes_sent += 1
         return send_time
 
-    def receive_icmp_reply(self, icmp_socket):
-
-        timeout = self.timeout / 1000
-
-        while True:
-            # started_select = time.time()
-            inputReady, _, _ = select.select([icmp_socket], [], [], timeout)
-            # how_long_in_select = time.time() - started_select
-            receive_time = timer()
-
-            if not inputReady:  # timeout
-                self.print_timeout()
-                return None, None, None
-
-            packet_data, address = icmp_socket.recvfrom(2048)
-
-            icmp_keys = ['type', 'code', 'checksum', 'identifier', 'sequence number']
-            icmp_header = self.header_to_dict(icmp_keys, packet_data[20:28], "!BBHHH")
-
-            # if icmp_header['type'] == 11:  # time exceeded
+    def receive_icmp_reply(self, seq_no, sent_time):
 
-            ip_keys = ['VersionIHL', 'Type_of_Service', 'Total_Length', 'Identification', 'Flags_FragOffset', 'TTL',
-                       'Protocol', 'Header_Checksum', 'Source_IP', 'Destination_IP']
+        with self.reply_ready:
+            while seq_no not in self.replies:
+                remaining = sent_time + self.hop_timeout(self.ttl) - timer()
+                if remaining <= 0:  # timeout
+                    break
+                self.reply_ready.wait(remaining)
+            reply = self.replies.get(seq_no)
+
+        if reply is None:
+            self.expire(self.ttl)
+            self.print_timeout()
+        return reply
+
+
+class PathMonitor:
+    """Watches the paths to many destinations for changes. The first cycle
+    traces each path in full; later cycles probe only a random sample of
+    its hops along with its last two, which tell whether the destination
+    moved closer or further. Only when a sampled hop answers from another
+    address, or the hop count shifted, is the path traced again, and each
+    hop that differs is written to the sink as a PathChange. Silent hops
+    are loss, not change. Probes keep one flow (Paris traceroute) so that
+    load balancing does not pass for a change."""
+
+    def __init__(self, store, sink, sample=MONITOR_SAMPLE):
+        self.store = store
+        self.sink = sink
+        self.sample = sample
+        self.random = random.Random()
+        self.totals = collections.Counter()
+
+    def check(self, t):
+        """Checks the path of one trace and returns the changes found. The
+        trace's socket is opened on its first check; a destination that
+        cannot be probed is reported, counted in the errors and tried again
+        next cycle."""
+        destination = t.destination_server
+        known = self.store.get(destination)
+        probes_sent = t.probes_sent
+        changes = []
+        try:
+            if t.dispatcher is None:
+                t.open_socket()
+            if known is None or self.changed(t, known):
+                hops, reached = t.trace_path()
+                if known is not None:
+                    # a silent hop keeps the responder last seen there
+                    hops = tuple(ip or (known.hops[i] if i < len(known.hops) else None) for i, ip in enumerate(hops))
+                    changes = self.compare(destination, known.hops, hops)
+                self.store.put(destination, KnownPath(hops, reached, time.time()))
+        except socket.error as error:
+            self.sink.message("traceroute: {}: {}".format(destination, error))
+            self.totals["errors"] += 1
+        self.totals["probes"] += t.probes_sent - probes_sent
+        return changes
+
+    def changed(self, t, known):
+        hop_count = len(known.hops)
+        if not hop_count:
+            return True
+        ttls = [ttl for ttl in range(1, hop_count - 1) if known.hops[ttl - 1] is not None]
+        ttls = self.random.sample(ttls, min(self.sample, len(ttls))) + list(range(max(hop_count - 1, 1),
+                                                                                    hop_count + 1))
+        for ttl, (icmp_type, address) in t.probe_ttls(ttls).items():
+            terminal = icmp_type != TIME_EXCEEDED[t.family]
+            if ttl == hop_count and known.reached:
+                if not terminal:  # the destination moved further
+                    return True
+            elif terminal:  # closer
+                return True
+            elif known.hops[ttl - 1] is not None and address != known.hops[ttl - 1]:
+                return True
+        return False
 
-            ip_header = self.header_to_dict(ip_keys, packet_data[:20], "!BBHHHBBHII")
+    @staticmethod
+    def compare(destination, before, after):
+        now = time.time()
+        changes = []
+        for ttl, (previous, ip) in enumerate(itertools.zip_longest(before, after), 1):
+            if previous != ip:
+                changes.append(PathChange(destination, ttl, previous, ip, len(after), now))
+        return changes
+
+    def cycle(self, traces, jobs=BATCH_JOBS):
+        """Checks every trace once, `jobs` at a time, writes the changes and
+        saves the store."""
+        changed = 0
+        for changes in run_concurrently(self.check, traces, jobs):
+            for change in changes:
+                self.sink.write(change)
+            changed += bool(changes)
+        self.store.save()
+        self.totals["cycles"] += 1
+        return changed
+
+
+def run_concurrently(function, items, jobs):
+    """Calls function on every item of an iterable, `jobs` calls at a time,
+    and yields the results as they complete. Items are taken from the
+    iterable only as earlier calls finish."""
+    with concurrent.futures.ThreadPoolExecutor(jobs, thread_name_prefix="trace") as executor:
+        running = set()
+        try:
+            for item in items:
+                if len(running) >= jobs:
+                    done, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                running.add(executor.submit(function, item))
 
-            return receive_time, icmp_header, ip_header
+            for future in concurrent.futures.as_completed(running):
+                yield future.result()
+        finally:
+            for future in running:
+                future.cancel()
 
 
 def create_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument('destination_server')
+    parser.add_argument('destination_server', nargs='?')
     parser.add_argument('-c', '--count', required=False, nargs='?', default=3, type=int, metavar='Count of packets')
     parser.add_argument('-t', '--timeout', required=False, nargs='?', default=1000, type=int, metavar='Timeout in ms')
     parser.add_argument('-m', '--maxhops', required=False, nargs='?', default=64, type=int, metavar='Max hops')
-    parser.add_argument('-l', '--ttl', required=False, nargs='?', default=1, type=int, metavar='Start TTL')
+    parser.add_argument('-l', '--ttl', required=False, nargs='?', default=None, type=int,
+                        metavar='Start TTL (1, {} in a batch)'.format(DOUBLETREE_TTL))
     parser.add_argument('-a', '--max_ttl', required=False, nargs='?', default=10, type=int, metavar='MAX TTL')
     parser.add_argument('-p', '--packet_size', required=False, nargs='?', default=55, type=int,
                         metavar='Packet size in bytes')
+    parser.add_argument('-o', '--output_format', required=False, default='text', choices=sorted(FORMATS),
+                        help='Format of the results (default text)')
+    parser.add_argument('-O', '--output_file', required=False, default=None, metavar='File to write the results to')
+    parser.add_argument('-S', '--io_statistics', required=False, action='store_true',
+                        help='Report the syscalls spent per probe')
+    parser.add_argument('-P', '--parallel', required=False, action='store_true',
+                        help='Probe every TTL at once instead of hop by hop')
+    parser.add_argument('-n', '--numeric', required=False, action='store_true',
+                        help='Print hop addresses without looking up their names')
+    parser.add_argument('-F', '--paris', required=False, action='store_true',
+                        help='Keep the flow of every probe constant (Paris traceroute)')
+    parser.add_argument('-M', '--multipath', required=False, action='store_true',
+                        help='Find every next hop of each TTL and print the hop graph (MDA)')
+    parser.add_argument('-C', '--confidence', required=False, nargs='?', default=95, type=float,
+                        metavar='Confidence in % that MDA found every next hop')
+    probes = parser.add_mutually_exclusive_group()
+    probes.add_argument('-I', '--icmp', dest='protocol', action='store_const', const='icmp', default='icmp',
+                        help='Probe with ICMP echo requests (default)')
+    probes.add_argument('-U', '--udp', dest='protocol', action='store_const', const='udp',
+                        help='Probe with UDP datagrams to high ports')
+    probes.add_argument('-T', '--tcp', dest='protocol', action='store_const', const='tcp',
+                        help='Probe with TCP SYNs')
+    parser.add_argument('-r', '--port', required=False, nargs='?', default=None, type=int,
+                        metavar='Destination port of UDP (33434) and TCP (80) probes')
+    parser.add_argument('-f', '--file', required=False, default=None,
+                        metavar='File of destinations to trace, one per line, - for stdin')
+    parser.add_argument('-R', '--pps', required=False, nargs='?', default=BATCH_PPS, type=float,
+                        metavar='Probes per second of a batch')
+    parser.add_argument('-j', '--jobs', required=False, nargs='?', default=BATCH_JOBS, type=int,
+                        metavar='Destinations of a batch traced at once')
+    parser.add_argument('-x', '--prefix_length', required=False, nargs='?', default=24, type=int,
+                        metavar='Prefix length of the destinations sharing last hops in a batch')
+    parser.add_argument('-A', '--adaptive', required=False, action='store_true',
+                        help='Time probes out after an RTO estimated per hop from their RTTs (RFC 6298), the timeout '
+                        'being its ceiling')
+    parser.add_argument('-k', '--rto_min', required=False, nargs='?', default=RTO_MIN, type=float,
+                        metavar='Floor of the adaptive timeout in ms')
+    parser.add_argument('-K', '--rto_max', required=False, nargs='?', default=None, type=float,
+                        metavar='Ceiling of the adaptive timeout in ms')
+    parser.add_argument('-W', '--monitor', required=False, default=None,
+                        metavar='Store of the last known paths; monitor them for changes')
+    parser.add_argument('-i', '--interval', required=False, nargs='?', default=MONITOR_INTERVAL, type=float,
+                        metavar='Seconds between the cycles of the monitor')
+    parser.add_argument('-N', '--cycles', required=False, nargs='?', default=0, type=int,
+                        metavar='Cycles of the monitor, 0 to run until interrupted')
+    parser.add_argument('-s', '--sample', required=False, nargs='?', default=MONITOR_SAMPLE, type=int,
+                        metavar='Hops the monitor checks per path and cycle, besides the last two')
+    parser.add_argument('-z', '--summary', required=False, action='store_true',
+                        help='Write loss and RTT statistics per hop instead of every probe (mtr style)')
 
     return parser
 
 
-def traceroute(destination_server, count_of_packets=3, packet_size=52, max_hops=64, timeout=1000, ttl=1, max_ttl=10):
-    t = Traceroute(destination_server, count_of_packets, packet_size, max_hops, timeout, ttl, max_ttl)
-    t.start_traceroute()
+def print_socket_error(error):
+    if error.errno == 1:
+        print("Operation not permitted: ICMP messages can only be sent from a process running as root",
+              file=sys.stderr)
+    else:
+        print("Error: {}".format(error), file=sys.stderr)
+
+
+def read_destinations(stream):
+    """The destinations listed in a stream, one per line, skipping blank
+    lines and # comments. Lines are read as they are needed."""
+    for line in stream:
+        destination = line.split("#", 1)[0].strip()
+        if destination:
+            yield destination
+
+
+def traceroute(destination_server, count_of_packets=3, packet_size=52, max_hops=64, timeout=1000, ttl=1, max_ttl=10,
+               output_format="text", output_file=None, io_statistics=False, parallel=False, numeric=False, paris=False,
+               multipath=False, confidence=95, protocol="icmp", port=None, adaptive=False, rto_min=RTO_MIN,
+               rto_max=None, summary=False):
+    sink = create_sink(output_format, output_file, count_of_packets, max_ttl)
+    try:
+        t = Traceroute(destination_server, count_of_packets, packet_size, max_hops, timeout, ttl, max_ttl, sink, parallel,
+                       numeric, paris, multipath, confidence, protocol, port, adaptive=adaptive, rto_min=rto_min,
+                       rto_max=rto_max, summary=summary)
+        try:
+            t.start_traceroute()
+        finally:
+            t.close_socket()
+        if io_statistics and t.dispatcher is not None:
+            sink.message("io: " + t.dispatcher.describe())
+            sink.message("dns: " + t.reverse_dns.describe())
+    finally:
+        sink.close()
+
+
+def batch_traceroute(destinations, count_of_packets=3, packet_size=52, max_hops=64, timeout=1000, ttl=DOUBLETREE_TTL,
+                     max_ttl=10, output_format="text", output_file=None, io_statistics=False, numeric=False,
+                     paris=False, protocol="icmp", port=None, pps=BATCH_PPS, jobs=BATCH_JOBS, prefix_length=24,
+                     adaptive=False, rto_min=RTO_MIN, rto_max=None, summary=False):
+    """Traces every destination of an iterable, `jobs` of them at once over
+    the shared dispatchers and all within one budget of `pps` probes per
+    second. Traces start at `ttl` and use Doubletree to skip the hops the
+    batch already knows. Each trace is written out once it is done.
+
+    A destination that cannot be resolved or probed is reported and the
+    batch goes on; returns how many destinations failed so."""
+    sink = create_sink(output_format, output_file, count_of_packets, max_ttl)
+    budget = TokenBucket(pps)
+    stop_set = StopSet(prefix_length)
+    totals = collections.Counter()
+
+    def run(destination):
+        buffer = TraceBuffer()
+        try:
+            t = Traceroute(destination, count_of_packets, packet_size, max_hops, timeout, ttl, max_ttl, buffer,
+                           numeric=numeric, paris=paris, protocol=protocol, port=port, budget=budget,
+                           stop_set=stop_set, adaptive=adaptive, rto_min=rto_min, rto_max=rto_max, summary=summary)
+            try:
+                t.start_traceroute()
+            finally:
+                t.close_socket()
+        except socket.error as error:
+            buffer.message("traceroute: {}: {}".format(destination, error))
+            return None, buffer
+        return (t if t.addresses else None), buffer  # None when unknown, which the trace reported
+
+    try:
+        try:
+            for t, buffer in run_concurrently(run, destinations, jobs):
+                buffer.flush_to(sink)
+                if t is None:
+                    totals["failed"] += 1
+                    continue
+                totals["destinations"] += 1
+                totals["probes"] += t.probes_sent
+        except KeyboardInterrupt:  # handles Ctrl+C, the traces under way still finish
+            pass
+
+        sink.message("{} destinations traced with {} probes, {:.1f} per destination".format(
+            totals["destinations"], totals["probes"], totals["probes"] / max(totals["destinations"], 1)))
+        if totals["failed"]:
+            sink.message("{} destinations failed".format(totals["failed"]))
+        if io_statistics:
+            for dispatcher in default_dispatchers.values():
+                if dispatcher.bulk_socket is not None:
+                    sink.message("io: " + dispatcher.describe())
+            sink.message("dns: " + default_reverse_dns.describe())
+    finally:
+        sink.close()
+    return totals["failed"]
+
+
+def monitor_paths(destinations, store_file, interval=MONITOR_INTERVAL, cycles=0, sample=MONITOR_SAMPLE,
+                  count_of_packets=3, packet_size=52, max_hops=64, timeout=1000, output_format="text", output_file=None,
+                  io_statistics=False, protocol="icmp", port=None, pps=BATCH_PPS, jobs=BATCH_JOBS, adaptive=False,
+                  rto_min=RTO_MIN, rto_max=None, summary=False):
+    """Monitors the paths to every destination of an iterable with a
+    PathMonitor, one cycle every `interval` seconds, `cycles` times or until
+    interrupted, and writes the changes found. The last known paths are
+    kept in `store_file`, so a monitor restarted later picks up where it
+    stopped. With `summary`, the statistics of every hop probed over all
+    cycles are written at the end, which csv and binary output cannot hold
+    in one file with the changes."""
+    if summary and output_format in ("csv", "binary"):
+        raise ValueError("monitor_paths: summary needs text or jsonl output")
+    sink = create_sink(output_format, output_file, count_of_packets)
+    store = PathStore(store_file)
+    store.load()
+    path_monitor = PathMonitor(store, sink, sample)
+    budget = TokenBucket(pps)
+    traces = []
+    try:
+        for destination in destinations:
+            t = Traceroute(destination, count_of_packets, packet_size, max_hops, timeout, 1, max_hops, sink,
+                           numeric=True, paris=True, protocol=protocol, port=port, budget=budget, adaptive=adaptive,
+                           rto_min=rto_min, rto_max=rto_max)
+            if t.addresses:  # its socket is opened by the first check
+                traces.append(t)
+
+        try:
+            while cycles <= 0 or path_monitor.totals["cycles"] < cycles:
+                start = timer()
+                changed = path_monitor.cycle(traces, jobs)
+                sink.message("cycle {}: {} of {} paths changed, {} probes and {} errors so far".format(
+                    path_monitor.totals["cycles"], changed, len(traces), path_monitor.totals["probes"],
+                    path_monitor.totals["errors"]))
+                if cycles <= 0 or path_monitor.totals["cycles"] < cycles:
+                    time.sleep(max(0.0, start + interval - timer()))
+        except KeyboardInterrupt:  # handles Ctrl+C
+            pass
+
+        if summary:
+            for t in traces:
+                t.print_summary()
+        if io_statistics:
+            for dispatcher in default_dispatchers.values():
+                if dispatcher.bulk_socket is not None:
+                    sink.message("io: " + dispatcher.describe())
+    finally:
+        for t in traces:
+            t.close_socket()
+        sink.close()
+
+
+def main(argv=None):
+    try:
+        parser = create_parser()
+        args = parser.parse_args(argv)
+        if args.multipath and args.protocol == 'tcp':
+            # the flow of a SYN probe is its ports, and the port is the service probed
+            parser.error("argument -M/--multipath: not allowed with argument -T/--tcp")
+        if args.destination_server is None and args.file is None:
+            parser.error("a destination_server or -f/--file is required")
+        if args.file is not None and args.monitor is None:
+            # a batch traces hop by hop with Doubletree
+            for flag, name in ((args.parallel, "-P/--parallel"), (args.multipath, "-M/--multipath")):
+                if flag:
+                    parser.error("argument {}: not allowed with argument -f/--file".format(name))
+        if args.monitor is not None and args.summary and args.output_format in ("csv", "binary"):
+            # one csv header or binary record layout cannot cover both the changes and the statistics
+            parser.error("argument -z/--summary: not allowed with argument -W/--monitor and {} output".format(
+                args.output_format))
+        destination_server = args.destination_server
+        timeout = args.timeout
+        packet_size = args.packet_size
+        count = args.count
+        max_hops = args.maxhops
+        ttl = args.ttl
+        max_ttl = args.max_ttl
+        if args.monitor is not None:
+            destinations = [destination_server]
+            if args.file is not None:
+                with sys.stdin if args.file == '-' else open(args.file) as stream:
+                    destinations = list(read_destinations(stream))
+            monitor_paths(destinations, args.monitor, args.interval, args.cycles, args.sample, count, packet_size,
+                          max_hops, timeout, args.output_format, args.output_file, args.io_statistics, args.protocol,
+                          args.port, args.pps, args.jobs, args.adaptive, args.rto_min, args.rto_max, args.summary)
+            return
+        if args.file is not None:
+            stream = sys.stdin if args.file == '-' else open(args.file)
+            with stream:
+                failed = batch_traceroute(read_destinations(stream), count, packet_size, max_hops, timeout,
+                                          DOUBLETREE_TTL if ttl is None else ttl, max_ttl, args.output_format,
+                                          args.output_file, args.io_statistics, args.numeric, args.paris, args.protocol,
+                                          args.port, args.pps, args.jobs, args.prefix_length, args.adaptive,
+                                          args.rto_min, args.rto_max, args.summary)
+            return 1 if failed else 0
+        if ttl is None:
+            ttl = 1
+        traceroute(destination_server, count, packet_size, max_hops, timeout, ttl, max_ttl, args.output_format,
+                   args.output_file, args.io_statistics, args.parallel, args.numeric, args.paris, args.multipath,
+                   args.confidence, args.protocol, args.port, args.adaptive, args.rto_min, args.rto_max, args.summary)
+    finally:
+        for dispatcher in default_dispatchers.values():
+            dispatcher.close()
 
 
 if __name__ == '__main__':
-    parser = create_parser()
-    args = parser.parse_args(sys.argv[1:])
-    destination_server = args.destination_server
-    timeout = args.timeout
-    packet_size = args.packet_size
-    count = args.count
-    max_hops = args.maxhops
-    ttl = args.ttl
-    max_ttl = args.max_ttl
-    traceroute(destination_server, count, packet_size, max_hops, timeout, ttl, max_ttl)
\ No newline at end of file
+    try:
+        sys.exit(main())
+    except socket.error as error:
+        print_socket_error(error)
+        sys.exit()
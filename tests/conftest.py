@@ -0,0 +1,28 @@
+"""Puts the shared package and the tool directories on sys.path, as each
+tool does for itself when run as a script."""
+
+import os
+import sys
+import importlib.util
+
+import pytest
+
+SRC = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+for directory in ("ping", "traceroute", ""):
+    sys.path.insert(0, os.path.join(SRC, directory))
+
+
+@pytest.fixture(scope="session")
+def port_sniffer():
+    """The port sniffer as a module. Its file name is no module name and it
+    parses its arguments on import, so it is loaded with the defaults."""
+    spec = importlib.util.spec_from_file_location("port_sniffer", os.path.join(SRC, "port-sniffer",
+                                                                               "port-sniffer.py"))
+    module = importlib.util.module_from_spec(spec)
+    argv, sys.argv = sys.argv, ["port-sniffer.py"]
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        sys.argv = argv
+    return module
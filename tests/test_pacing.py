@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+from common.pacing import RTO_MIN, RtoEstimator, TokenBucket
+
+
+def test_rto_before_any_sample():
+    assert RtoEstimator(1000).rto == 1000
+    assert RtoEstimator(10).rto == RTO_MIN
+    assert RtoEstimator(5000, ceiling=2000).rto == 2000
+
+
+def test_rto_follows_rfc_6298():
+    rto = RtoEstimator(1000, floor=0, granularity=1.0)
+    rto.sample(100.0)
+    # SRTT = R, RTTVAR = R / 2, RTO = SRTT + max(G, 4 * RTTVAR)
+    assert (rto.srtt, rto.rttvar, rto.rto) == (100.0, 50.0, 300.0)
+    rto.sample(60.0)
+    rttvar = 0.75 * 50.0 + 0.25 * 40.0
+    srtt = 0.875 * 100.0 + 0.125 * 60.0
+    assert rto.rttvar == pytest.approx(rttvar)
+    assert rto.srtt == pytest.approx(srtt)
+    assert rto.rto == pytest.approx(srtt + 4 * rttvar)
+
+
+def test_rto_granularity_and_bounds():
+    rto = RtoEstimator(1000, floor=0, granularity=10.0)
+    for _ in range(100):
+        rto.sample(5.0)
+    assert rto.rto == pytest.approx(15.0)  # RTTVAR decays, G remains
+
+    rto = RtoEstimator(1000)
+    rto.sample(0.1)
+    assert rto.rto == RTO_MIN
+    rto = RtoEstimator(1000, ceiling=2000)
+    rto.sample(5000.0)
+    assert rto.rto == 2000
+
+
+def test_rto_backoff():
+    rto = RtoEstimator(100, floor=50, ceiling=1000)
+    rto.backoff()
+    assert rto.rto == 200
+    for _ in range(5):
+        rto.backoff()
+    assert rto.rto == 1000
+    rto.sample(20.0)  # a sample ends the backoff
+    assert rto.rto == 60.0
+
+
+def test_token_bucket_paces():
+    bucket = TokenBucket(1000, burst=5)
+    for _ in range(5):
+        assert bucket.delay() == 0
+        bucket.consume()
+    assert 0 < bucket.delay() <= 0.001
+    start = time.monotonic()
+    for _ in range(20):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.015
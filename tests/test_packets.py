@@ -0,0 +1,42 @@
+import random
+import struct
+
+from common.packets import EchoPacketBuilder, calculate_checksum, update_checksum
+
+
+def test_checksum_of_known_header():
+    # the IPv4 header of RFC 1071's usual worked example
+    header = bytes.fromhex("4500003c1c4640004006" "0000" "ac100a63ac100a0c")
+    assert calculate_checksum(header) == 0xb1e6
+
+
+def test_checksum_pads_odd_length():
+    assert calculate_checksum(b"\x12\x34\x56") == calculate_checksum(b"\x12\x34\x56\x00")
+
+
+def test_update_checksum_matches_recomputing():
+    rng = random.Random(1624)
+    for _ in range(500):
+        packet = bytearray(rng.randbytes(2 * rng.randint(4, 64)))
+        checksum = calculate_checksum(packet)
+        offset = 2 * rng.randrange(len(packet) // 2)
+        old_word, = struct.unpack_from("!H", packet, offset)
+        new_word = rng.choice((0, 0xffff, rng.randrange(0x10000)))
+        struct.pack_into("!H", packet, offset, new_word)
+        assert update_checksum(checksum, old_word, new_word) == calculate_checksum(packet)
+
+
+def test_built_echo_requests_verify():
+    builder = EchoPacketBuilder(0x1234, 55)
+    for seq_no in (0, 1, 0xfffe, 0xffff, 7):
+        packet = builder.build(seq_no, identifier=seq_no ^ 0x5555)
+        assert calculate_checksum(packet) == 0
+        assert struct.unpack_from("!HH", packet, 4) == (seq_no ^ 0x5555, seq_no)
+
+
+def test_build_pins_checksum():
+    builder = EchoPacketBuilder(0x1234, 55)
+    for seq_no in range(1, 20):
+        packet = builder.build(seq_no, checksum=0xbeef)
+        assert struct.unpack_from("!H", packet, 2) == (0xbeef, )
+        assert calculate_checksum(packet) == 0
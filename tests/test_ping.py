@@ -0,0 +1,119 @@
+import math
+import random
+import sys
+import socket
+import struct
+import statistics
+
+import pytest
+
+from ping import RttStatistics, parse_datagram_echo_reply, parse_echo_reply, parse_echo_reply6
+
+
+def ipv4_packet(payload, ttl=57, options=b""):
+    header_length = 20 + len(options)
+    header = struct.pack("!BBHHHBBH4s4s", 0x40 | header_length // 4, 0, header_length + len(payload), 0, 0, ttl,
+                         socket.IPPROTO_ICMP, 0, socket.inet_aton("192.0.2.1"), socket.inet_aton("192.0.2.2"))
+    return header + options + payload
+
+
+def icmp_message(icmp_type, identifier, seq_no, data_len):
+    return struct.pack("!BBHHH", icmp_type, 0, 0, identifier, seq_no) + bytes(data_len)
+
+
+def test_parse_echo_reply():
+    packet = ipv4_packet(icmp_message(0, 0x1234, 7, 55))
+    assert parse_echo_reply(packet) == (0x1234, 7, 57, 55)
+    assert parse_echo_reply(memoryview(packet)) == (0x1234, 7, 57, 55)
+
+
+def test_parse_echo_reply_skips_ip_options():
+    # a record route option, padded to a multiple of 4 bytes
+    packet = ipv4_packet(icmp_message(0, 0x1234, 8, 55), options=bytes([7, 7, 4]) + bytes(5))
+    assert parse_echo_reply(packet) == (0x1234, 8, 57, 55)
+
+
+def test_parse_echo_reply_ignores_other_packets():
+    assert parse_echo_reply(ipv4_packet(icmp_message(8, 0x1234, 7, 55))) is None  # our own request
+    assert parse_echo_reply(ipv4_packet(icmp_message(11, 0, 0, 28))) is None
+    assert parse_echo_reply(ipv4_packet(b"\0\0\0")) is None  # truncated ICMP header
+    assert parse_echo_reply(b"\x45" + bytes(10)) is None
+
+
+def test_parse_headerless_echo_replies():
+    ttl = [(socket.IPPROTO_IP, socket.IP_TTL, (63).to_bytes(4, sys.byteorder))]
+    assert parse_datagram_echo_reply(icmp_message(0, 40000, 3, 16), ttl) == (40000, 3, 63, 16)
+    assert parse_datagram_echo_reply(icmp_message(0, 40000, 3, 16)) == (40000, 3, 0, 16)
+    assert parse_datagram_echo_reply(icmp_message(8, 40000, 3, 16)) is None
+
+    hop_limit = [(socket.IPPROTO_IPV6, socket.IPV6_HOPLIMIT, ttl[0][2])]
+    assert parse_echo_reply6(icmp_message(129, 0x4321, 9, 0), hop_limit) == (0x4321, 9, 63, 0)
+    assert parse_echo_reply6(icmp_message(128, 0x4321, 9, 0), hop_limit) is None
+    assert parse_echo_reply6(b"\x81\0") is None
+
+
+def rtt_statistics(delays):
+    result = RttStatistics()
+    for delay in delays:
+        result.add(delay)
+    return result
+
+
+def test_rtt_statistics_moments():
+    delays = [0.5, 1.25, 3.0, 0.75, 10.0, 2.5]
+    result = rtt_statistics(delays)
+    assert result.count == len(delays)
+    assert result.min_delay == 0.5
+    assert result.max_delay == 10.0
+    assert result.mean == pytest.approx(statistics.mean(delays))
+    assert result.stddev == pytest.approx(statistics.stdev(delays))
+    assert result.mdev == pytest.approx(statistics.pstdev(delays))
+
+
+def test_rtt_statistics_jitter():
+    # RFC 3550: J += (|D| - J) / 16 for each difference D
+    result = rtt_statistics([1.0, 3.0, 2.0])
+    jitter = (2.0 - 0.0) / 16
+    jitter += (1.0 - jitter) / 16
+    assert result.jitter == pytest.approx(jitter)
+
+
+def test_empty_rtt_statistics():
+    result = RttStatistics()
+    assert result.percentile(50) is None
+    assert result.stddev == 0.0
+    assert result.mdev == 0.0
+
+
+def test_histogram_buckets():
+    result = RttStatistics()
+    assert result.bucket_index(0.0) == 0
+    assert result.bucket_index(RttStatistics.MIN_DELAY) == 0
+    assert result.bucket_index(1e12) == RttStatistics.BUCKETS - 1
+    delays = [0.002 * 1.01**i for i in range(1000)]
+    assert [result.bucket_index(delay) for delay in delays] == sorted(result.bucket_index(delay) for delay in delays)
+
+
+def test_percentiles_within_accuracy():
+    rng = random.Random(3550)
+    delays = [rng.lognormvariate(0, 1) for _ in range(20000)]
+    result = rtt_statistics(delays)
+    delays.sort()
+    for percent in (50, 90, 99, 99.9):
+        exact = delays[max(1, math.ceil(len(delays) * percent / 100)) - 1]
+        assert result.percentile(percent) == pytest.approx(exact, rel=RttStatistics.ACCURACY)
+    assert result.percentile(100) <= delays[-1]
+
+
+def test_merge_equals_one_pass():
+    rng = random.Random(6)
+    first = [rng.uniform(0.1, 5.0) for _ in range(300)]
+    second = [rng.uniform(2.0, 40.0) for _ in range(700)]
+    merged = rtt_statistics(first).merge(rtt_statistics(second))
+    single = rtt_statistics(first + second)
+    assert merged.count == single.count
+    assert merged.mean == pytest.approx(single.mean)
+    assert merged.stddev == pytest.approx(single.stddev)
+    assert (merged.min_delay, merged.max_delay) == (single.min_delay, single.max_delay)
+    assert list(merged.buckets) == list(single.buckets)
+    assert rtt_statistics(first).merge(RttStatistics()).count == len(first)
@@ -0,0 +1,191 @@
+import sys
+import socket
+import struct
+import ipaddress
+import threading
+
+import pytest
+
+from common.packets import calculate_checksum
+
+
+def test_scan_state(port_sniffer):
+    ports = port_sniffer.PortList([range(20, 26), range(80, 81), range(8000, 8010)])
+    state = port_sniffer.ScanState(ports)
+    state.set("192.0.2.1", 22, port_sniffer.OPEN)
+    state.set("192.0.2.1", 8009, port_sniffer.OPEN)
+    state.set("192.0.2.1", 80, port_sniffer.CLOSED)
+    state.set("192.0.2.2", 80, port_sniffer.FILTERED)
+
+    assert state.status("192.0.2.1", 22) == port_sniffer.OPEN
+    assert state.status("192.0.2.1", 8009) == port_sniffer.OPEN
+    assert state.status("192.0.2.1", 80) == port_sniffer.CLOSED
+    assert state.status("192.0.2.1", 23) == port_sniffer.FILTERED
+    assert state.status("192.0.2.3", 22) == port_sniffer.FILTERED
+    assert "192.0.2.2" not in state.hosts  # a host that never answered costs nothing
+    assert (state.count(port_sniffer.OPEN), state.count(port_sniffer.CLOSED)) == (2, 1)
+
+    # a port answering differently from one check to the next
+    state.set("192.0.2.1", 22, port_sniffer.CLOSED)
+    state.set("192.0.2.1", 80, port_sniffer.OPEN_FILTERED)
+    assert state.status("192.0.2.1", 22) == port_sniffer.CLOSED
+    assert state.status("192.0.2.1", 80) == port_sniffer.FILTERED
+    assert (state.count(port_sniffer.OPEN), state.count(port_sniffer.CLOSED)) == (1, 1)
+
+
+def test_scan_state_snapshot(port_sniffer):
+    state = port_sniffer.ScanState(port_sniffer.PortList([range(1, 1025)]))
+    state.set("192.0.2.1", 443, port_sniffer.OPEN)
+    previous = state.snapshot()
+    state.clear()
+    state.set("192.0.2.1", 80, port_sniffer.OPEN)
+
+    assert previous.status("192.0.2.1", 443) == port_sniffer.OPEN
+    assert previous.status("192.0.2.1", 80) == port_sniffer.FILTERED
+    assert state.status("192.0.2.1", 443) == port_sniffer.FILTERED
+    assert previous.count(port_sniffer.OPEN) == state.count(port_sniffer.OPEN) == 1
+
+
+def test_port_list_parse(port_sniffer):
+    parse = port_sniffer.PortList.parse
+    assert list(parse("80")) == [80]
+    assert list(parse("443, 22,80")) == [22, 80, 443]
+    assert list(parse("8000-8003,8002-8005,8006")) == list(range(8000, 8007))
+    assert list(parse("22,22,20-25")) == list(range(20, 26))
+    assert list(parse("-3")) == [1, 2, 3]
+    assert list(parse("65534-")) == [65534, 65535]
+    assert len(parse("-")) == 65535
+
+
+@pytest.mark.parametrize("spec", ["", "http", "0", "65536", "10-5", "1-2-3", "22,,80"])
+def test_port_list_parse_rejects(port_sniffer, spec):
+    with pytest.raises(ValueError):
+        port_sniffer.PortList.parse(spec)
+
+
+def test_port_list_top_and_between(port_sniffer):
+    assert list(port_sniffer.PortList.top([80, 23, 443], 2)) == [80, 23]
+    assert len(port_sniffer.PortList.top(port_sniffer.TOP_TCP_PORTS, 100)) == 100
+    assert list(port_sniffer.PortList.parse("20-30,8000-8100").between(25, 8002)) == [25, 26, 27, 28, 29, 30,
+                                                                                          8000, 8001, 8002]
+
+
+def test_scan_targets_interleave_hosts(port_sniffer):
+    networks = [ipaddress.ip_network("192.0.2.0/30"), ipaddress.ip_network("198.51.100.7")]
+    targets = list(port_sniffer.scanTargets(networks, port_sniffer.PortList.parse("22,80,443")))
+    hosts = ["192.0.2.1", "192.0.2.2", "198.51.100.7"]
+    assert targets == [(ip, port) for port in (22, 80, 443) for ip in hosts]
+    # every host is reached within the first len(hosts) targets, not after all the ports of the first
+    assert {ip for ip, port in targets[:len(hosts)]} == set(hosts)
+
+
+@pytest.mark.parametrize("conntype, ranked", [("tcp", 100), ("udp", 50)])
+def test_top_ports_beyond_the_ranking(port_sniffer, monkeypatch, conntype, ranked):
+    monkeypatch.setattr(port_sniffer, "top_ports", ranked)
+    assert len(port_sniffer.portList(conntype)) == ranked
+    monkeypatch.setattr(port_sniffer, "top_ports", ranked + 1)
+    with pytest.raises(ValueError):
+        port_sniffer.portList(conntype)
+
+
+def syn_scanner(port_sniffer, sport=40000):
+    scanner = port_sniffer.SynScanner(1000, 1)
+    scanner.sport = sport  # set by scan() from the port it reserves
+    return scanner
+
+
+def test_syn_cookie(port_sniffer):
+    scanner = syn_scanner(port_sniffer)
+    cookie = scanner.cookie("192.0.2.1", 80)
+    assert cookie == scanner.cookie("192.0.2.1", 80)
+    assert 0 <= cookie <= 0xffffffff
+    assert len({scanner.cookie("192.0.2.1", port) for port in range(1, 1001)}) > 990
+    assert cookie != scanner.cookie("192.0.2.2", 80)
+    # another scan draws another key
+    assert cookie != syn_scanner(port_sniffer).cookie("192.0.2.1", 80)
+
+
+def test_syn_checksum(port_sniffer):
+    scanner = syn_scanner(port_sniffer)
+    segment = scanner.syn("127.0.0.1", 443)
+    sport, dport, seq, ack, offset, flags = struct.unpack_from("!HHIIBB", segment)
+    assert (sport, dport, seq, ack) == (40000, 443, scanner.cookie("127.0.0.1", 443), 0)
+    assert (offset >> 4) * 4 == len(segment) == 24
+    assert flags == port_sniffer.TCP_SYN
+    pseudo = struct.pack("!4s4sxBH", socket.inet_aton("127.0.0.1"), socket.inet_aton("127.0.0.1"),
+                         socket.IPPROTO_TCP, len(segment))
+    assert calculate_checksum(pseudo + segment) == 0
+
+
+@pytest.fixture
+def listener():
+    """A listening TCP port on localhost and a closed one."""
+    with socket.socket() as listening, socket.socket() as closed:
+        listening.bind(("127.0.0.1", 0))
+        listening.listen(16)
+        closed.bind(("127.0.0.1", 0))  # bound but not listening, so refused
+        yield listening.getsockname()[1], closed.getsockname()[1]
+
+
+def test_connect_scan(port_sniffer, listener):
+    open_port, closed_port = listener
+    scanner = port_sniffer.ConnectScanner(1)
+    results = set(scanner.scan([("127.0.0.1", open_port), ("127.0.0.1", closed_port)]))
+    assert results == {("127.0.0.1", open_port, port_sniffer.OPEN), ("127.0.0.1", closed_port, port_sniffer.CLOSED)}
+    assert not scanner.connecting
+
+
+def test_connect_scan_caps(port_sniffer, listener):
+    open_port, closed_port = listener
+    scanner = port_sniffer.ConnectScanner(1, max_inflight=5, per_host=3)
+    peaks = {"inflight": 0, "per host": 0}
+    connect = scanner.connect
+
+    def counted_connect(ip, port, attempt, results):
+        connect(ip, port, attempt, results)
+        peaks["inflight"] = max(peaks["inflight"], len(scanner.connecting))
+        peaks["per host"] = max(peaks["per host"], max(scanner.host_connects.values()))
+
+    scanner.connect = counted_connect
+    targets = [(ip, port) for port in (closed_port, open_port) * 10 for ip in ("127.0.0.1", "127.0.0.2")]
+    results = list(scanner.scan(targets))
+    assert sorted((ip, port) for ip, port, status in results) == sorted(targets)
+    assert peaks == {"inflight": 5, "per host": 3}
+
+
+@pytest.mark.parametrize("origin, icmp_type, code, status", [
+    (2, 3, 3, "closed"),  # port unreachable
+    (2, 3, 1, "filtered"),  # host unreachable
+    (2, 3, 13, "filtered"),  # administratively prohibited
+    (2, 11, 0, None),  # time exceeded tells nothing of the port
+    (3, 1, 4, "closed"),  # ICMPv6 port unreachable
+    (3, 1, 1, "filtered"),
+    (3, 3, 0, None),
+    (1, 3, 3, None),  # a local error, not an ICMP one
+])
+def test_udp_classify(port_sniffer, origin, icmp_type, code, status):
+    assert port_sniffer.UdpScanner.classify(origin, icmp_type, code) == status
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="reads ICMP errors with IP_RECVERR")
+def test_udp_scan(port_sniffer):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as echo, \
+            socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as silent, \
+            socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as closed:
+        for sock in (echo, silent, closed):
+            sock.bind(("127.0.0.1", 0))
+        ports = [sock.getsockname()[1] for sock in (echo, silent, closed)]
+        closed.close()  # nothing listens there, the kernel answers port unreachable
+
+        def answer():
+            data, address = echo.recvfrom(512)
+            echo.sendto(data, address)
+
+        threading.Thread(target=answer, daemon=True).start()
+        results = set(port_sniffer.UdpScanner(0.5).scan([("127.0.0.1", port) for port in ports]))
+
+    assert results == {
+        ("127.0.0.1", ports[0], port_sniffer.OPEN),
+        ("127.0.0.1", ports[1], port_sniffer.OPEN_FILTERED),
+        ("127.0.0.1", ports[2], port_sniffer.CLOSED),
+    }
@@ -0,0 +1,137 @@
+import io
+import json
+import struct
+from collections import namedtuple
+
+import pytest
+
+from common.sinks import (BinarySink, CsvSink, JsonLinesSink, ResultSink, address_to_bytes, bytes_to_address,
+                          create_sink)
+
+Record = namedtuple("Record", "host seq rtt responders")
+
+
+def pack(record):
+    return address_to_bytes(record.host) + struct.pack("!Hd", record.seq, record.rtt)
+
+
+class Unclosed(io.StringIO):
+    """Keeps the written text readable after the sink closes its stream."""
+
+    def close(self):
+        pass
+
+
+class Unencodable(ResultSink):
+    def encode(self, record):
+        raise ValueError("cannot encode %r" % (record,))
+
+
+def test_json_lines_sink():
+    stream = Unclosed()
+    sink = JsonLinesSink(stream)
+    sink.write(Record("192.0.2.1", 1, 1.5, ("192.0.2.7", "192.0.2.8")))
+    sink.write(Record("2001:db8::1", 2, None, ()))
+    sink.close()
+
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert lines == [
+        {"host": "192.0.2.1", "seq": 1, "rtt": 1.5, "responders": ["192.0.2.7", "192.0.2.8"]},
+        {"host": "2001:db8::1", "seq": 2, "rtt": None, "responders": []},
+    ]
+
+
+def test_csv_sink_writes_header_once():
+    stream = Unclosed()
+    sink = CsvSink(stream)
+    sink.write(Record("192.0.2.1", 1, 1.5, ("192.0.2.7", "192.0.2.8")))
+    sink.write(Record("192.0.2.1", 2, None, ()))
+    sink.close()
+
+    assert stream.getvalue().splitlines() == [
+        "host,seq,rtt,responders",
+        "192.0.2.1,1,1.5,192.0.2.7 192.0.2.8",
+        "192.0.2.1,2,,",
+    ]
+
+
+def test_binary_sink_packs_fixed_size_records():
+    stream = io.BytesIO()
+    stream.close = lambda: None
+    sink = BinarySink(stream, pack)
+    sink.write(Record("192.0.2.1", 1, 1.5, ()))
+    sink.write(Record("2001:db8::1", 2, float("nan"), ()))
+    sink.close()
+
+    data = stream.getvalue()
+    assert len(data) == 2 * 26
+    assert bytes_to_address(data[:16]) == "192.0.2.1"
+    assert struct.unpack("!Hd", data[16:26]) == (1, 1.5)
+    assert bytes_to_address(data[26:42]) == "2001:db8::1"
+    seq, rtt = struct.unpack("!Hd", data[42:])
+    assert seq == 2 and rtt != rtt
+
+
+@pytest.mark.parametrize("address", ["192.0.2.1", "10.0.0.255", "2001:db8::1", "::1", None])
+def test_address_bytes_round_trip(address):
+    packed = address_to_bytes(address)
+    assert len(packed) == 16
+    assert bytes_to_address(packed) == address
+
+
+def test_ipv4_is_mapped_into_ipv6():
+    assert address_to_bytes("192.0.2.1") == bytes(10) + b"\xff\xff" + bytes([192, 0, 2, 1])
+    assert address_to_bytes(None) == bytes(16)
+
+
+@pytest.mark.parametrize("output_format, sink_type", [
+    ("jsonl", JsonLinesSink),
+    ("csv", CsvSink),
+    ("binary", BinarySink),
+])
+def test_create_sink_writes_to_file(tmp_path, output_format, sink_type):
+    path = tmp_path / ("results." + output_format)
+    sink = create_sink(output_format, str(path), None, pack)
+    assert type(sink) is sink_type
+    sink.write(Record("192.0.2.1", 1, 1.5, ()))
+    sink.close()
+
+    if output_format == "binary":
+        data = path.read_bytes()
+        assert len(data) == 26 and bytes_to_address(data[:16]) == "192.0.2.1"
+    elif output_format == "csv":
+        assert path.read_text().splitlines() == ["host,seq,rtt,responders", "192.0.2.1,1,1.5,"]
+    else:
+        assert json.loads(path.read_text())["host"] == "192.0.2.1"
+
+
+def test_create_sink_text_uses_the_tools_sink(tmp_path):
+    path = tmp_path / "results.txt"
+    streams = []
+    sink = create_sink("text", str(path), lambda stream: streams.append(stream) or "text sink", pack)
+    assert sink == "text sink"
+    assert streams[0].name == str(path) and "b" not in streams[0].mode
+    streams[0].close()
+
+
+def test_encode_error_is_raised_by_flush():
+    sink = Unencodable(Unclosed())
+    sink.write(Record("192.0.2.1", 1, 1.5, ()))
+    with pytest.raises(ValueError):
+        sink.flush()
+    # The writer survives, so later records and close() do not hang.
+    sink.write(Record("192.0.2.1", 2, 1.5, ()))
+    with pytest.raises(ValueError):
+        sink.close()
+    assert not sink.writer.is_alive()
+
+
+def test_encode_error_is_raised_by_close():
+    stream = Unclosed()
+    sink = Unencodable(stream)
+    for seq in range(3):
+        sink.write(Record("192.0.2.1", seq, 1.5, ()))
+    with pytest.raises(ValueError):
+        sink.close()
+    assert stream.getvalue() == ""
+    assert not sink.writer.is_alive()
@@ -0,0 +1,333 @@
+import concurrent.futures
+import math
+import socket
+import struct
+import types
+
+import pytest
+
+import traceroute
+from traceroute import (ICMP_DEST_UNREACHABLE, ICMP_ECHO, ICMP_ECHO_REPLY, ICMP_TIME_EXCEEDED, ICMPV6_ECHO_REQUEST,
+                        ICMPV6_TIME_EXCEEDED, PATH_RECORD, HopSamples, KnownPath, PathStore, ProbeReply,
+                        ReverseDnsCache, StopSet, TraceBuffer, Traceroute, decode_reply, mda_stopping_point,
+                        print_socket_error)
+
+
+def ipv4_header(protocol, payload_length, options=b""):
+    header_length = 20 + len(options)
+    return struct.pack("!BBHHHBBH4s4s", 0x40 | header_length // 4, 0, header_length + payload_length, 0, 0, 1,
+                       protocol, 0, socket.inet_aton("192.0.2.1"), socket.inet_aton("198.51.100.7")) + options
+
+
+def ipv4_packet(protocol, payload, options=b""):
+    return ipv4_header(protocol, len(payload), options) + payload
+
+
+def icmp_message(icmp_type, code=0, identifier=0, seq_no=0, payload=b""):
+    return struct.pack("!BBHHH", icmp_type, code, 0, identifier, seq_no) + payload
+
+
+def icmp_error(icmp_type, quoted, code=0):
+    """An ICMPv4 error quoting `quoted`, whose unused word is zero."""
+    return ipv4_packet(socket.IPPROTO_ICMP, icmp_message(icmp_type, code, payload=quoted))
+
+
+def test_decode_echo_reply():
+    packet = ipv4_packet(socket.IPPROTO_ICMP, icmp_message(ICMP_ECHO_REPLY, 0, 0x1234, 0x0305, bytes(55)))
+    assert decode_reply(socket.AF_INET, packet) == (ICMP_ECHO_REPLY, 0, socket.IPPROTO_ICMP, 0x1234, 0x0305)
+    assert isinstance(decode_reply(socket.AF_INET, memoryview(packet)), ProbeReply)
+
+
+def test_decode_quoted_echo_request():
+    quoted = ipv4_packet(socket.IPPROTO_ICMP, icmp_message(ICMP_ECHO, 0, 0x1234, 0x0502, bytes(55)))
+    reply = decode_reply(socket.AF_INET, icmp_error(ICMP_TIME_EXCEEDED, quoted))
+    assert reply == (ICMP_TIME_EXCEEDED, 0, socket.IPPROTO_ICMP, 0x1234, 0x0502)
+
+
+def test_decode_quoted_udp_and_tcp_probes():
+    # only the first 8 bytes of the transport header need to be quoted
+    udp = ipv4_packet(socket.IPPROTO_UDP, struct.pack("!HHHH", 40000, 33434, 60, 0x0701))
+    reply = decode_reply(socket.AF_INET, icmp_error(ICMP_DEST_UNREACHABLE, udp, code=3))
+    assert reply == (ICMP_DEST_UNREACHABLE, 3, socket.IPPROTO_UDP, 40000, 0x0701)
+
+    tcp = ipv4_packet(socket.IPPROTO_TCP, struct.pack("!HHI", 40001, 80, 0xdeadbeef))
+    reply = decode_reply(socket.AF_INET, icmp_error(ICMP_TIME_EXCEEDED, tcp))
+    assert reply == (ICMP_TIME_EXCEEDED, 0, socket.IPPROTO_TCP, 40001, 0xdeadbeef)
+
+
+def test_decode_skips_ip_options():
+    options = bytes([1, 1, 1, 1])  # no-ops
+    quoted = ipv4_packet(socket.IPPROTO_ICMP, icmp_message(ICMP_ECHO, 0, 0x1234, 0x0101), options)
+    packet = ipv4_packet(socket.IPPROTO_ICMP, icmp_message(ICMP_TIME_EXCEEDED, payload=quoted), options)
+    assert decode_reply(socket.AF_INET, packet) == (ICMP_TIME_EXCEEDED, 0, socket.IPPROTO_ICMP, 0x1234, 0x0101)
+
+
+def test_decode_ipv6_time_exceeded():
+    # ICMPv6 raw sockets receive no IP header, the quoted one is a fixed 40 bytes
+    quoted = struct.pack("!IHBB", 6 << 28, 8, socket.IPPROTO_ICMPV6, 1) + bytes(32)
+    quoted += icmp_message(ICMPV6_ECHO_REQUEST, 0, 0x4321, 0x0203)
+    reply = decode_reply(socket.AF_INET6, icmp_message(ICMPV6_TIME_EXCEEDED, payload=quoted))
+    assert reply == (ICMPV6_TIME_EXCEEDED, 0, socket.IPPROTO_ICMP, 0x4321, 0x0203)
+
+
+def test_decode_rejects_other_packets():
+    assert decode_reply(socket.AF_INET, ipv4_packet(socket.IPPROTO_ICMP, icmp_message(ICMP_ECHO))) is None
+    assert decode_reply(socket.AF_INET, ipv4_packet(socket.IPPROTO_ICMP, b"\0\0")) is None
+    assert decode_reply(socket.AF_INET, b"\x45" + bytes(10)) is None
+    # an error quoting somebody else's echo reply, or too little of a probe
+    reply = ipv4_packet(socket.IPPROTO_ICMP, icmp_message(ICMP_ECHO_REPLY, 0, 1, 1))
+    assert decode_reply(socket.AF_INET, icmp_error(ICMP_TIME_EXCEEDED, reply)) is None
+    udp = ipv4_packet(socket.IPPROTO_UDP, struct.pack("!HH", 40000, 33434))
+    assert decode_reply(socket.AF_INET, icmp_error(ICMP_TIME_EXCEEDED, udp)) is None
+    gre = ipv4_packet(47, bytes(8))
+    assert decode_reply(socket.AF_INET, icmp_error(ICMP_TIME_EXCEEDED, gre)) is None
+
+
+def test_mda_stopping_points():
+    # the table of Veitch et al., "Failure control in multipath route tracing", at 95%
+    assert [mda_stopping_point(k) for k in range(1, 11)] == [6, 11, 16, 21, 27, 33, 38, 44, 51, 57]
+    assert [mda_stopping_point(k, 99) for k in range(1, 4)] == [8, 15, 21]
+
+
+def test_mda_stopping_point_is_the_fewest_probes():
+    # the chance that n flows spread evenly over k + 1 next hops miss one of them
+    def missed(hops, probes):
+        return sum((-1)**(i + 1) * math.comb(hops, i) * ((hops - i) / hops)**probes for i in range(1, hops + 1))
+
+    for confidence in (90, 95, 99):
+        for successors in range(1, 8):
+            probes = mda_stopping_point(successors, confidence)
+            assert missed(successors + 1, probes) <= 1 - confidence / 100 < missed(successors + 1, probes - 1)
+
+
+def test_path_store_round_trip(tmp_path):
+    path = str(tmp_path / "paths")
+    store = PathStore(path)
+    store.load()  # no file yet
+    assert store.paths == {}
+
+    paths = {
+        "example.com": KnownPath(("192.0.2.1", None, "198.51.100.7"), True, 1700000000.25),
+        "2001:db8::7": KnownPath(("2001:db8::1", None, None, "2001:db8::7"), False, 1700000001.5),
+        "d\u00e9j\u00e0.example": KnownPath((), False, 0.0),
+    }
+    for destination, known in paths.items():
+        store.put(destination, known)
+    store.save()
+
+    loaded = PathStore(path)
+    loaded.load()
+    assert loaded.paths == paths
+    assert loaded.get("example.com").hops[1] is None
+    assert not (tmp_path / "paths.tmp").exists()
+
+
+@pytest.mark.parametrize("damage", [
+    lambda data: data[:-1],  # a hop cut short
+    lambda data: data[:5],  # a record header cut short
+    lambda data: data[:PATH_RECORD.size + 3],  # a name cut short
+    lambda data: data[:PATH_RECORD.size] + b"\xff" + data[PATH_RECORD.size + 1:],  # a name that is not UTF-8
+])
+def test_path_store_ignores_a_corrupt_file(tmp_path, capsys, damage):
+    path = str(tmp_path / "paths.bin")
+    store = PathStore(path)
+    store.put("example.com", KnownPath(("192.0.2.1", "198.51.100.7"), True, 1700000000.25))
+    store.save()
+    with open(path, "rb") as stream:
+        data = stream.read()
+    with open(path, "wb") as stream:
+        stream.write(damage(data))
+
+    loaded = PathStore(path)
+    loaded.load()
+    assert loaded.paths == {}
+    assert "corrupt path store" in capsys.readouterr().err
+
+
+def test_stop_set_forward_stops_at_known_hop_towards_prefix():
+    stop_set = StopSet(24)
+    prefix = stop_set.prefix("203.0.113.7")
+    assert str(prefix) == "203.0.113.0/24"
+    assert not stop_set.forward({"192.0.2.1"}, prefix)
+    # the same hop on the way to the prefix, from another host of it
+    assert stop_set.forward({"192.0.2.1", "192.0.2.99"}, stop_set.prefix("203.0.113.200"))
+    # but not on the way to another prefix
+    assert not stop_set.forward({"192.0.2.1"}, stop_set.prefix("198.51.100.7"))
+    assert not stop_set.forward(set(), prefix)  # a silent hop never stops
+
+
+def test_stop_set_backward_stops_at_any_known_hop():
+    stop_set = StopSet(24)
+    prefix = stop_set.prefix("203.0.113.7")
+    other = stop_set.prefix("198.51.100.7")
+    assert not stop_set.backward({"192.0.2.1"}, prefix)
+    assert stop_set.backward({"192.0.2.1"}, other)
+    # hops found backward join the global stop set as well
+    assert stop_set.forward({"192.0.2.1"}, prefix)
+    assert not stop_set.backward(set(), other)
+
+
+def test_stop_set_host_prefixes():
+    stop_set = StopSet(32, 128)
+    assert str(stop_set.prefix("203.0.113.7")) == "203.0.113.7/32"
+    assert str(stop_set.prefix("2001:db8::7")) == "2001:db8::7/128"
+    stop_set.forward({"192.0.2.1"}, stop_set.prefix("203.0.113.7"))
+    assert not stop_set.forward({"192.0.2.1"}, stop_set.prefix("203.0.113.8"))
+
+
+def test_doubletree_drops_results_beyond_destination():
+    # a destination one hop away, traced from TTL 3: it answers every TTL
+    buffer = TraceBuffer()
+    t = Traceroute("192.0.2.9", 1, 52, 64, 1000, 3, 10, buffer, numeric=True, stop_set=StopSet())
+
+    def trace_hop():
+        t.seq_no = 1
+        t.replies[t.ttl << 8 | 1] = 0.0, ICMP_ECHO_REPLY, "192.0.2.9"
+        t.print_trace(0.5, "192.0.2.9")
+        return {"192.0.2.9"}, True
+
+    t.trace_hop = trace_hop
+    t.doubletree_trace()
+    t.write_results(wait=True)
+    assert [(record.ttl, record.ip) for record in buffer.records] == [(1, "192.0.2.9")]
+
+
+def test_hop_samples_loss_and_delays():
+    samples = HopSamples()
+    for delay in (1.0, None, 2.0, 3.0, None, 4.0):
+        samples.add(delay, None if delay is None else "192.0.2.1")
+    stats = samples.summarize("192.0.2.9", 3)
+    assert (stats.destination, stats.ttl, stats.ip, stats.hostname) == ("192.0.2.9", 3, "192.0.2.1", "192.0.2.1")
+    assert (stats.sent, stats.received) == (6, 4)
+    assert stats.loss == pytest.approx(100 / 3)
+    assert (stats.min, stats.avg, stats.max) == (1.0, 2.5, 4.0)
+    # sample standard deviation of 1, 2, 3 and 4
+    assert stats.stddev == pytest.approx(math.sqrt(5 / 3))
+
+
+def test_hop_samples_nothing_received():
+    samples = HopSamples()
+    for _ in range(3):
+        samples.add(None)
+    stats = samples.summarize("192.0.2.9", 3)
+    assert (stats.ip, stats.hostname, stats.responders) == (None, None, ())
+    assert (stats.sent, stats.received, stats.loss) == (3, 0, 100.0)
+    assert (stats.min, stats.avg, stats.max, stats.stddev) == (None, None, None, None)
+
+    stats = HopSamples().summarize("192.0.2.9", 3)
+    assert (stats.sent, stats.loss, stats.avg) == (0, 0.0, None)
+
+
+def test_hop_samples_single_reply_has_no_spread():
+    samples = HopSamples()
+    samples.add(7.5, "192.0.2.1")
+    stats = samples.summarize("192.0.2.9", 3, hostname="router.example")
+    assert (stats.min, stats.avg, stats.max, stats.stddev) == (7.5, 7.5, 7.5, 0.0)
+    assert (stats.ip, stats.hostname) == ("192.0.2.1", "router.example")
+
+
+def test_hop_samples_rank_responders():
+    samples = HopSamples()
+    for ip in ("192.0.2.2", "192.0.2.1", None, "192.0.2.1", "192.0.2.3", "192.0.2.1", "192.0.2.2"):
+        samples.add(None if ip is None else 1.0, ip)
+    assert samples.ranked_responders() == ("192.0.2.1", "192.0.2.2", "192.0.2.3")
+    stats = samples.summarize("192.0.2.9", 3)
+    assert stats.ip == "192.0.2.1"
+    assert stats.responders == ("192.0.2.1", "192.0.2.2", "192.0.2.3")
+
+
+def test_hop_samples_keep_the_latest():
+    samples = HopSamples()
+    for i in range(HopSamples.MAX_SAMPLES + 1):
+        samples.add(float(i), "192.0.2.1" if i < HopSamples.MAX_SAMPLES else "192.0.2.2")
+    half = HopSamples.MAX_SAMPLES // 2
+    assert len(samples.delays) == len(samples.responders) == half + 1
+    assert samples.delays[0] == half and samples.delays[-1] == HopSamples.MAX_SAMPLES
+    assert samples.responders[-1] == "192.0.2.2"
+    stats = samples.summarize("192.0.2.9", 3)
+    assert (stats.sent, stats.min, stats.max) == (half + 1, half, HopSamples.MAX_SAMPLES)
+
+
+class InlineExecutor:
+    """Runs lookups as they are submitted, so entries expire on a known clock."""
+
+    def submit(self, fn, *args):
+        future = concurrent.futures.Future()
+        future.set_result(fn(*args))
+        return future
+
+
+@pytest.fixture
+def dns_cache(monkeypatch):
+    clock = types.SimpleNamespace(now=0.0)
+    monkeypatch.setattr(traceroute, "time", types.SimpleNamespace(monotonic=lambda: clock.now))
+    names = {"192.0.2.1": "one.example", "192.0.2.2": "two.example", "192.0.2.3": "three.example"}
+    queries = []
+
+    def query(ip):
+        queries.append(ip)
+        return names.get(ip)
+
+    cache = ReverseDnsCache(max_entries=2, ttl=100, negative_ttl=10)
+    cache.executor = InlineExecutor()
+    cache.query = query
+    return cache, clock, queries
+
+
+def test_reverse_dns_cache_expires_names(dns_cache):
+    cache, clock, queries = dns_cache
+    assert cache.lookup("192.0.2.1").result() == "one.example"
+    clock.now = 99.0
+    assert cache.lookup("192.0.2.1").result() == "one.example"
+    assert queries == ["192.0.2.1"]
+    clock.now = 100.0
+    assert cache.lookup("192.0.2.1").result() == "one.example"
+    assert queries == ["192.0.2.1", "192.0.2.1"]
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_reverse_dns_cache_caches_failures_briefly(dns_cache):
+    cache, clock, queries = dns_cache
+    assert cache.lookup("192.0.2.99").result() is None
+    clock.now = 9.0
+    assert cache.lookup("192.0.2.99").result() is None
+    assert queries == ["192.0.2.99"]
+    clock.now = 10.0
+    assert cache.lookup("192.0.2.99").result() is None
+    assert queries == ["192.0.2.99", "192.0.2.99"]
+
+
+def test_reverse_dns_cache_evicts_least_recently_used(dns_cache):
+    cache, clock, queries = dns_cache
+    cache.lookup("192.0.2.1")
+    cache.lookup("192.0.2.2")
+    cache.lookup("192.0.2.1")
+    cache.lookup("192.0.2.3")
+    assert list(cache.entries) == ["192.0.2.1", "192.0.2.3"]
+    assert cache.lookup("192.0.2.1").result() == "one.example"
+    assert cache.lookup("192.0.2.2").result() == "two.example"
+    assert queries == ["192.0.2.1", "192.0.2.2", "192.0.2.3", "192.0.2.2"]
+    assert cache.describe() == "6 reverse lookups, 2 served from cache, 2 cached"
+
+
+def test_reverse_dns_cache_shares_lookups_in_flight(dns_cache):
+    cache, clock, queries = dns_cache
+    pending = concurrent.futures.Future()
+    cache.executor = types.SimpleNamespace(submit=lambda fn, ip: pending)
+    assert cache.lookup("192.0.2.1") is pending
+    clock.now = 1000.0
+    assert cache.lookup("192.0.2.1") is pending
+    assert cache.entries["192.0.2.1"] == (pending, None)
+    pending.set_result("one.example")
+    assert cache.entries["192.0.2.1"] == (pending, 1100.0)
+
+
+def test_socket_errors_go_to_stderr(capsys):
+    print_socket_error(PermissionError(1, "Operation not permitted"))
+    print_socket_error(OSError(101, "Network is unreachable"))
+    out, err = capsys.readouterr()
+    assert out == ""
+    assert err.splitlines() == [
+        "Operation not permitted: ICMP messages can only be sent from a process running as root",
+        "Error: [Errno 101] Network is unreachable",
+    ]